@@ -0,0 +1,176 @@
+import argparse
+import glob
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import compiler
+import parse_tree
+
+SIGNATURE_CACHE = None
+RESULT_CACHE = None
+
+
+def collect_files(paths, manifest=None, pattern='*.txt'):
+    files = []
+    paths = list(paths)
+    if manifest:
+        with open(manifest) as manifest_file:
+            for line in manifest_file:
+                if line.strip() and not line.lstrip().startswith('#'):
+                    paths.append(line.strip())
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, pattern))))
+        elif glob.has_magic(path):
+            files.extend(sorted(glob.glob(path, recursive=True)))
+        else:
+            files.append(path)
+    return files
+
+
+def worker_signature(sym_table, cache_dir):
+    global SIGNATURE_CACHE
+    if SIGNATURE_CACHE is None:
+        SIGNATURE_CACHE = compiler.SignatureCache(cache_dir=cache_dir)
+    return SIGNATURE_CACHE.lookup(sym_table)[1]
+
+
+def worker_results(result_path, max_entries):
+    global RESULT_CACHE
+    if RESULT_CACHE is None and result_path:
+        RESULT_CACHE = compiler.ResultCache(path=result_path,
+                                            max_entries=max_entries)
+    return RESULT_CACHE
+
+
+def check_file(job):
+    (index, file_name, out_dir, write_outputs, cache_dir, result_path,
+     result_entries, fmt) = job
+    record = {'file': file_name, 'valid': False, 'stage': 'read',
+              'error': None, 'position': None, 'timings': {}}
+    timings = record['timings']
+    start = time.perf_counter()
+    try:
+        sym_table, formula = compiler.read_in_file(file_name)
+        timings['read'] = time.perf_counter() - start
+        record['stage'] = 'grammar'
+        phase = time.perf_counter()
+        signature = worker_signature(sym_table, cache_dir)
+        results = worker_results(result_path, result_entries)
+        comp = compiler.Compiler(signature, True, results)
+        timings['grammar'] = time.perf_counter() - phase
+        if results:
+            record['stage'] = 'parse'
+            phase = time.perf_counter()
+            result = comp.parse(formula)
+            timings['parse'] = time.perf_counter() - phase
+        else:
+            record['stage'] = 'lex'
+            phase = time.perf_counter()
+            tokens = comp.lex(formula)
+            timings['lex'] = time.perf_counter() - phase
+            record['stage'] = 'parse'
+            phase = time.perf_counter()
+            result = comp.parse_tokens(formula, tokens)
+            timings['parse'] = time.perf_counter() - phase
+        record['valid'] = True
+        record['stage'] = 'done'
+        if write_outputs and fmt != 'none':
+            base_name = os.path.splitext(os.path.basename(file_name))[0]
+            stem = os.path.join(out_dir, f'{index:06d}_{base_name}')
+            with open(f'{stem}_grammar.txt', 'w') as grammar_file:
+                grammar_file.write('\n'.join(signature.grammar()) + '\n')
+            phase = time.perf_counter()
+            try:
+                comp.render(result, f'{stem}_parse_tree.{fmt}', fmt)
+            except (ImportError, OSError) as err:
+                record['render_error'] = str(err)
+            timings['render'] = time.perf_counter() - phase
+    except compiler.CompilerError as err:
+        record['error'] = err.message
+        record['position'] = err.position
+    except Exception as err:
+        # Anything else fails this file only, not the rest of the batch.
+        record['valid'] = False
+        record['error'] = f'{type(err).__name__}: {err}'
+    timings['total'] = time.perf_counter() - start
+    return record
+
+
+def make_run_dir(base_dir):
+    os.makedirs(base_dir, exist_ok=True)
+    time_str = time.strftime('%Y-%m-%d_%H-%M-%S')
+    return tempfile.mkdtemp(prefix=f'{time_str}_', dir=base_dir)
+
+
+def run_batch(files, out_dir, jobs=None, write_outputs=False, chunksize=16,
+              cache_dir=None, result_path=None, fmt='png',
+              result_entries=compiler.RESULT_DISK_ENTRIES):
+    results_name = os.path.join(out_dir, 'results.jsonl')
+    work = [(i, name, out_dir, write_outputs, cache_dir, result_path,
+             result_entries, fmt) for i, name in enumerate(files)]
+    counts = {'files': 0, 'valid': 0, 'invalid': 0}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs) as pool, \
+            open(results_name, 'w') as results:
+        for record in pool.map(check_file, work, chunksize=chunksize):
+            results.write(json.dumps(record) + '\n')
+            counts['files'] += 1
+            counts['valid' if record['valid'] else 'invalid'] += 1
+    counts['seconds'] = time.perf_counter() - start
+    with open(os.path.join(out_dir, 'summary.json'), 'w') as summary:
+        json.dump(counts, summary, indent=2)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Validate many input files across a process pool')
+    parser.add_argument('paths', nargs='*', metavar='PATH',
+                        help='Input files, directories or glob patterns')
+    parser.add_argument('-m', '--manifest', metavar='FILE_NAME',
+                        help='File listing one input path per line')
+    parser.add_argument('-g', '--pattern', default='*.txt',
+                        help='Pattern used to pick files out of directories')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of worker processes (default: all cores)')
+    parser.add_argument('-o', '--out-dir', default='runs',
+                        help='Directory under which each run gets its own ' +
+                        'output directory')
+    parser.add_argument('-w', '--write-outputs', action='store_true',
+                        help='Also write the grammar and parse tree of each ' +
+                        'valid file into the run directory')
+    parser.add_argument('-f', '--format', default='png',
+                        choices=parse_tree.OUTPUT_FORMATS,
+                        help='Format of the parse trees written with -w')
+    parser.add_argument('--chunksize', type=int, default=16,
+                        help='Files handed to a worker at a time')
+    parser.add_argument('-c', '--cache-dir', metavar='DIR',
+                        help='Share grammar and lexer tables between runs' +
+                        ' through DIR')
+    parser.add_argument('-r', '--result-cache', metavar='FILE_NAME',
+                        help='Database file the workers share formula' +
+                        ' results through')
+    parser.add_argument('--result-cache-entries', type=int,
+                        default=compiler.RESULT_DISK_ENTRIES, metavar='N',
+                        help='Evict the least recently used results once ' +
+                        'the database holds N, 0 for no limit')
+    options = parser.parse_args()
+    files = collect_files(options.paths, options.manifest, options.pattern)
+    if not files:
+        parser.error('No input files found')
+    run_dir = make_run_dir(options.out_dir)
+    counts = run_batch(files, run_dir, options.jobs, options.write_outputs,
+                       options.chunksize, options.cache_dir,
+                       options.result_cache, options.format,
+                       options.result_cache_entries)
+    print(f'Checked {counts["files"]} files in {counts["seconds"]:.2f}s:' +
+          f' {counts["valid"]} valid, {counts["invalid"]} invalid')
+    print(f'Results written to {os.path.join(run_dir, "results.jsonl")}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+import argparse
+import io
+import itertools
+import json
+import random
+import sys
+
+import compiler
+import instrument
+import parse_tree
+
+CONNECTIVES = ['AND', 'OR', 'IMPLIES', 'IFF']
+PHASES = ['read', 'grammar', 'lex', 'parse', 'render']
+AXES = ['symbols', 'symbol_length', 'atoms', 'depth', 'quantifiers',
+        'negations']
+
+
+def symbol_name(prefix, i, length):
+    if length is None:
+        return f'{prefix}{i}'
+    return f'{prefix}{i}'.ljust(length, '_')
+
+
+def gen_signature_lines(n_symbols, length=None):
+    names = [[symbol_name(prefix, i, length) for i in range(n_symbols)]
+             for prefix in ('VAR', 'CONST', 'PRED')]
+    return [f'variables: {" ".join(names[0])}\n',
+            f'constants: {" ".join(names[1])}\n',
+            f'predicates: {" ".join(name + "[1]" for name in names[2])}\n',
+            'equality: EQ\n',
+            f'connectives: {" ".join(CONNECTIVES)} NEG\n',
+            'quantifiers: EXISTS FORALL\n']
+
+
+def gen_signature(n_symbols, length=None):
+    sym_table, _ = compiler.read_input(gen_signature_lines(n_symbols, length))
+    return compiler.Signature(sym_table)
+
+
+def chain_rounds(n_atoms, depth):
+    # Pairing rounds to run before chaining what is left, so that the
+    # connectives nest depth deep (or as close as n_atoms allows).
+    rounds = 0
+    items = n_atoms
+    while items > 1 and rounds + items - 1 > depth:
+        items = (items + 1) // 2
+        rounds += 1
+    return rounds
+
+
+def gen_formula(n_atoms, n_symbols, length=None, depth=None, quantifiers=0.0,
+                negations=0.0):
+    # depth=None gives a left-deep chain, the most deeply nested shape.
+    def name(prefix):
+        return symbol_name(prefix, random.randrange(n_symbols), length)
+
+    def prefix(formula):
+        if quantifiers and random.random() < quantifiers:
+            quantifier = random.choice(['EXISTS', 'FORALL'])
+            formula = f'{quantifier} {name("VAR")} {formula}'
+        if negations and random.random() < negations:
+            formula = f'NEG {formula}'
+        return formula
+
+    items = []
+    for _ in range(n_atoms):
+        if random.random() < 0.5:
+            atom = f'({name("CONST")} EQ {name("VAR")})'
+        else:
+            atom = f'{name("PRED")}({name("VAR")})'
+        items.append(prefix(atom))
+    rounds = 0 if depth is None else chain_rounds(n_atoms, depth)
+    for _ in range(rounds):
+        paired = []
+        for i in range(0, len(items) - 1, 2):
+            paired.append(prefix(f'({items[i]} {random.choice(CONNECTIVES)}' +
+                                 f' {items[i + 1]})'))
+        if len(items) % 2:
+            paired.append(items[-1])
+        items = paired
+    parts = ['(' * (len(items) - 1), items[0]]
+    for item in items[1:]:
+        parts.append(f' {random.choice(CONNECTIVES)} {item})')
+    return ''.join(parts)
+
+
+def gen_input(case):
+    lines = gen_signature_lines(case['symbols'], case['symbol_length'])
+    formula = gen_formula(case['atoms'], case['symbols'],
+                          case['symbol_length'], case['depth'],
+                          case['quantifiers'], case['negations'])
+    return lines + [f'formula: {formula}\n']
+
+
+def time_case(case, repeats, iterative=True):
+    lines = gen_input(case)
+    best = {}
+    for _ in range(repeats):
+        profile = instrument.Profile()
+        with profile.phase('read'):
+            sym_table, formula = compiler.read_input(lines)
+        with profile.phase('grammar'):
+            signature = compiler.Signature(sym_table)
+            signature.grammar()
+            signature.ll1_grammar()
+        comp = compiler.Compiler(signature, iterative, profile=profile)
+        result = comp.parse_tokens(formula, comp.lex(formula))
+        with profile.phase('render'):
+            parse_tree.write_dot(result.tree, result.tokens, io.StringIO())
+        for phase, (wall, _, _) in profile.phases.items():
+            if phase not in best or wall < best[phase]:
+                best[phase] = wall
+    record = dict(case)
+    record['chars'] = len(formula)
+    record['tokens'] = len(result.tokens)
+    record['nodes'] = len(result.tree)
+    record['tree_depth'] = max(parse_tree.depths(result.tree))
+    record['seconds'] = best
+    return record
+
+
+def make_cases(axes, grid=False):
+    # Without grid, every axis is swept on its own from the first value of
+    # all the others.
+    base = {axis: values[0] for axis, values in axes.items()}
+    if grid:
+        combos = itertools.product(*axes.values())
+        return [dict(zip(axes, combo)) for combo in combos]
+    cases = [base]
+    for axis, values in axes.items():
+        for value in values[1:]:
+            case = dict(base)
+            case[axis] = value
+            cases.append(case)
+    return cases
+
+
+def case_key(case):
+    return tuple(case[axis] for axis in AXES)
+
+
+def print_header():
+    print(f'{"symbols":>8} {"len":>4} {"atoms":>7} {"depth":>6} ' +
+          f'{"quant":>5} {"neg":>5} {"tokens":>8} ' +
+          ' '.join(f'{phase:>9}' for phase in PHASES))
+
+
+def print_record(record):
+    depth = '-' if record['depth'] is None else record['depth']
+    length = record['symbol_length']
+    if length is None:
+        length = '-'
+    print(f'{record["symbols"]:>8} {length:>4} {record["atoms"]:>7}' +
+          f' {depth:>6} {record["quantifiers"]:>5} {record["negations"]:>5}' +
+          f' {record["tokens"]:>8} ' +
+          ' '.join(f'{record["seconds"].get(phase, 0):>9.4f}'
+                   for phase in PHASES))
+
+
+def compare(records, baseline, threshold, min_seconds):
+    old = {case_key(record): record for record in baseline}
+    regressions = []
+    for record in records:
+        before = old.get(case_key(record))
+        if before is None:
+            continue
+        for phase in PHASES:
+            new_time = record['seconds'].get(phase)
+            old_time = before['seconds'].get(phase)
+            if new_time is None or old_time is None:
+                continue
+            if (new_time > old_time * (1 + threshold) and
+                    new_time - old_time > min_seconds):
+                regressions.append((record, phase, old_time, new_time))
+    for record, phase, old_time, new_time in regressions:
+        print(f'REGRESSION {phase} symbols={record["symbols"]}' +
+              f' atoms={record["atoms"]} depth={record["depth"]}:' +
+              f' {old_time:.4f}s -> {new_time:.4f}s' +
+              f' ({new_time / old_time:.2f}x)')
+    return regressions
+
+
+def optional_int(value):
+    return None if value == 'none' else int(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time every pipeline phase over generated workloads')
+    parser.add_argument('--symbols', nargs='+', type=int,
+                        default=[100, 10, 10000],
+                        help='Number of symbols of each kind in the signature')
+    parser.add_argument('--symbol-length', nargs='+', type=optional_int,
+                        default=[None, 32],
+                        help='Pad symbol names to this many characters, ' +
+                        'none leaves them short')
+    parser.add_argument('--atoms', nargs='+', type=int,
+                        default=[1000, 100, 10000],
+                        help='Number of atoms in each generated formula')
+    parser.add_argument('--depth', nargs='+', type=optional_int,
+                        default=[None, 16],
+                        help='Nesting depth of binary connectives, none ' +
+                        'chains every atom')
+    parser.add_argument('--quantifiers', nargs='+', type=float,
+                        default=[0.0, 0.5],
+                        help='Chance of a quantifier before each subformula')
+    parser.add_argument('--negations', nargs='+', type=float,
+                        default=[0.0, 0.5],
+                        help='Chance of a negation before each subformula')
+    parser.add_argument('--grid', action='store_true',
+                        help='Run every combination instead of sweeping ' +
+                        'one axis at a time')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='Runs per case, the fastest is reported')
+    parser.add_argument('--recursive', action='store_true',
+                        help='Use the recursive parser, which fails on ' +
+                        'deeply nested formulas')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', metavar='FILE_NAME',
+                        help='Write the results to a baseline file')
+    parser.add_argument('--compare', metavar='FILE_NAME',
+                        help='Flag phases that got slower than in a ' +
+                        'baseline file')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Relative slowdown counted as a regression')
+    parser.add_argument('--min-seconds', type=float, default=0.001,
+                        help='Ignore slowdowns smaller than this')
+    options = parser.parse_args()
+    axes = {axis: getattr(options, axis) for axis in AXES}
+    records = []
+    print_header()
+    for case in make_cases(axes, options.grid):
+        random.seed(options.seed)
+        record = time_case(case, options.repeats, not options.recursive)
+        print_record(record)
+        records.append(record)
+    if options.save:
+        with open(options.save, 'w') as out_file:
+            json.dump({'seed': options.seed, 'repeats': options.repeats,
+                       'records': records}, out_file, indent=2)
+    if options.compare:
+        with open(options.compare) as in_file:
+            baseline = json.load(in_file)['records']
+        if compare(records, baseline, options.threshold, options.min_seconds):
+            sys.exit(1)
+        print('No regressions')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+def content_key(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class LRUCache:
+    def __init__(self, max_size=128):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class DiskCache:
+    def __init__(self, cache_dir, suffix='.pickle'):
+        self.cache_dir = cache_dir
+        self.suffix = suffix
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f'{key}{self.suffix}')
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as cache_file:
+                return pickle.load(cache_file)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            return None
+
+    def put(self, key, value):
+        handle, tmp_name = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as tmp_file:
+                pickle.dump(value, tmp_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_name, self.path(key))
+        except OSError:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+
+
+class SqliteCache:
+    # A single database file that several processes can read and write.
+    # max_entries bounds it, evicting the least recently used rows.
+    def __init__(self, path, max_entries=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.puts = 0
+        self.connection = sqlite3.connect(path, timeout=30,
+                                          check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY,' +
+                ' value BLOB NOT NULL, used REAL NOT NULL)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+
+    def get(self, key):
+        try:
+            with self.lock, self.connection:
+                row = self.connection.execute(
+                    'SELECT value FROM entries WHERE key = ?',
+                    (key,)).fetchone()
+                if row is None:
+                    return None
+                if self.max_entries:
+                    self.connection.execute(
+                        'UPDATE entries SET used = ? WHERE key = ?',
+                        (time.time(), key))
+            return pickle.loads(row[0])
+        except (sqlite3.Error, pickle.UnpicklingError, EOFError):
+            return None
+
+    def put(self, key, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        try:
+            with self.lock, self.connection:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                    (key, data, time.time()))
+                self.puts += 1
+                if self.max_entries and self.puts % 64 == 0:
+                    self.evict()
+        except sqlite3.Error:
+            pass
+
+    def evict(self):
+        count = self.connection.execute(
+            'SELECT COUNT(*) FROM entries').fetchone()[0]
+        if count > self.max_entries:
+            self.connection.execute(
+                'DELETE FROM entries WHERE key IN (SELECT key FROM entries' +
+                ' ORDER BY used LIMIT ?)', (count - self.max_entries,))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class TieredCache:
+    # Objects stay live in the LRU tier; the disk tier holds encode()d plain
+    # data so it can be shared between processes.
+    def __init__(self, max_size=128, disk=None):
+        self.memory = LRUCache(max_size)
+        self.disk = disk
+        self.disk_hits = 0
+
+    def encode(self, value):
+        return value
+
+    def decode(self, data):
+        return data
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is None and self.disk:
+            data = self.disk.get(key)
+            if data is not None:
+                value = self.decode(data)
+                self.disk_hits += 1
+                self.memory.put(key, value)
+        return value
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+        if self.disk:
+            self.disk.put(key, self.encode(value))
+
+    def stats(self):
+        return {'size': len(self.memory), 'memory_hits': self.memory.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.memory.misses - self.disk_hits}
@@ -1,107 +1,174 @@
 import argparse
+import logging
+import logging.handlers
+import mmap
+import os
 import time
 import sys
 import re
-import pydot
+import cache
+import instrument
+import ll1
+import model
+import normal_form
+import parse_dag
+import parse_tree
+import scope
+import token_stream
+from queue import SimpleQueue
 
-LOG_FILE = ''
-GRAMMAR_FILE = ''
 CONNSTRINGS = ['AND', 'OR', 'IMPLIES', 'IFF', 'NOT']
 QSTRINGS = ['EXISTS', 'FORALL']
-LOOKAHEAD_INDEX = 0
-FORM_INDEX = 0
-EQUALITY = ''
-NEGATION = ''
-CONNECTIVES = []
-QUANTIFIERS = []
-VARIABLES = []
-CONSTANTS = []
-PREDICATES = []
-FORMULA = ''
-TOKENS = []
-NODE_ID = 0
-TERM_NODES = []
-
-
-def open_logger(path):
-    global LOG_FILE
-    try:
-        LOG_FILE = open(path, 'w')
-    except IOError:
-        sys.exit('Could not open log file. EXITING.')
-
-
-def close_logger():
-    global LOG_FILE
-    try:
-        LOG_FILE.close()
-    except IOError:
-        sys.exit('Could not close log file. EXITING.')
-
-
-def log_error(err_str):
-    print(err_str)
-    try:
-        LOG_FILE.write(f'[ERROR] {err_str}\n')
-        sys.exit()
-    except IOError:
-        sys.exit('Could not write to log file. EXITING.')
-
-
-def log_msg(msg_str):
-    print(msg_str)
-    try:
-        LOG_FILE.write(f'[MSG] {msg_str}\n')
-    except IOError:
-        sys.exit('Could not write to log file. EXITING.')
-
-
-def open_grammar(path):
-    global GRAMMAR_FILE
-    try:
-        GRAMMAR_FILE = open(path, 'w')
-    except IOError:
-        sys.exit('Could not open log file. EXITING.')
-
-
-def close_grammar():
-    global GRAMMAR_FILE
-    try:
-        GRAMMAR_FILE.close()
-    except IOError:
-        sys.exit('Could not close log file. EXITING.')
-
-
-def log_grammar(msg_str):
-    print(msg_str)
-    try:
-        GRAMMAR_FILE.write(f'{msg_str}\n')
-    except IOError:
-        sys.exit('Could not write to log file. EXITING.')
-
-
-def escape_bslash(string):
-    return string.replace('\\', '\\\\')
+# Part of every cache key; bump it when cached tables or results change shape.
+CACHE_FORMAT = 2
+LOG_LEVELS = {'debug': logging.DEBUG, 'info': logging.INFO,
+              'error': logging.ERROR}
+
+
+class CompilerError(Exception):
+    def __init__(self, message, position=None, line=None):
+        super().__init__(message)
+        self.message = message
+        self.position = position
+        self.line = line
+
+
+class LogFileError(CompilerError):
+    pass
+
+
+class LogFormatter(logging.Formatter):
+    def format(self, record):
+        tag = 'ERROR' if record.levelno >= logging.ERROR else 'MSG'
+        return f'[{tag}] {record.getMessage()}'
+
+
+class BufferedFileHandler(logging.FileHandler):
+    # Leaves flushing to the file buffer and close() instead of flushing
+    # after every record.
+    def flush(self):
+        pass
+
+
+class Log:
+    # The step by step messages are logged at DEBUG, results at INFO and
+    # errors at ERROR. Sinks hang off a QueueListener thread when background
+    # is set, so callers never wait on the console or the disk.
+    def __init__(self, echo=False, level=logging.DEBUG, background=True):
+        self.level = level
+        self.background = background
+        self.logger = logging.Logger('compiler')
+        self.sinks = []
+        self.listener = None
+        self.log_handler = None
+        self.grammar_file = None
+        if echo:
+            console = logging.StreamHandler(sys.stdout)
+            console.setFormatter(logging.Formatter('%(message)s'))
+            self.add_sink(console)
+        else:
+            self.attach()
+
+    def add_sink(self, handler):
+        handler.setLevel(self.level)
+        self.sinks.append(handler)
+        self.attach()
+
+    def attach(self):
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+        if not self.sinks:
+            self.logger.setLevel(logging.CRITICAL + 1)
+            return
+        self.logger.setLevel(self.level)
+        if self.background:
+            self.logger.addHandler(logging.handlers.QueueHandler(
+                SimpleQueue()))
+            self.listener = logging.handlers.QueueListener(
+                self.logger.handlers[0].queue, *self.sinks,
+                respect_handler_level=True)
+            self.listener.start()
+        else:
+            for handler in self.sinks:
+                self.logger.addHandler(handler)
+
+    def open_logger(self, path):
+        try:
+            self.log_handler = BufferedFileHandler(path, 'w')
+        except IOError:
+            raise LogFileError('Could not open log file. EXITING.')
+        self.log_handler.setFormatter(LogFormatter())
+        self.log_handler.addFilter(
+            lambda record: not getattr(record, 'grammar', False))
+        self.add_sink(self.log_handler)
+
+    def close_logger(self):
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+        if self.log_handler:
+            self.sinks.remove(self.log_handler)
+            try:
+                self.log_handler.close()
+            except IOError:
+                raise LogFileError('Could not close log file. EXITING.')
+            self.log_handler = None
+        self.attach()
+
+    def error(self, err_str):
+        self.logger.error(err_str)
+
+    def info(self, msg_str):
+        self.logger.info(msg_str)
+
+    def msg(self, msg_str):
+        self.logger.debug(msg_str)
+
+    def open_grammar(self, path):
+        try:
+            self.grammar_file = open(path, 'w')
+        except IOError:
+            raise LogFileError('Could not open log file. EXITING.')
+
+    def close_grammar(self):
+        try:
+            if self.grammar_file:
+                self.grammar_file.close()
+        except IOError:
+            raise LogFileError('Could not close log file. EXITING.')
+        self.grammar_file = None
+
+    def grammar(self, msg_str):
+        self.logger.debug(msg_str, extra={'grammar': True})
+        if self.grammar_file:
+            try:
+                self.grammar_file.write(f'{msg_str}\n')
+            except IOError:
+                raise LogFileError('Could not write to log file. EXITING.')
 
 
 def validate_var(var, var_type):
     if not re.fullmatch(r'[a-zA-Z0-9_]+', var):
-        log_error(f'{var_type} {var} contains an invalid symbol. {var_type}s' +
-                  f' can only contain alphanumeric characters or underscores')
+        raise CompilerError(f'{var_type} {var} contains an invalid symbol.' +
+                            f' {var_type}s can only contain alphanumeric' +
+                            f' characters or underscores')
 
 
 def validate_quant_conn(var, var_type):
     if not re.fullmatch(r'[a-zA-Z0-9_\\]+', var):
-        log_error(f'{var_type} {var} contains an invalid symbol. {var_type}s' +
-                  f' can only contain alphanumeric characters, underscores' +
-                  f' or backslashes')
+        raise CompilerError(f'{var_type} {var} contains an invalid symbol.' +
+                            f' {var_type}s can only contain alphanumeric' +
+                            f' characters, underscores or backslashes')
 
 
 def validate_equality(var):
     if not re.fullmatch(r'[a-zA-Z0-9_=\\]+', var):
-        log_error(f'Equality {var} contains an invalid symbol. Equality' +
-                  f' can only contain alphanumeric characters, underscores' +
-                  f' or "="')
+        raise CompilerError(f'Equality {var} contains an invalid symbol.' +
+                            f' Equality can only contain alphanumeric' +
+                            f' characters, underscores or "="')
 
 
 def parse_variables(line_split, sym_table):
@@ -110,7 +177,7 @@ def parse_variables(line_split, sym_table):
         for var in variables:
             validate_var(var, 'Variable')
             if var in sym_table:
-                log_error(
+                raise CompilerError(
                     f'Variable {var} is already defined as a' +
                     f' {sym_table[var][0]}')
             else:
@@ -123,7 +190,7 @@ def parse_constants(line_split, sym_table):
         for con in constants:
             validate_var(con, 'Constant')
             if con in sym_table:
-                log_error(
+                raise CompilerError(
                     f'Constant {con} is already defined as a' +
                     f' {sym_table[con][0]}')
             else:
@@ -132,13 +199,13 @@ def parse_constants(line_split, sym_table):
 
 def parse_equality(line_split, sym_table):
     if len(line_split) != 2 or len(line_split[1].split()) != 1:
-        log_error(
+        raise CompilerError(
             'Exactly 1 equality symbol must be sepecified in an' +
             f' input file')
     equality = line_split[1].split()[0]
     validate_equality(equality)
     if equality in sym_table:
-        log_error(
+        raise CompilerError(
             f'Equality {equality} is already defined as a' +
             f' {sym_table[equality][0]}')
     else:
@@ -147,13 +214,13 @@ def parse_equality(line_split, sym_table):
 
 def parse_connectives(line_split, sym_table):
     if len(line_split) != 2 or len(line_split[1].split()) != 5:
-        log_error('Exactly 5 equality symbols must be defined')
+        raise CompilerError('Exactly 5 equality symbols must be defined')
     connectives = line_split[1].split()
     count = 0
     for con in connectives:
         validate_quant_conn(con, 'Connective')
         if con in sym_table:
-            log_error(
+            raise CompilerError(
                 f'Connective {con} is already defined as a' +
                 f' {sym_table[con][0]}')
         else:
@@ -163,13 +230,13 @@ def parse_connectives(line_split, sym_table):
 
 def parse_quantifiers(line_split, sym_table):
     if len(line_split) != 2 or len(line_split[1].split()) != 2:
-        log_error('Exactly 2 quantifiers must be sepecified')
+        raise CompilerError('Exactly 2 quantifiers must be sepecified')
     quantifiers = line_split[1].split()
     count = 0
     for quant in quantifiers:
         validate_quant_conn(quant, 'Quantifier')
         if quant in sym_table:
-            log_error(
+            raise CompilerError(
                 f'Quantifier {quant} is already defined as a' +
                 f' {sym_table[quant][0]}')
         else:
@@ -182,13 +249,13 @@ def parse_predicates(line_split, sym_table):
         predicates = line_split[1].split()
         for pred in predicates:
             if not re.fullmatch(r'[a-zA-Z0-9_]+\[[0-9]+\]', pred):
-                log_error(
+                raise CompilerError(
                     f'Predicate {pred} does not match valid predicate' +
                     f' syntax. Correct syntax is symbol[count]')
             name = re.match(r'[a-zA-Z0-9_]+', pred).group(0)
             count = pred.split('[')[1][0:-1]
             if name in sym_table:
-                log_error(
+                raise CompilerError(
                     f'Predicate {name} is already defined as a' +
                     f' {sym_table[name][0]}')
             else:
@@ -196,516 +263,1549 @@ def parse_predicates(line_split, sym_table):
 
 
 def parse_formula(lines, count):
-    global FORMULA
     skip = 0
     split = lines[count].split(':')
     if len(split) != 2:
-        log_error('You must specify a formula in the input file')
-    FORMULA = ' '.join(split[1].split()).strip()
+        raise CompilerError('You must specify a formula in the input file')
+    formula = ' '.join(split[1].split()).strip()
     for i in range(count + 1, len(lines)):
         if len(lines[i].split(':')) == 1:
-            FORMULA += ' '.join(lines[i].split()).strip()
+            formula += ' '.join(lines[i].split()).strip()
             skip += 1
         else:
             break
-    if len(FORMULA) == 0:
-        log_error('You must specify a formula in the input file')
-    return skip
+    if len(formula) == 0:
+        raise CompilerError('You must specify a formula in the input file')
+    return formula, skip
+
 
+def new_sym_table():
+    sym_table = {'(': ['SEPARATOR', 'OB'], ')': [
+        'SEPARATOR', 'CB'], ',': ['SEPARATOR', 'C']}
+    sym_table.update({'[': ['FORBIDDEN'], ']': ['FORBIDDEN']})
+    return sym_table
 
-def read_in_file(file_name, sym_table):
+
+def read_in_file(file_name, log=None, errors=None):
     try:
         with open(file_name) as in_file:
             lines = list(in_file)
     except IOError:
-        log_error('Could not open input file.')
+        raise CompilerError('Could not open input file.')
+    except UnicodeDecodeError:
+        raise CompilerError('Input file is not valid text.')
+    return read_input(lines, log, errors)
+
+
+NON_SPACE = re.compile(rb'\S')
+NON_SPACE_RUN = re.compile(rb'\S+')
+LINE_BREAK = re.compile(rb'[\n\r]')
+
+
+def map_input(file_name, log=None, errors=None):
+    # Like read_in_file, but the formula is returned as a memoryview of the
+    # mapped file for lex_buffer, and only signature lines are decoded.
+    # normal_error gives the positions read_in_file would for its errors.
+    if log is None:
+        log = Log()
+    try:
+        with open(file_name, 'rb') as in_file:
+            if os.fstat(in_file.fileno()).st_size == 0:
+                return read_input([], log, errors)
+            buffer = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, ValueError):
+        raise CompilerError('Could not open input file.')
+    sym_table = new_sym_table()
+    formula = ''
+    defined = {}
+    i = 0
+    start = 0
+    while start < len(buffer):
+        end = buffer.find(b'\n', start) + 1 or len(buffer)
+        colon = buffer.find(b':', start, end)
+        try:
+            if colon == -1:
+                read_field([buffer[start:end].decode()], i, defined,
+                           sym_table, log)
+            elif buffer[start:colon].decode().strip() == 'formula':
+                if 'formula' in defined:
+                    raise CompilerError(
+                        f'Formula has already been defined on line' +
+                        f' {defined["formula"]} of input file cannot' +
+                        f' redefine them on line {i}')
+                log.msg('Reading Formula')
+                defined['formula'] = i
+                if buffer.find(b':', colon + 1, end) != -1:
+                    raise CompilerError(
+                        'You must specify a formula in the input file')
+                # Continuation lines are the ones without a colon.
+                region_end = end
+                lines = 0
+                while region_end < len(buffer):
+                    next_end = (buffer.find(b'\n', region_end) + 1 or
+                                len(buffer))
+                    if buffer.find(b':', region_end, next_end) != -1:
+                        break
+                    region_end = next_end
+                    lines += 1
+                first = NON_SPACE.search(buffer, colon + 1, region_end)
+                if first is None:
+                    raise CompilerError(
+                        'You must specify a formula in the input file')
+                formula = memoryview(buffer)[first.start():region_end]
+                end = region_end
+                i += lines
+            else:
+                read_field(buffer[start:end].decode().split(':'), i,
+                           defined, sym_table, log)
+        except CompilerError as err:
+            collect(errors, err, i)
+        except UnicodeDecodeError:
+            raise CompilerError('Input file is not valid text.')
+        start = end
+        i += 1
+    return sym_table, formula
+
+
+SIGNATURE_FIELDS = {
+    'variables': ('Variables have', parse_variables),
+    'constants': ('Constants have', parse_constants),
+    'equality': ('Equality has', parse_equality),
+    'connectives': ('Connectives have', parse_connectives),
+    'quantifiers': ('Quantifiers have', parse_quantifiers),
+    'predicates': ('Predicates have', parse_predicates),
+}
+
+
+def read_field(line_split, line_no, defined, sym_table, log):
+    field = line_split[0].strip()
+    if field not in SIGNATURE_FIELDS:
+        raise CompilerError(f'Invalid field name {field} on line {line_no}')
+    name, parse_field = SIGNATURE_FIELDS[field]
+    if field in defined:
+        raise CompilerError(f'{name} already been defined' +
+                            f' on line {defined[field]} of input file' +
+                            f' cannot redefine them on line {line_no}')
+    log.msg(f'Reading {field.capitalize()}')
+    parse_field(line_split, sym_table)
+    defined[field] = line_no
+
+
+def collect(errors, err, line):
+    # With an errors list, keep going after a bad line instead of failing.
+    if errors is None:
+        raise err
+    errors.append(CompilerError(err.message, err.position, line))
+
+
+def read_input(lines, log=None, errors=None):
+    if log is None:
+        log = Log()
+    sym_table = new_sym_table()
+    formula = ''
+    defined = {}
     i = 0
-    var = (False, 0)
-    con = (False, 0)
-    eq = (False, 0)
-    conn = (False, 0)
-    quant = (False, 0)
-    pred = (False, 0)
-    form = (False, 0)
     while i < len(lines):
-        line = lines[i]
+        line_split = lines[i].split(':')
+        try:
+            if line_split[0].strip() == 'formula':
+                if 'formula' in defined:
+                    raise CompilerError(
+                        f'Formula has already been defined on line' +
+                        f' {defined["formula"]} of input file cannot' +
+                        f' redefine them on line {i}')
+                log.msg('Reading Formula')
+                defined['formula'] = i
+                formula, skip = parse_formula(lines, i)
+                i += skip
+            else:
+                read_field(line_split, i, defined, sym_table, log)
+        except CompilerError as err:
+            collect(errors, err, i)
+        i += 1
+    return sym_table, formula
+
+
+def stream_input(lines, log=None, errors=None):
+    if log is None:
+        log = Log()
+    lines = enumerate(lines)
+    sym_table = new_sym_table()
+    defined = {}
+    for i, line in lines:
         line_split = line.split(':')
-        if line_split[0].strip() == 'variables':
-            if var[0]:
-                log_error(f'Variables have already been defined' +
-                          f' on line {var[1]} of input file' +
-                          f' cannot redefine them on line {i}')
-            log_msg(f'Reading Variables')
-            parse_variables(line_split, sym_table)
-            var = (True, i)
-        elif line_split[0].strip() == 'constants':
-            if con[0]:
-                log_error(f'Constants have already been defined' +
-                          f' on line {var[1]} of input file' +
-                          f' cannot redefine them on line {i}')
-            log_msg(f'Reading Constants')
-            parse_constants(line_split, sym_table)
-            con = (True, i)
-        elif line_split[0].strip() == 'equality':
-            if eq[0]:
-                log_error(f'Equality has already been defined' +
-                          f' on line {var[1]} of input file' +
-                          f' cannot redefine them on line {i}')
-            log_msg(f'Reading Equality')
-            parse_equality(line_split, sym_table)
-            eq = (True, i)
-        elif line_split[0].strip() == 'connectives':
-            if conn[0]:
-                log_error(f'Connectives have already been defined' +
-                          f' on line {var[1]} of input file' +
-                          f' cannot redefine them on line {i}')
-            log_msg(f'Reading Connectives')
-            parse_connectives(line_split, sym_table)
-            conn = (True, i)
-        elif line_split[0].strip() == 'quantifiers':
-            if quant[0]:
-                log_error(f'Quantifiers have already been defined' +
-                          f' on line {var[1]} of input file' +
-                          f' cannot redefine them on line {i}')
-            log_msg('Reading Quantifiers')
-            parse_quantifiers(line_split, sym_table)
-            quant = (True, i)
-        elif line_split[0].strip() == 'predicates':
-            if pred[0]:
-                log_error(f'Predicates have already been defined' +
-                          f' on line {var[1]} of input file' +
-                          f' cannot redefine them on line {i}')
-            log_msg('Reading Predicates')
-            parse_predicates(line_split, sym_table)
-            pred = (True, i)
-        elif line_split[0].strip() == 'formula':
-            if form[0]:
-                log_error(f'Formula has already been defined' +
-                          f' on line {var[1]} of input file' +
-                          f' cannot redefine them on line {i}')
-            log_msg('Reading Formula')
-            skip = parse_formula(lines, i)
-            form = (True, i)
-            i += skip
+        if line_split[0].strip() == 'formula':
+            return sym_table, stream_formulas(i, line_split, lines, log,
+                                              errors)
+        try:
+            read_field(line_split, i, defined, sym_table, log)
+        except CompilerError as err:
+            collect(errors, err, i)
+    return sym_table, iter(())
+
+
+def stream_formulas(line_no, line_split, lines, log, errors=None):
+    while line_split:
+        start = line_no
+        parts = []
+        valid = False
+        if line_split[0].strip() != 'formula':
+            collect(errors, CompilerError(
+                f'Field {line_split[0].strip()} on line {line_no} must come' +
+                f' before the first formula'), line_no)
+        elif len(line_split) != 2:
+            collect(errors, CompilerError(
+                f'You must specify a formula on line {line_no}'), line_no)
         else:
-            log_error(f'Invalid field name {line_split[0].strip()} on' +
-                      f' line {i}')
-        i += 1
+            log.msg(f'Reading Formula on line {line_no}')
+            parts.append(' '.join(line_split[1].split()))
+            valid = True
+        line_split = None
+        for line_no, line in lines:
+            split = line.split(':')
+            if len(split) != 1:
+                line_split = split
+                break
+            parts.append(' '.join(line.split()))
+        formula = ''.join(parts)
+        if not valid:
+            continue
+        if len(formula) == 0:
+            collect(errors, CompilerError(
+                f'You must specify a formula on line {start}'), start)
+            continue
+        yield start, formula
+
+
+class Signature:
+    def __init__(self, sym_table, trie=None, grammar_lines=None):
+        self.sym_table = sym_table
+        self.grammar_lines = grammar_lines
+        self.ll1 = None
+        self.bytes_trie = None
+        self.constants = []
+        self.variables = []
+        self.predicates = []
+        self.quantifiers = []
+        self.connectives = []
+        self.equality = ''
+        self.negation = ''
+        # Symbol ids are positions in the symbol table.
+        self.symbols = list(sym_table)
+        self.symbol_ids = {sym: i for i, sym in enumerate(self.symbols)}
+        for sym, attrib in sym_table.items():
+            if attrib[0] == 'CONSTANT':
+                self.constants.append(sym)
+            elif attrib[0] == 'VARIABLE':
+                self.variables.append(sym)
+            elif attrib[0] == 'PREDICATE':
+                self.predicates.append(sym)
+            elif attrib[0] == 'EQUALITY':
+                self.equality = sym
+            elif attrib[0] == 'QUANTIFIER':
+                self.quantifiers.append(sym)
+            elif attrib[0] == 'CONNECTIVE':
+                if attrib[1] == 'NOT':
+                    self.negation = sym
+                else:
+                    self.connectives.append(sym)
+        if trie is None:
+            trie = build_trie(
+                [(self.connectives, token_stream.CONNECTIVE),
+                 (self.variables, token_stream.VARIABLE),
+                 (self.constants, token_stream.CONSTANT),
+                 (self.quantifiers, token_stream.QUANTIFIER),
+                 (self.predicates, token_stream.PREDICATE),
+                 ([self.equality], token_stream.EQUALITY),
+                 ([self.negation], token_stream.NEGATION),
+                 (['('], token_stream.LPAREN), ([')'], token_stream.RPAREN),
+                 ([','], token_stream.COMMA)], self.symbol_ids)
+        self.trie = trie
+
+    def arity(self, pred):
+        return int(self.sym_table[pred][1])
+
+    def grammar(self):
+        if self.grammar_lines is None:
+            self.grammar_lines = generate_grammar(self)
+        return self.grammar_lines
+
+    def byte_trie(self):
+        if self.bytes_trie is None:
+            self.bytes_trie = byte_trie(self.trie)
+        return self.bytes_trie
+
+    def ll1_grammar(self):
+        if self.ll1 is None:
+            self.ll1 = build_ll1_grammar(self)
+        return self.ll1
+
+
+def sym_table_text(sym_table):
+    # Symbol order decides the order of the grammar rules, so it is kept.
+    return '\n'.join(f'{sym} {" ".join(attrib)}'
+                     for sym, attrib in sym_table.items())
+
+
+def sym_table_from_text(text):
+    sym_table = {}
+    for line in text.split('\n'):
+        sym, *attrib = line.split(' ')
+        sym_table[sym] = attrib
+    return sym_table
+
+
+def signature_key(sym_table):
+    return cache.content_key(f'{CACHE_FORMAT}\n{sym_table_text(sym_table)}')
+
+
+class SignatureCache(cache.TieredCache):
+    def __init__(self, max_size=128, cache_dir=None):
+        disk = None
+        if cache_dir:
+            disk = cache.DiskCache(cache_dir, '.signature.pickle')
+        super().__init__(max_size, disk)
+
+    def encode(self, signature):
+        return (sym_table_text(signature.sym_table), signature.trie,
+                '\n'.join(signature.grammar()))
+
+    def decode(self, data):
+        return Signature(sym_table_from_text(data[0]), data[1],
+                         data[2].split('\n'))
+
+    def lookup(self, sym_table):
+        key = signature_key(sym_table)
+        signature = self.memory.get(key)
+        if signature is None and self.disk:
+            data = self.disk.get(key)
+            if data is not None:
+                # The caller's table is already parsed, only the tables are
+                # taken from disk.
+                signature = Signature(sym_table, data[1], data[2].split('\n'))
+                self.disk_hits += 1
+                self.memory.put(key, signature)
+        if signature is not None:
+            return key, signature, True
+        signature = Signature(sym_table)
+        self.put(key, signature)
+        return key, signature, False
+
+
+def normalize_formula(formula):
+    return ' '.join(formula.split())
+
+
+def raw_position(formula, position):
+    # Maps a position in normalize_formula(formula) back to formula. Error
+    # positions are always in a word or just after one.
+    normal = 0
+    for word in re.finditer(r'\S+', formula):
+        if position <= normal + len(word.group()):
+            return word.start() + position - normal
+        normal += len(word.group()) + 1
+    return position
+
+
+def normal_position(buffer, position):
+    # Maps a position in a mapped formula to normalize_formula of the text
+    # read_in_file reads, where a line break joins the words either side
+    # of it.
+    normal = 0
+    end = None
+    for word in NON_SPACE_RUN.finditer(buffer, 0, position):
+        if end is not None:
+            normal += not LINE_BREAK.search(buffer, end, word.start())
+        normal += word.end() - word.start()
+        end = word.end()
+    if end is not None and end < position:
+        normal += not LINE_BREAK.search(buffer, end, position)
+    return normal
+
+
+def move_error(err, move):
+    if err.position is None:
+        return err
+
+    def replace(match):
+        return f'{match[1]}{move(int(match[2]))}'
+
+    # "position 0 to N" in the trailing symbols message keeps its 0.
+    message = re.sub(r'(position (?:0 to )?)(\d+)', replace, err.message)
+    return CompilerError(message, move(err.position), err.line)
+
+
+def normal_error(formula, err):
+    # err with the positions read_in_file would give, when formula is a
+    # mapped buffer.
+    if isinstance(formula, str):
+        return err
+    return move_error(err, lambda position: normal_position(formula,
+                                                            position))
+
+
+# Rows kept in a result cache database unless told otherwise.
+RESULT_DISK_ENTRIES = 1 << 16
+
+
+class ResultCache(cache.TieredCache):
+    # Entries are ('valid', tokens, tree) or ('invalid', message, position);
+    # the tokens and tree are only kept when keep_trees is set. Recovering
+    # parses have keys of their own, with ('errors', [(message, position),
+    # ...]) entries for invalid formulas. Formulas are
+    # cached normalized, and error positions are mapped back to the formula
+    # as given. The database is unbounded when max_entries is 0 or None.
+    def __init__(self, max_size=4096, path=None,
+                 max_entries=RESULT_DISK_ENTRIES, keep_trees=True):
+        disk = cache.SqliteCache(path, max_entries) if path else None
+        super().__init__(max_size, disk)
+        self.keep_trees = keep_trees
+
+    def raw_error(self, err, formula):
+        return move_error(err, lambda position: raw_position(formula,
+                                                             position))
+
+    def key(self, sig_key, formula, dag=False, recover=False):
+        # Normalized formulas have no line breaks, so the DAG form of a
+        # result and the errors of a recovering parse get keys of their own.
+        if dag:
+            formula = f'dag\n{formula}'
+        if recover:
+            formula = f'recover\n{formula}'
+        return cache.content_key(f'{sig_key}\n{formula}')
+
+    def store(self, compiler, key, formula):
+        try:
+            result = compiler.parse_tokens(formula, compiler.lex(formula))
+        except CompilerError as err:
+            self.put(key, ('invalid', err.message, err.position))
+            raise
+        if self.keep_trees:
+            self.put(key, ('valid', result.tokens, result.tree))
+        else:
+            self.put(key, ('valid', None, None))
+        return result
+
+    def parse(self, compiler, formula):
+        text = normalize_formula(formula)
+        key = self.key(compiler.signature_key(), text, compiler.dag)
+        entry = self.get(key)
+        try:
+            if entry is None or (entry[0] == 'valid' and entry[1] is None):
+                return self.store(compiler, key, text)
+            if entry[0] == 'invalid':
+                raise CompilerError(entry[1], entry[2])
+        except CompilerError as err:
+            raise self.raw_error(err, formula) from None
+        return ParseResult(text, entry[1], entry[2])
+
+    def validate(self, compiler, formula):
+        text = normalize_formula(formula)
+        key = self.key(compiler.signature_key(), text, compiler.dag)
+        entry = self.get(key)
+        try:
+            if entry is None:
+                self.store(compiler, key, text)
+            elif entry[0] == 'invalid':
+                raise CompilerError(entry[1], entry[2])
+        except CompilerError as err:
+            return False, self.raw_error(err, formula)
+        return True, None
+
+    def diagnose(self, compiler, formula):
+        # Only the errors of invalid formulas are kept, so a hit on one
+        # returns no partial parse.
+        text = normalize_formula(formula)
+        key = self.key(compiler.signature_key(), text, compiler.dag, True)
+        entry = self.get(key)
+        if entry is None or (entry[0] == 'valid' and entry[1] is None):
+            result, errors = compiler.recover(text)
+            if errors:
+                self.put(key, ('errors', [(err.message, err.position)
+                                          for err in errors]))
+            elif self.keep_trees:
+                self.put(key, ('valid', result.tokens, result.tree))
+            else:
+                self.put(key, ('valid', None, None))
+        elif entry[0] == 'valid':
+            result, errors = ParseResult(text, entry[1], entry[2]), []
+        else:
+            result = ParseResult(text, None, None)
+            errors = [CompilerError(message, position)
+                      for message, position in entry[1]]
+        return result, [self.raw_error(err, formula) for err in errors]
 
 
-def print_terminals():
-    log_grammar('Terminal symbols:')
+def grammar_terminals(sig):
     syms = ''
-    if VARIABLES:
-        syms += f'{" ".join(VARIABLES)}'
+    if sig.variables:
+        syms += f'{" ".join(sig.variables)}'
         syms += ' '
-    if CONSTANTS:
-        syms += f'{" ".join(CONSTANTS)}'
+    if sig.constants:
+        syms += f'{" ".join(sig.constants)}'
         syms += ' '
-    if QUANTIFIERS:
-        syms += f'{" ".join(QUANTIFIERS)}'
+    if sig.quantifiers:
+        syms += f'{" ".join(sig.quantifiers)}'
         syms += ' '
-    if CONNECTIVES:
-        syms += f'{" ".join(CONNECTIVES)}'
+    if sig.connectives:
+        syms += f'{" ".join(sig.connectives)}'
         syms += ' '
-    if NEGATION:
-        syms += f'{NEGATION} '
-    if EQUALITY:
-        syms += f'{EQUALITY} '
-    if PREDICATES:
-        syms += f'{" ".join(PREDICATES)}'
+    if sig.negation:
+        syms += f'{sig.negation} '
+    if sig.equality:
+        syms += f'{sig.equality} '
+    if sig.predicates:
+        syms += f'{" ".join(sig.predicates)}'
         syms += ' '
     syms += '( ) ,'
-    log_grammar(syms)
+    return ['Terminal symbols:', syms]
 
 
-def print_non_terminals():
-    log_grammar('Non-terminal symbols:')
+def grammar_non_terminals(sig):
     syms = ''
     syms += "<Constant> <Variable> "
-    for pred in PREDICATES:
+    for pred in sig.predicates:
         syms += f"<{pred}_rule> "
     syms += ("<Predicate_rule> <Equality> <Quantifier > " +
              "<Connective> <Negation> <Atom> <Formula>")
-    log_grammar(syms)
+    return ['Non-terminal symbols:', syms]
 
 
-def print_constants():
+def grammar_constants(sig):
     msg_str = ''
     msg_str += '<Constant> -> '
-    if not CONSTANTS:
-        log_grammar(msg_str)
-        return
-    msg_str += f'{"|".join(CONSTANTS)}'
-    log_grammar(msg_str)
+    if not sig.constants:
+        return [msg_str]
+    msg_str += f'{"|".join(sig.constants)}'
+    return [msg_str]
 
 
-def print_variables():
+def grammar_variables(sig):
     msg_str = ''
     msg_str += '<Variable> -> '
-    if not CONSTANTS:
-        log_grammar(msg_str)
-        return
-    msg_str += f'{"|".join(VARIABLES)}'
-    log_grammar(msg_str)
+    if not sig.constants:
+        return [msg_str]
+    msg_str += f'{"|".join(sig.variables)}'
+    return [msg_str]
 
 
-def print_predicates(sym_table):
-    msg_str = ''
-    if not PREDICATES:
-        log_grammar('')
-        return
-    for pred in PREDICATES:
+def grammar_predicates(sig):
+    lines = []
+    if not sig.predicates:
+        return ['']
+    for pred in sig.predicates:
         msg_str = ''
         msg_str += f'<{pred}_rule> -> {pred}('
-        for _ in range(int(sym_table[pred][1])-1):
+        for _ in range(sig.arity(pred)-1):
             msg_str += '<Variable>,'
         msg_str += '<Variable>)'
-        log_grammar(msg_str)
+        lines.append(msg_str)
     msg_str = '<Predicate_rule> -> '
-    for i in range(len(PREDICATES)-1):
-        msg_str += f'<{PREDICATES[i]}_rule>|'
-    msg_str += f'<{PREDICATES[-1]}_rule>'
-    log_grammar(msg_str)
+    for i in range(len(sig.predicates)-1):
+        msg_str += f'<{sig.predicates[i]}_rule>|'
+    msg_str += f'<{sig.predicates[-1]}_rule>'
+    lines.append(msg_str)
+    return lines
 
 
-def print_quantifiers():
+def grammar_quantifiers(sig):
     msg_str = ''
     msg_str += '<Quantifier> -> '
-    msg_str += f'{"|".join(QUANTIFIERS)}'
-    log_grammar(msg_str)
+    msg_str += f'{"|".join(sig.quantifiers)}'
+    return [msg_str]
 
 
-def print_connectives():
+def grammar_connectives(sig):
     msg_str = ''
     msg_str += '<Connective> -> '
-    msg_str += f'{"|".join(CONNECTIVES)}'
-    log_grammar(msg_str)
-
-
-def print_formulae():
-    log_grammar('<Atom> -> <Predicate_rule>|(<Constant><Equality>' +
-                '<Constant>)|(<Constant><Equality><Variable>)|(' +
-                '<Variable><Equality><Constant>)|(<Variable>' +
-                '<Equality><Variable>)')
-    log_grammar('<Formula> -> <Atom>|(<Formula><Connective><Formula>)|' +
-                '<Negation><Formula>|<Quantifier><Formula>')
-
-
-def generate_grammar_lists(sym_table):
-    global CONSTANTS, VARIABLES, PREDICATES, EQUALITY, QUANTIFIERS, NEGATION
-    for sym, attrib in sym_table.items():
-        if attrib[0] == 'CONSTANT':
-            CONSTANTS.append(sym)
-        elif attrib[0] == 'VARIABLE':
-            VARIABLES.append(sym)
-        elif attrib[0] == 'PREDICATE':
-            PREDICATES.append(sym)
-        elif attrib[0] == 'EQUALITY':
-            EQUALITY = sym
-        elif attrib[0] == 'QUANTIFIER':
-            QUANTIFIERS.append(sym)
-        elif attrib[0] == 'CONNECTIVE':
-            if attrib[1] == 'NOT':
-                NEGATION = sym
-            else:
-                CONNECTIVES.append(sym)
-    time_str = time.strftime('%Y-%m-%d_%H-%M-%S')
-    log_msg(f'Opening grammar output file at {time_str}_' +
-            f'{GRAMMAR_FILE_NAME}.txt')
-    open_grammar(f'{time_str}_{GRAMMAR_FILE_NAME}.txt')
-    log_msg('Writing grammar to grammar output file')
-    log_grammar('Grammar for first order logic formula')
-    print_terminals()
-    print_non_terminals()
-    log_grammar('Production rules for the first order logic language.')
-    print_constants()
-    print_variables()
-    print_predicates(sym_table)
-    log_grammar('<Equality> -> ' + EQUALITY)
-    print_quantifiers()
-    print_connectives()
-    log_grammar('<Negation> -> ' + NEGATION)
-    print_formulae()
-    log_msg('Closing grammar output file')
-    close_grammar()
-
-
-def match_set(sym_set, index):
-    current_match = ''
-    for sym in sym_set:
-        if FORMULA[index:].find(sym) == 0:
-            if len(sym) > len(current_match):
-                current_match = sym
-    return current_match
-
-
-def lex_analysis():
-    global TOKENS
+    msg_str += f'{"|".join(sig.connectives)}'
+    return [msg_str]
+
+
+def grammar_formulae():
+    return ['<Atom> -> <Predicate_rule>|(<Constant><Equality>' +
+            '<Constant>)|(<Constant><Equality><Variable>)|(' +
+            '<Variable><Equality><Constant>)|(<Variable>' +
+            '<Equality><Variable>)',
+            '<Formula> -> <Atom>|(<Formula><Connective><Formula>)|' +
+            '<Negation><Formula>|<Quantifier><Formula>']
+
+
+def generate_grammar(sig):
+    lines = ['Grammar for first order logic formula']
+    lines += grammar_terminals(sig)
+    lines += grammar_non_terminals(sig)
+    lines.append('Production rules for the first order logic language.')
+    lines += grammar_constants(sig)
+    lines += grammar_variables(sig)
+    lines += grammar_predicates(sig)
+    lines.append('<Equality> -> ' + sig.equality)
+    lines += grammar_quantifiers(sig)
+    lines += grammar_connectives(sig)
+    lines.append('<Negation> -> ' + sig.negation)
+    lines += grammar_formulae()
+    return lines
+
+
+def build_trie(symbol_sets, symbol_ids):
+    # Leaves hold (kind, symbol id).
+    trie = {}
+    for sym_set, kind in symbol_sets:
+        for sym in sym_set:
+            if not sym:
+                continue
+            node = trie
+            for char in sym:
+                node = node.setdefault(char, {})
+            node[None] = (kind, symbol_ids[sym])
+    return trie
+
+
+def match_trie(trie, formula, index):
+    # Returns the length and leaf of the longest match and how many
+    # characters were walked through the trie.
+    length = 0
+    leaf = None
+    node = trie
+    i = index
+    while i < len(formula) and formula[i] in node:
+        node = node[formula[i]]
+        i += 1
+        if None in node:
+            length = i - index
+            leaf = node[None]
+    return length, leaf, i - index
+
+
+def byte_trie(trie):
+    # The same trie keyed by byte values, symbols being ASCII.
+    node = {}
+    for key, value in trie.items():
+        if key is None:
+            node[None] = value
+        else:
+            node[ord(key)] = byte_trie(value)
+    return node
+
+
+def lex_analysis(formula, trie, errors=None, counters=None):
+    tokens = token_stream.TokenStream(formula)
     i = 0
-    leading_space = 0
-    while i < len(FORMULA):
-        if FORMULA[i] == '(':
-            TOKENS.append(['(', '(', leading_space])
-            leading_space = 0
-            i += 1
-        elif FORMULA[i] == ')':
-            TOKENS.append([')', ')', leading_space])
-            leading_space = 0
+    steps = 0
+    while i < len(formula):
+        if formula[i].isspace():
             i += 1
-        elif FORMULA[i] == ',':
-            TOKENS.append([',', ',', leading_space])
-            leading_space = 0
+            continue
+        length, leaf, walked = match_trie(trie, formula, i)
+        steps += walked
+        if leaf is None:
+            if errors is None:
+                raise CompilerError('Formula contains invalid identifiers', i)
+            # Skip the rest of the word.
+            start = i
+            while (i < len(formula) and not formula[i].isspace() and
+                   formula[i] not in '(),'):
+                i += 1
+            errors.append(CompilerError(
+                f'Formula contains invalid identifier' +
+                f' {formula[start:i]} at formula position {start}', start))
+            continue
+        tokens.append(leaf[0], leaf[1], i, length)
+        i += length
+    if counters is not None:
+        counters['chars'] = counters.get('chars', 0) + len(formula)
+        counters['tokens'] = counters.get('tokens', 0) + len(tokens)
+        counters['trie_steps'] = counters.get('trie_steps', 0) + steps
+    return tokens
+
+
+WHITESPACE_BYTES = frozenset(b' \t\n\r\x0b\x0c')
+LINE_BREAK_BYTES = frozenset(b'\n\r')
+SEPARATOR_BYTES = frozenset(b'(),')
+
+
+def line_gap(buffer, index):
+    # The end of the whitespace at index if it holds a line break, which
+    # read_in_file drops along with the whitespace around it, else index.
+    i = index
+    broken = False
+    while i < len(buffer) and buffer[i] in WHITESPACE_BYTES:
+        broken = broken or buffer[i] in LINE_BREAK_BYTES
+        i += 1
+    return i if broken and i < len(buffer) else index
+
+
+def match_buffer(trie, buffer, index):
+    # match_trie over a buffer, carrying on across line gaps.
+    length = 0
+    leaf = None
+    node = trie
+    i = index
+    skipped = 0
+    while True:
+        while i < len(buffer) and buffer[i] in node:
+            node = node[buffer[i]]
             i += 1
-        elif FORMULA[i].isspace():
-            leading_space += 1
+            if None in node:
+                length = i - index
+                leaf = node[None]
+        if (len(node) == (None in node) or i == len(buffer) or
+                buffer[i] not in WHITESPACE_BYTES):
+            return length, leaf, i - index - skipped
+        gap = line_gap(buffer, i)
+        if gap == i:
+            return length, leaf, i - index - skipped
+        skipped += gap - i
+        i = gap
+
+
+def lex_buffer(buffer, trie, errors=None, counters=None):
+    # lex_analysis for a bytes-like buffer and a byte_trie. Offsets count
+    # bytes of the buffer, and a symbol split by a line break is one token.
+    tokens = token_stream.TokenStream(buffer)
+    i = 0
+    steps = 0
+    while i < len(buffer):
+        if buffer[i] in WHITESPACE_BYTES:
             i += 1
-        else:
-            candidates = []
-            candidates.append([match_set(CONNECTIVES, i), 'CONNECTIVE'])
-            candidates.append([match_set(VARIABLES, i), 'VARIABLE'])
-            candidates.append([match_set(CONSTANTS, i), 'CONSTANT'])
-            candidates.append([match_set(QUANTIFIERS, i), 'QUANTIFIER'])
-            candidates.append([match_set(PREDICATES, i), 'PREDICATE'])
-            candidates.append([match_set([EQUALITY], i), 'EQUALITY'])
-            candidates.append([match_set([NEGATION], i), 'NEGATION'])
-            candidates.sort(key=lambda item: len(item[0]), reverse=True)
-            if len(candidates[0][0]) == 0:
-                log_error('Formula contains invalid identifiers')
+            continue
+        length, leaf, walked = match_buffer(trie, buffer, i)
+        steps += walked
+        if leaf is None:
+            if errors is None:
+                raise CompilerError('Formula contains invalid identifiers', i)
+            start = i
+            while i < len(buffer) and buffer[i] not in SEPARATOR_BYTES:
+                if buffer[i] in WHITESPACE_BYTES:
+                    gap = line_gap(buffer, i)
+                    if gap == i:
+                        break
+                    i = gap
+                    continue
+                i += 1
+            word = ''.join(bytes(buffer[start:i]).decode(
+                errors='replace').split())
+            errors.append(CompilerError(
+                f'Formula contains invalid identifier {word} at formula' +
+                f' position {start}', start))
+            continue
+        tokens.append(leaf[0], leaf[1], i, length)
+        i += length
+    if counters is not None:
+        counters['chars'] = counters.get('chars', 0) + len(buffer)
+        counters['tokens'] = counters.get('tokens', 0) + len(tokens)
+        counters['trie_steps'] = counters.get('trie_steps', 0) + steps
+    return tokens
+
+
+def lex_formula(formula, signature, errors=None, counters=None):
+    if isinstance(formula, str):
+        return lex_analysis(formula, signature.trie, errors, counters)
+    return lex_buffer(formula, signature.byte_trie(), errors, counters)
+
+
+# Tree node kind of each nonterminal (None adds no node) and of each
+# token kind, the ones missing here only getting a SYMBOL node.
+NONTERMINAL_KINDS = {'Formula': parse_tree.FORMULA, 'Atom': parse_tree.ATOM,
+                     'Predicate': parse_tree.PREDICATE,
+                     'Predicate_rule': parse_tree.PREDICATE_RULE,
+                     'Term': None}
+TERMINAL_KINDS = {token_stream.VARIABLE: parse_tree.VARIABLE,
+                  token_stream.CONSTANT: parse_tree.CONSTANT,
+                  token_stream.QUANTIFIER: parse_tree.QUANTIFIER,
+                  token_stream.CONNECTIVE: parse_tree.CONNECTIVE,
+                  token_stream.NEGATION: parse_tree.NEGATION,
+                  token_stream.EQUALITY: parse_tree.EQUALITY}
+# What a nonterminal expects when the input runs out, and the message for a
+# token it has no production for.
+NONTERMINAL_ERRORS = {
+    'Formula': ('Formula', 'Illegal symbol {symbol} in Formula at formula' +
+                ' position {position} expected ( or Negation or Quantifier' +
+                ' or PREDICATE'),
+    'Atom': ('Atom', 'Illegal symbol {symbol} in Atom at formula position' +
+             ' {position} expected ( or Predicate'),
+    'Predicate': ('Predicate', 'Illegal symbol {symbol} in Predicate found' +
+                  ' at formula position {position} expected Predicate'),
+    'Term': ('Variable or Constant', 'Illegal symbol {symbol} in Atom at' +
+             ' formula position {position} expected Variable or Constant'),
+}
+NONTERMINAL_ERRORS['Predicate_rule'] = NONTERMINAL_ERRORS['Predicate']
+
+
+def build_ll1_grammar(sig):
+    # Terminals are token kinds, except that each predicate is a terminal of
+    # its own (token_stream.terminal) so its arity is spelt out in its
+    # ('Predicate_rule', name) production.
+    lparen, rparen, comma = (token_stream.LPAREN, token_stream.RPAREN,
+                             token_stream.COMMA)
+    variable = token_stream.VARIABLE
+    grammar = ll1.Grammar('Formula')
+    # Added before Formula -> Atom so it is chosen when the token after a (
+    # starts neither production.
+    grammar.add('Formula', lparen, 'Formula', token_stream.CONNECTIVE,
+                'Formula', rparen)
+    grammar.add('Formula', 'Atom')
+    grammar.add('Formula', token_stream.NEGATION, 'Formula')
+    grammar.add('Formula', token_stream.QUANTIFIER, variable, 'Formula')
+    grammar.add('Atom', lparen, 'Term', token_stream.EQUALITY, 'Term',
+                rparen)
+    if sig.predicates:
+        grammar.add('Atom', 'Predicate')
+    for pred in sig.predicates:
+        grammar.add('Predicate', ('Predicate_rule', pred))
+        body = [token_stream.terminal(token_stream.PREDICATE,
+                                      sig.symbol_ids[pred]), lparen]
+        body += [variable, comma] * (sig.arity(pred) - 1)
+        body += [variable, rparen]
+        grammar.add(('Predicate_rule', pred), *body)
+    grammar.add('Term', token_stream.CONSTANT)
+    grammar.add('Term', variable)
+    return grammar.build()
+
+
+class Parser:
+    # A predictive parser driven by the table of an ll1.Grammar. With
+    # recover set, a syntax error inside a Formula is recorded in errors and
+    # the parser skips ahead to a ) or connective that Formula may be
+    # followed by, then carries on. Symbols left after the first Formula are
+    # reported once and then parsed as further Formulas, so errors in them
+    # are found too. With dag set it builds a ParseDag.
+    def __init__(self, grammar, tokens, recover=False, dag=False):
+        self.grammar = grammar
+        self.table = grammar.table
+        self.tokens = tokens
+        self.terminals = tokens.terminals()
+        self.lookahead = 0
+        self.dag = dag
+        self.tree = parse_dag.ParseDag(tokens) if dag \
+            else parse_tree.ParseTree()
+        self.recover = recover
+        self.errors = []
+        self.failed_at = -1
+
+    def position(self):
+        if self.lookahead < len(self.tokens):
+            return self.tokens.offset[self.lookahead]
+        return self.tokens.end()
+
+    def error(self, err_str):
+        raise CompilerError(err_str, self.position())
+
+    def record(self, err):
+        # A second error at the token of the last one is a cascade of it, as
+        # when skipping stops at a ) or connective the enclosing Formula does
+        # not expect either.
+        if self.lookahead > self.failed_at:
+            self.errors.append(err)
+        self.failed_at = self.lookahead
+
+    def synchronize(self, err, start):
+        if not self.recover:
+            raise err
+        self.record(err)
+        kinds = self.tokens.kind
+        depth = 0
+        for kind in kinds[start:self.lookahead]:
+            if kind == token_stream.LPAREN:
+                depth += 1
+            elif kind == token_stream.RPAREN:
+                depth -= 1
+        while self.lookahead < len(kinds):
+            kind = kinds[self.lookahead]
+            if kind == token_stream.RPAREN:
+                if depth <= 0:
+                    break
+                depth -= 1
+                self.lookahead += 1
+                if depth == 0:
+                    break
+            elif kind == token_stream.CONNECTIVE and depth <= 0:
+                break
             else:
-                TOKENS.append(
-                    [candidates[0][1], candidates[0][0], leading_space])
-                leading_space = 0
-                i += len(candidates[0][0])
-
-
-def add_tree(graph, label, parent_id):
-    global NODE_ID
-    if (label in ('Quantifier', 'Connective', 'Variable',
-                  'Constant', 'Negation', 'Equality')):
-        graph.add_node(pydot.Node(NODE_ID, label=f'"<{label}>"'))
-        graph.add_edge(pydot.Edge(parent_id, NODE_ID))
-        NODE_ID += 1
-        graph.add_node(pydot.Node(
-            NODE_ID, label=f'"{escape_bslash(TOKENS[LOOKAHEAD_INDEX-1][1])}"'))
-        graph.add_edge(pydot.Edge(NODE_ID-1, NODE_ID))
-        TERM_NODES.append(NODE_ID)
-        NODE_ID += 1
-    elif label == 'Predicate':
-        graph.add_node(pydot.Node(NODE_ID, label=f'"<{label}>"'))
-        graph.add_edge(pydot.Edge(parent_id, NODE_ID))
-        NODE_ID += 1
-        graph.add_node(pydot.Node(
-            NODE_ID, label=f'"<{escape_bslash(TOKENS[LOOKAHEAD_INDEX-1][1])}' +
-            f'_rule>"'))
-        graph.add_edge(pydot.Edge(NODE_ID-1, NODE_ID))
-        NODE_ID += 1
-        graph.add_node(pydot.Node(
-            NODE_ID, label=f'"{escape_bslash(TOKENS[LOOKAHEAD_INDEX-1][1])}"'))
-        graph.add_edge(pydot.Edge(NODE_ID-1, NODE_ID))
-        TERM_NODES.append(NODE_ID)
-        NODE_ID += 1
-    elif label == 'Formula':
-        graph.add_node(pydot.Node(NODE_ID, label=f'"<{label}>"'))
-        if parent_id > -1:
-            graph.add_edge(pydot.Edge(parent_id, NODE_ID))
-        NODE_ID += 1
+                if kind == token_stream.LPAREN:
+                    depth += 1
+                self.lookahead += 1
+
+    def add_node(self, symbol, parent_id):
+        kind = NONTERMINAL_KINDS[symbol if isinstance(symbol, str)
+                                 else symbol[0]]
+        if kind is None:
+            return parent_id
+        return self.tree.add(kind, self.lookahead, parent_id)
+
+    def add_terminal(self, terminal, parent_id):
+        token = self.lookahead - 1
+        kind = TERMINAL_KINDS.get(terminal)
+        if kind is not None:
+            parent_id = self.tree.add(kind, token, parent_id)
+        self.tree.add(parse_tree.SYMBOL, token, parent_id)
+
+    def match(self, terminal, parent_id):
+        tokens = self.tokens
+        if (self.lookahead < len(tokens) and
+                terminal == self.terminals[self.lookahead]):
+            self.lookahead += 1
+            self.add_terminal(terminal, parent_id)
+            return
+        name = token_stream.KIND_NAMES[terminal] \
+            if terminal < token_stream.PREDICATE_TERMINALS else 'PREDICATE'
+        if self.lookahead == len(tokens):
+            self.error(f'Syntax Error. Expected {name} at formula ' +
+                       f'position {self.position()}. Instead found nothing.')
+        self.error(f'Syntax Error. Expected {name} at formula ' +
+                   f'position {self.position()} instead found' +
+                   f' {tokens.text(self.lookahead)}')
+
+    def predict(self, symbol):
+        row = self.table[symbol]
+        tokens = self.tokens
+        if self.lookahead == len(tokens):
+            body = row.get(ll1.END)
+        else:
+            body = row.get(self.terminals[self.lookahead])
+            if isinstance(body, dict):
+                second = ll1.END
+                if self.lookahead < len(tokens) - 1:
+                    second = self.terminals[self.lookahead + 1]
+                body = body.get(second, body[None])
+        if body is None:
+            name, illegal = NONTERMINAL_ERRORS[
+                symbol if isinstance(symbol, str) else symbol[0]]
+            if self.lookahead == len(tokens):
+                self.error(f'Syntax Error. Expected {name} at formula ' +
+                           f'position {self.position()}. Instead found ' +
+                           f'nothing.')
+            self.error('Syntax Error. ' + illegal.format(
+                symbol=tokens.text(self.lookahead), position=self.position()))
+        return body
+
+    def expand(self, symbol, parent_id):
+        if symbol not in self.table:
+            self.match(symbol, parent_id)
+            return
+        start = self.lookahead
+        node_id = self.add_node(symbol, parent_id)
+        try:
+            for child in self.predict(symbol):
+                self.expand(child, node_id)
+        except CompilerError as err:
+            if symbol != self.grammar.start:
+                raise
+            self.synchronize(err, start)
+
+    def formula(self, parent_id):
+        self.expand(self.grammar.start, parent_id)
+        return True
+
+    def formula_iterative(self, parent_id):
+        # When recovering, each Formula pushes an END entry, (None, start),
+        # under its children so an error can drop the rest of the Formula it
+        # happened in.
+        stack = [(self.grammar.start, parent_id)]
+        while stack:
+            symbol, parent_id = stack.pop()
+            try:
+                if symbol is None:
+                    continue
+                if symbol not in self.table:
+                    self.match(symbol, parent_id)
+                    continue
+                if self.recover and symbol == self.grammar.start:
+                    stack.append((None, self.lookahead))
+                node_id = self.add_node(symbol, parent_id)
+                for child in reversed(self.predict(symbol)):
+                    stack.append((child, node_id))
+            except CompilerError as err:
+                if not self.recover:
+                    raise
+                while stack[-1][0] is not None:
+                    stack.pop()
+                self.synchronize(err, stack.pop()[1])
+        return True
+
+    def check_trailing(self):
+        if self.lookahead != len(self.tokens):
+            position = self.position()
+            self.error(f'Syntax error. Formula is valid until position ' +
+                       f'{position}. Trailing symbols occur after ' +
+                       f'this. Consider adding brackets around formula ' +
+                       f'position 0 to {position} and re running' +
+                       f' compiler.')
+
+    def parse(self, iterative=False):
+        formula = self.formula_iterative if iterative else self.formula
+        formula(-1)
+        try:
+            self.check_trailing()
+        except CompilerError as err:
+            if not self.recover:
+                raise
+            self.record(err)
+            self.resume(formula)
+        return self.finish()
+
+    def resume(self, formula):
+        # Parses what is left as further Formulas, each a root of its own,
+        # skipping symbols none of them can start with.
+        starts = self.table[self.grammar.start]
+        while self.lookahead < len(self.tokens):
+            start = self.lookahead
+            if self.terminals[start] in starts:
+                formula(-1)
+            if self.lookahead == start:
+                self.lookahead += 1
+
+    def finish(self):
+        if self.dag:
+            self.tree.close()
+        return self.tree
+
+
+class ParseResult:
+    __slots__ = ('formula', 'tokens', 'tree')
+
+    def __init__(self, formula, tokens, tree):
+        self.formula = formula
+        self.tokens = tokens
+        self.tree = tree
+
+
+class Compiler:
+    def __init__(self, signature, iterative=False, results=None,
+                 use_pydot=False, render_options=None, profile=None,
+                 dag=False):
+        self.signature = signature
+        self.iterative = iterative
+        self.dag = dag
+        self.results = results
+        self.use_pydot = use_pydot
+        self.render_options = render_options
+        self.profile = profile
+        self.sig_key = None
+
+    def signature_key(self):
+        if self.sig_key is None:
+            self.sig_key = signature_key(self.signature.sym_table)
+        return self.sig_key
+
+    @classmethod
+    def from_file(cls, file_name, iterative=False):
+        sym_table, formula = read_in_file(file_name)
+        return cls(Signature(sym_table), iterative), formula
+
+    def lex(self, formula):
+        if self.profile is None:
+            return lex_formula(formula, self.signature)
+        with self.profile.phase('lex'):
+            return lex_formula(formula, self.signature,
+                               counters=self.profile.counters)
+
+    def parse_tokens(self, formula, tokens):
+        parser = Parser(self.signature.ll1_grammar(), tokens, dag=self.dag)
+        if self.profile is None:
+            return ParseResult(formula, tokens, parser.parse(self.iterative))
+        with self.profile.phase('parse'):
+            tree = parser.parse(self.iterative)
+        self.profile.count('tree_nodes', len(tree))
+        return ParseResult(formula, tokens, tree)
+
+    def parse(self, formula):
+        if self.results is not None:
+            return self.results.parse(self, formula)
+        return self.parse_tokens(formula, self.lex(formula))
+
+    def validate(self, formula):
+        if self.results is not None:
+            return self.results.validate(self, formula)
+        try:
+            self.parse(formula)
+        except CompilerError as err:
+            return False, err
+        return True, None
+
+    def diagnose(self, formula):
+        # Returns the (possibly partial) parse and every error found in it.
+        if self.results is not None:
+            return self.results.diagnose(self, formula)
+        return self.recover(formula)
+
+    def recover(self, formula):
+        errors = []
+        profile = self.profile or instrument.Profile()
+        with profile.phase('lex'):
+            tokens = lex_formula(formula, self.signature, errors,
+                                 profile.counters)
+        parser = Parser(self.signature.ll1_grammar(), tokens, recover=True,
+                        dag=self.dag)
+        with profile.phase('parse'):
+            tree = parser.parse(self.iterative)
+        profile.count('tree_nodes', len(tree))
+        # Lexical errors come first, as a parse without recovery stops at
+        # them before parsing, and the syntax errors follow in order.
+        errors.extend(parser.errors)
+        return ParseResult(formula, tokens, tree), errors
+
+    def validate_all(self, formulas):
+        for formula in formulas:
+            yield formula, *self.validate(formula)
+
+    def render(self, result, path, fmt='png', queue=None):
+        if queue is not None or self.profile is None:
+            return self.draw(result, path, fmt, queue)
+        with self.profile.phase('render'):
+            self.draw(result, path, fmt)
+        if os.path.exists(path):
+            self.profile.count('bytes_written', os.path.getsize(path))
+
+    def draw(self, result, path, fmt='png', queue=None):
+        options = self.render_options
+        if isinstance(result.tree, parse_dag.ParseDag):
+            if queue is not None:
+                return queue.submit(result.tree, result.tokens, path, fmt,
+                                    options, parse_dag.render)
+            parse_dag.render(result.tree, result.tokens, path, fmt, options)
+            return
+        try:
+            parse_tree.check_view(result.tree, options)
+        except ValueError as err:
+            raise CompilerError(f'Cannot draw the parse tree. {err}')
+        if self.use_pydot and fmt in ('svg', 'png'):
+            graph = parse_tree.to_pydot(result.tree, result.tokens, options)
+            graph.write(path, format=fmt, prog=options.prog if options
+                        else 'dot')
+        elif queue is not None:
+            return queue.submit(result.tree, result.tokens, path, fmt,
+                                options)
+        else:
+            parse_tree.render(result.tree, result.tokens, path, fmt, options)
+
+
+def load_signature(sym_table, options, log):
+    if not options.cache_dir:
+        return Signature(sym_table)
+    key, signature, hit = SignatureCache(
+        cache_dir=options.cache_dir[0]).lookup(sym_table)
+    if hit:
+        log.msg(f'Loaded grammar and lexer tables for signature {key}' +
+                f' from cache')
     else:
-        graph.add_node(pydot.Node(NODE_ID, label=f'"{escape_bslash(label)}"'))
-        graph.add_edge(pydot.Edge(parent_id, NODE_ID))
-        NODE_ID += 1
-
-
-def match(terminal):
-    global LOOKAHEAD_INDEX, FORM_INDEX
-    if LOOKAHEAD_INDEX == len(TOKENS):
-        log_error(f'Syntax Error. Expected {terminal} at formula position' +
-                  f' {FORM_INDEX}. Instead found nothing.')
-    if terminal == TOKENS[LOOKAHEAD_INDEX][0]:
-        FORM_INDEX += len(TOKENS[LOOKAHEAD_INDEX][1])
-        if LOOKAHEAD_INDEX < len(TOKENS) - 1:
-            FORM_INDEX += TOKENS[LOOKAHEAD_INDEX+1][2]
-        LOOKAHEAD_INDEX += 1
+        log.msg(f'Stored grammar and lexer tables for signature {key}' +
+                f' in cache')
+    return signature
+
+
+def render_options(options):
+    return parse_tree.RenderOptions(options.layout, options.dpi,
+                                    options.subtree, options.max_depth,
+                                    options.max_nodes, options.fold_repeats,
+                                    options.render_timeout)
+
+
+def write_grammar(signature, options, time_str, log, profile):
+    if options.no_files:
+        for line in signature.grammar():
+            log.grammar(line)
+        return
+    grammar_name = f'{time_str}_{options.grammar_file[0]}.txt'
+    log.msg(f'Opening grammar output file at {grammar_name}')
+    log.open_grammar(grammar_name)
+    log.msg('Writing grammar to grammar output file')
+    for line in signature.grammar():
+        log.grammar(line)
+        profile.count('bytes_written', len(line) + 1)
+    log.msg('Closing grammar output file')
+    log.close_grammar()
+
+
+def log_errors(errors, log):
+    for err in errors:
+        if err.line is not None:
+            log.error(f'Line {err.line}: {err.message}')
+        else:
+            log.error(err.message)
+
+
+def log_scopes(result, log, profile, prefix=''):
+    with profile.phase('scope'):
+        scopes = scope.analyze(result.tree, result.tokens)
+    for message in scopes.report(result.tree, result.tokens):
+        log.info(f'{prefix}{message}')
+
+
+def write_normal_form(result, signature, options, log, profile, path):
+    form = options.normal_form
+    forms = normal_form.convert(result.tree, result.tokens, signature, form,
+                                profile)
+    stats = forms.stats()
+    for name, value in stats.items():
+        profile.count(f'{form}_{name}', value)
+    log.msg(f'Normal form sizes: ' +
+            ', '.join(f'{name} {value}' for name, value in stats.items()))
+    log.msg(f'Saving {form} to file: {path}')
+    with open(path, 'w') as out_file:
+        for line in forms.lines(form):
+            out_file.write(f'{line}\n')
+
+
+def load_model(signature, options, log):
+    path = options.model[0]
+    log.msg(f'Loading model {path}')
+    try:
+        structure = model.Structure.load(signature, path)
+    except model.ModelError as err:
+        raise CompilerError(str(err))
+    except ImportError:
+        raise CompilerError('Evaluating formulas in a model needs numpy')
+    log.msg(f'Model has a domain of {structure.size} elements')
+    return structure
+
+
+def log_model(result, structure, options, log, profile, prefix=''):
+    budget = options.memory_budget * (1 << 20) or None
+    try:
+        with profile.phase('model'):
+            valuation = model.evaluate(result.tree, result.tokens, structure,
+                                       budget)
+    except model.ModelError as err:
+        raise CompilerError(str(err))
+    if valuation.variables:
+        log.info(f'{prefix}Formula holds for {valuation.count()} of' +
+                 f' {structure.size ** len(valuation.variables)}' +
+                 f' assignments to its free variables' +
+                 f' {" ".join(valuation.variables)}')
+    elif valuation.holds():
+        log.info(f'{prefix}Formula is true in the model')
     else:
-        log_error(f'Syntax Error. Expected {terminal} at formula position ' +
-                  f'{FORM_INDEX} instead found' +
-                  f' {TOKENS[LOOKAHEAD_INDEX][1]}')
-
-
-def predicate_rule(sym_table, graph, parent_id):
-    global NODE_ID
-    if LOOKAHEAD_INDEX == len(TOKENS):
-        log_error(f'Syntax Error. Expected Predicate at formula position ' +
-                  f'{FORM_INDEX}. Instead found nothing.')
-    if TOKENS[LOOKAHEAD_INDEX][0] == 'PREDICATE':
-        count = int(sym_table[TOKENS[LOOKAHEAD_INDEX][1]][1])
-        match('PREDICATE')
-        add_tree(graph, 'Predicate', parent_id)
-        TERM_NODES.append(NODE_ID-1)
-        start_id = NODE_ID - 2
-        match('(')
-        add_tree(graph, '(', start_id)
-        TERM_NODES.append(NODE_ID-1)
-        for _ in range(count-1):
-            match('VARIABLE')
-            add_tree(graph, 'Variable', start_id)
-            TERM_NODES.append(NODE_ID-1)
-            match(',')
-            add_tree(graph, ',', start_id)
-            TERM_NODES.append(NODE_ID-1)
-        match('VARIABLE')
-        add_tree(graph, 'Variable', start_id)
-        TERM_NODES.append(NODE_ID-1)
-        match(')')
-        add_tree(graph, ')', start_id)
-        TERM_NODES.append(NODE_ID-1)
+        log.info(f'{prefix}Formula is false in the model')
+
+
+def run(options, time_str, log, profile):
+    in_file = options.input_file[0]
+    log.msg(f'Starting read in file {in_file}')
+    errors = [] if options.keep_going else None
+    with profile.phase('read'):
+        if options.mmap:
+            sym_table, formula = map_input(in_file, log, errors)
+        else:
+            sym_table, formula = read_in_file(in_file, log, errors)
+    if errors:
+        log_errors(errors, log)
+        log.msg(f'Finished Reading in file. Input file has {len(errors)}' +
+                f' errors')
     else:
-        log_error(f'Syntax Error. Illegal symbol {TOKENS[LOOKAHEAD_INDEX][1]}' +
-                  f' in Predicate found at formula position {FORM_INDEX}' +
-                  f' expected Predicate')
-
-
-def const_var(graph, parent_id):
-    global NODE_ID
-    if LOOKAHEAD_INDEX == len(TOKENS):
-        log_error(f'Syntax Error. Expected Variable or Constant at ' +
-                  f'formula position {FORM_INDEX}. Instead found nothing.')
-    if TOKENS[LOOKAHEAD_INDEX][0] == 'CONSTANT':
-        match('CONSTANT')
-        add_tree(graph, 'Constant', parent_id)
-        TERM_NODES.append(NODE_ID-1)
-    elif TOKENS[LOOKAHEAD_INDEX][0] == 'VARIABLE':
-        match('VARIABLE')
-        add_tree(graph, 'Variable', parent_id)
-        TERM_NODES.append(NODE_ID-1)
+        log.msg(f'Finished Reading in file. Input file was valid')
+    if isinstance(formula, str):
+        log.msg(f'Formula used for error messages: {formula}')
     else:
-        log_error(f'Syntax Error. Illegal symbol {TOKENS[LOOKAHEAD_INDEX][1]}' +
-                  f' in Atom at formula position {FORM_INDEX} expected ' +
-                  f'Variable or Constant')
-
-
-def atom(sym_table, graph, parent_id):
-    global NODE_ID, TERM_NODES
-    add_tree(graph, '<Atom>', parent_id)
-    start_id = NODE_ID - 1
-    if LOOKAHEAD_INDEX == len(TOKENS):
-        log_error(f'Syntax Error. Expected Atom at formula position {FORM_INDEX}.' +
-                  f' Instead found nothing.')
-    if TOKENS[LOOKAHEAD_INDEX][0] == '(':
-        match('(')
-        add_tree(graph, '(', start_id)
-        TERM_NODES.append(NODE_ID-1)
-        const_var(graph, start_id)
-        match('EQUALITY')
-        add_tree(graph, 'Equality', start_id)
-        TERM_NODES.append(NODE_ID-1)
-        const_var(graph, start_id)
-        match(')')
-        add_tree(graph, ')', start_id)
-        TERM_NODES.append(NODE_ID-1)
-    elif TOKENS[LOOKAHEAD_INDEX][0] == 'PREDICATE':
-        predicate_rule(sym_table, graph, start_id)
+        log.msg(f'Formula of {len(formula)} bytes is lexed straight from' +
+                f' the mapped input file')
+    log.msg(f'Starting grammar generation')
+    with profile.phase('grammar'):
+        signature = load_signature(sym_table, options, log)
+        write_grammar(signature, options, time_str, log, profile)
+        signature.ll1_grammar()
+    log.msg(f'Finished grammar generation')
+    structure = None
+    if options.model:
+        structure = load_model(signature, options, log)
+    compiler = Compiler(signature, options.iterative,
+                        use_pydot=options.use_pydot,
+                        render_options=render_options(options),
+                        profile=profile, dag=options.dag)
+    if options.keep_going:
+        log.msg(f'Starting Lexical Analysis and parsing, recovering from' +
+                f' errors')
+        result, parse_errors = compiler.diagnose(formula)
+        parse_errors = [normal_error(formula, err) for err in parse_errors]
+        log_errors(parse_errors, log)
+        errors.extend(parse_errors)
+        if errors:
+            raise CompilerError(f'Found {len(errors)} errors in input file')
     else:
-        log_error(f'Syntax Error. Illegal symbol {TOKENS[LOOKAHEAD_INDEX][1]}' +
-                  f' in Atom at formula position {FORM_INDEX} expected ' +
-                  f'( or Predicate')
-
-
-def formula(sym_table, graph, parent_id):
-    global NODE_ID
-    add_tree(graph, 'Formula', parent_id)
-    start_id = NODE_ID - 1
-    if LOOKAHEAD_INDEX == len(TOKENS):
-        log_error(f'Syntax Error. Expected Formula at formula position ' +
-                  f'{FORM_INDEX}. Instead found nothing.')
-    if TOKENS[LOOKAHEAD_INDEX][0] == '(':
-        if (LOOKAHEAD_INDEX < len(TOKENS)-1 and
-                (TOKENS[LOOKAHEAD_INDEX+1][0] in ('VARIABLE', 'CONSTANT'))):
-            atom(sym_table, graph, start_id)
+        try:
+            log.msg(f'Starting Lexical Analysis')
+            tokens = compiler.lex(formula)
+            log.msg(f'Finished Lexical Analysis')
+            log.msg(f'Starting parsing')
+            parser = Parser(signature.ll1_grammar(), tokens, dag=options.dag)
+            with profile.phase('parse'):
+                if options.iterative:
+                    parser.formula_iterative(-1)
+                else:
+                    parser.formula(-1)
+                log.msg(f'Finished parsing')
+                parser.check_trailing()
+                tree = parser.finish()
+        except CompilerError as err:
+            raise normal_error(formula, err)
+        profile.count('tree_nodes', len(tree))
+        result = ParseResult(formula, tokens, tree)
+    log.info(f'Formula is valid')
+    if options.dag:
+        stats = result.tree.stats()
+        log.msg(f'Parse DAG has {stats["dag_nodes"]} distinct nodes for' +
+                f' {stats["tree_nodes"]} tree nodes')
+    if options.scope:
+        log_scopes(result, log, profile)
+    if options.normal_form:
+        write_normal_form(result, signature, options, log, profile,
+                          f'{time_str}_{options.normal_form}.txt')
+    if structure:
+        log_model(result, structure, options, log, profile)
+    if options.format != 'none':
+        tree_name = f'{time_str}_{options.tree_file[0]}.{options.format}'
+        log.msg(f'Saving parse tree to file: {tree_name}')
+        compiler.render(result, tree_name, options.format)
+
+
+def run_multi(options, time_str, log, profile):
+    in_file_name = options.input_file[0]
+    log.msg(f'Starting read in file {in_file_name}')
+    try:
+        in_file = open(in_file_name)
+    except IOError:
+        raise CompilerError('Could not open input file.')
+    with in_file:
+        errors = [] if options.keep_going else None
+        with profile.phase('read'):
+            sym_table, formulas = stream_input(in_file, log, errors)
+        if errors:
+            log_errors(errors, log)
+            del errors[:]
+        log.msg(f'Finished reading signature')
+        log.msg(f'Starting grammar generation')
+        with profile.phase('grammar'):
+            signature = load_signature(sym_table, options, log)
+            write_grammar(signature, options, time_str, log, profile)
+        log.msg(f'Finished grammar generation')
+        structure = None
+        if options.model:
+            structure = load_model(signature, options, log)
+        results = None
+        if options.result_cache:
+            results = ResultCache(path=options.result_cache[0],
+                                  max_entries=options.result_cache_entries)
+        compiler = Compiler(signature, options.iterative, results,
+                            options.use_pydot, render_options(options),
+                            profile, options.dag)
+        queue = None
+        if options.render_jobs and options.format != 'none':
+            queue = parse_tree.RenderQueue(options.render_jobs)
+        count = 0
+        valid = 0
+        for line_no, formula in formulas:
+            count += 1
+            if errors:
+                log_errors(errors, log)
+                del errors[:]
+            if options.keep_going:
+                result, parse_errors = compiler.diagnose(formula)
+                for err in parse_errors:
+                    log.error(f'Formula {count} on line {line_no} is' +
+                              f' invalid. {err.message}')
+                if parse_errors:
+                    continue
+            else:
+                try:
+                    result = compiler.parse(formula)
+                except CompilerError as err:
+                    log.error(f'Formula {count} on line {line_no} is' +
+                              f' invalid. {err.message}')
+                    continue
+            valid += 1
+            log.info(f'Formula {count} on line {line_no} is valid')
+            if options.scope:
+                log_scopes(result, log, profile,
+                           f'Formula {count} on line {line_no}: ')
+            if options.normal_form:
+                write_normal_form(
+                    result, signature, options, log, profile,
+                    f'{time_str}_{options.normal_form}_{count}.txt')
+            if structure:
+                log_model(result, structure, options, log, profile,
+                          f'Formula {count} on line {line_no}: ')
+            if options.format == 'none':
+                continue
+            tree_name = (f'{time_str}_{options.tree_file[0]}_{count}.' +
+                         options.format)
+            log.msg(f'Saving parse tree to file: {tree_name}')
+            try:
+                compiler.render(result, tree_name, options.format, queue)
+            except CompilerError as err:
+                log.error(f'Could not render {tree_name}. {err.message}')
+    if errors:
+        log_errors(errors, log)
+    profile.count('formulas', count)
+    profile.count('valid_formulas', valid)
+    log.info(f'{valid} of {count} formulas are valid')
+    if queue:
+        log.msg(f'Waiting for {queue.stats()["pending"]} parse trees to' +
+                f' finish rendering')
+        for tree_name, message in queue.wait():
+            log.error(f'Could not render {tree_name}. {message}')
+    if results:
+        stats = results.stats()
+        log.msg(f'Result cache: {stats["memory_hits"]} memory hits,' +
+                f' {stats["disk_hits"]} disk hits, {stats["misses"]} misses')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--log', nargs=1, metavar='FILE_NAME',
+                        dest='log_file', default=['log'],
+                        help='Filename to write log to')
+    parser.add_argument('-t', '--tree', nargs=1, metavar='FILE_NAME',
+                        dest='tree_file', default=['parse_tree'],
+                        help='Filename to write parse tree to')
+    parser.add_argument('-p', '--parse', nargs=1, metavar='FILE_NAME',
+                        dest='grammar_file', default=['grammar'],
+                        help='Filename to write grammar to')
+    parser.add_argument('-i', '--iterative', action='store_true',
+                        dest='iterative',
+                        help='Parse with an explicit stack instead of ' +
+                        'recursion, for very deeply nested formulas')
+    parser.add_argument('-c', '--cache-dir', nargs=1, metavar='DIR',
+                        dest='cache_dir',
+                        help='Directory to cache grammar and lexer tables in')
+    parser.add_argument('-f', '--format', choices=parse_tree.OUTPUT_FORMATS,
+                        default='png', dest='format',
+                        help='Format to write parse trees in, none skips them')
+    parser.add_argument('-j', '--render-jobs', type=int, default=0,
+                        dest='render_jobs', metavar='N',
+                        help='With --multi, render parse trees on N ' +
+                        'background workers while parsing continues')
+    parser.add_argument('--layout', choices=parse_tree.LAYOUT_ENGINES,
+                        default='dot', dest='layout',
+                        help='Graphviz layout engine, sfdp copes best with ' +
+                        'very large trees')
+    parser.add_argument('--dpi', type=int, default=300, dest='dpi',
+                        help='Resolution of PNG parse trees')
+    parser.add_argument('--subtree', type=int, default=0, dest='subtree',
+                        metavar='NODE',
+                        help='Only draw the subtree under node NODE, as ' +
+                        'numbered in DOT and JSON output')
+    parser.add_argument('--max-depth', type=int, dest='max_depth',
+                        metavar='N',
+                        help='Fold everything deeper than N levels into ' +
+                        'summary nodes')
+    parser.add_argument('--max-nodes', type=int, default=20000,
+                        dest='max_nodes', metavar='N',
+                        help='Lower the depth cap until at most N nodes are ' +
+                        'drawn, 0 for no limit')
+    parser.add_argument('--fold-repeats', type=int, default=0,
+                        dest='fold_repeats', metavar='N',
+                        help='Fold repeated subtrees of at least N nodes ' +
+                        'into a reference to their first occurrence')
+    parser.add_argument('--render-timeout', type=float, default=300,
+                        dest='render_timeout', metavar='SECONDS',
+                        help='Give up on graphviz after this long, 0 to' +
+                        ' wait forever')
+    parser.add_argument('--dag', action='store_true', dest='dag',
+                        help='Share identical subtrees and write the parse ' +
+                        'tree as a DAG. --subtree, --max-depth, ' +
+                        '--max-nodes, --fold-repeats and --pydot only ' +
+                        'apply to trees')
+    parser.add_argument('-s', '--scope', action='store_true', dest='scope',
+                        help='Report free variables and vacuous or shadowed' +
+                        ' quantifiers of valid formulas')
+    parser.add_argument('--normal-form', choices=normal_form.FORMS,
+                        dest='normal_form',
+                        help='Write each valid formula in negation normal ' +
+                        'form, prenex form or definitional clausal form')
+    parser.add_argument('--model', nargs=1, metavar='FILE_NAME',
+                        dest='model',
+                        help='Evaluate each valid formula in the finite ' +
+                        'structure described by a JSON file, needs numpy')
+    parser.add_argument('--memory-budget', type=int, default=256,
+                        dest='memory_budget', metavar='MB',
+                        help='Evaluate quantifiers over chunks of the ' +
+                        'domain to keep arrays under MB megabytes, 0 for ' +
+                        'no limit')
+    parser.add_argument('--pydot', action='store_true', dest='use_pydot',
+                        help='Build the parse tree image through pydot ' +
+                        'instead of streaming DOT text to graphviz')
+    parser.add_argument('-r', '--result-cache', nargs=1, metavar='FILE_NAME',
+                        dest='result_cache',
+                        help='Database file to remember formula verdicts and' +
+                        ' parse trees in, with --multi')
+    parser.add_argument('--result-cache-entries', type=int,
+                        default=RESULT_DISK_ENTRIES,
+                        dest='result_cache_entries', metavar='N',
+                        help='Evict the least recently used results once ' +
+                        'the result cache database holds N, 0 for no limit')
+    parser.add_argument('-k', '--keep-going', action='store_true',
+                        dest='keep_going',
+                        help='Recover from errors and report every error in ' +
+                        'the input instead of stopping at the first')
+    parser.add_argument('-m', '--multi', action='store_true', dest='multi',
+                        help='Check every formula field of the input file ' +
+                        'against the signature given before the first one')
+    parser.add_argument('--mmap', action='store_true', dest='mmap',
+                        help='Memory-map the input file and lex the formula' +
+                        ' straight from it, without --multi')
+    parser.add_argument('input_file', nargs=1,
+                        metavar='FILE', help='File to parse')
+    parser.add_argument('--profile', action='store_true', dest='profile',
+                        help='Write per phase timings and counters as JSON' +
+                        ' to a timestamped file')
+    parser.add_argument('--profile-file', nargs=1, metavar='FILE_NAME',
+                        dest='profile_file', default=['profile'],
+                        help='Filename to write the profile to')
+    parser.add_argument('-q', '--quiet', action='store_true', dest='quiet',
+                        help='Do not echo log messages to the terminal')
+    parser.add_argument('--log-level', choices=list(LOG_LEVELS),
+                        default='debug', dest='log_level',
+                        help='Least severe messages to log, debug keeps ' +
+                        'every step')
+    parser.add_argument('-n', '--no-files', action='store_true',
+                        dest='no_files',
+                        help='Do not write the timestamped log and grammar ' +
+                        'files')
+    options = parser.parse_args()
+    if options.dag and (options.scope or options.normal_form or
+                        options.model):
+        parser.error('--scope, --normal-form and --model need parse trees' +
+                     ' and cannot be used with --dag')
+    if options.mmap and options.multi:
+        parser.error('--mmap reads a single formula and cannot be used with' +
+                     ' --multi')
+    for name in ('render_jobs', 'subtree', 'max_depth', 'max_nodes',
+                 'fold_repeats', 'render_timeout', 'memory_budget',
+                 'result_cache_entries'):
+        value = getattr(options, name)
+        if value is not None and value < 0:
+            parser.error(f'--{name.replace("_", "-")} must not be negative')
+    if options.dpi <= 0:
+        parser.error('--dpi must be positive')
+    time_str = time.strftime('%Y-%m-%d_%H-%M-%S')
+    log = Log(echo=not options.quiet, level=LOG_LEVELS[options.log_level])
+    profile = instrument.Profile()
+    outcome = {'input_file': options.input_file[0], 'ok': False,
+               'error': None}
+    try:
+        if not options.no_files:
+            log_name = f'{time_str}_{options.log_file[0]}.txt'
+            log.open_logger(log_name)
+            log.msg(f'Created logfile called {log_name}')
+        if options.multi:
+            run_multi(options, time_str, log, profile)
         else:
-            match('(')
-            add_tree(graph, '(', start_id)
-            TERM_NODES.append(NODE_ID-1)
-            formula(sym_table, graph, start_id)
-            match('CONNECTIVE')
-            add_tree(graph, 'Connective', start_id)
-            TERM_NODES.append(NODE_ID-1)
-            formula(sym_table, graph, start_id)
-            match(')')
-            add_tree(graph, ')', start_id)
-            TERM_NODES.append(NODE_ID-1)
-    elif TOKENS[LOOKAHEAD_INDEX][0] == 'NEGATION':
-        match('NEGATION')
-        add_tree(graph, 'Negation', start_id)
-        TERM_NODES.append(NODE_ID-1)
-        formula(sym_table, graph, start_id)
-    elif TOKENS[LOOKAHEAD_INDEX][0] == 'QUANTIFIER':
-        match('QUANTIFIER')
-        add_tree(graph, 'Quantifier', start_id)
-        TERM_NODES.append(NODE_ID-1)
-        match('VARIABLE')
-        add_tree(graph, 'Variable', start_id)
-        TERM_NODES.append(NODE_ID-1)
-        formula(sym_table, graph, start_id)
-    elif TOKENS[LOOKAHEAD_INDEX][0] == 'PREDICATE':
-        atom(sym_table, graph, start_id)
-    else:
-        log_error(f'Syntax Error. Illegal symbol {TOKENS[LOOKAHEAD_INDEX][1]}' +
-                  f' in Formula at formula position {FORM_INDEX} expected ' +
-                  f'( or Negation or Quantifier or PREDICATE')
-    return True
-
-
-LOG_FILE_NAME = 'log'
-GRAMMAR_FILE_NAME = 'grammar'
-PARSE_TREE_NAME = 'parse_tree'
-
-PARSER = argparse.ArgumentParser()
-PARSER.add_argument('-l', '--log', nargs=1, metavar='FILE_NAME',
-                    dest='log_file', help='Filename to write log to')
-PARSER.add_argument('-t', '--tree', nargs=1, metavar='FILE_NAME',
-                    dest='tree_file', help='Filename to write parse tree to')
-PARSER.add_argument('-p', '--parse', nargs=1, metavar='FILE_NAME',
-                    dest='grammar_file', help='Filename to write grammar to')
-PARSER.add_argument('input_file', nargs=1,
-                    metavar='FILE', help='File to parse')
-OPTIONS = PARSER.parse_args()
-if OPTIONS.log_file:
-    LOG_FILE_NAME = OPTIONS.log_file[0]
-if OPTIONS.tree_file:
-    PARSE_TREE_NAME = OPTIONS.tree_file[0]
-if OPTIONS.grammar_file:
-    GRAMMAR_FILE_NAME = OPTIONS.grammar_file[0]
-SYM_TABLE = {'(': ['SEPARATOR', 'OB'], ')': [
-    'SEPARATOR', 'CB'], ',': ['SEPARATOR', 'C']}
-SYM_TABLE.update({'[': ['FORBIDDEN'], ']': ['FORBIDDEN']})
-INFILE = OPTIONS.input_file[0]
-TIME_STR = time.strftime('%Y-%m-%d_%H-%M-%S')
-open_logger(f'{TIME_STR}_{LOG_FILE_NAME}.txt')
-log_msg(f'Created logfile called {TIME_STR}_{LOG_FILE_NAME}.txt')
-log_msg(f'Starting read in file {INFILE}')
-read_in_file(INFILE, SYM_TABLE)
-log_msg(f'Finished Reading in file. Input file was valid')
-log_msg(f'Formula used for error messages: {FORMULA}')
-log_msg(f'Starting grammar generation')
-generate_grammar_lists(SYM_TABLE)
-log_msg(f'Finished grammar generation')
-log_msg(f'Starting Lexical Analysis')
-lex_analysis()
-log_msg(f'Finished Lexical Analysis')
-PGRAPH = pydot.Dot(graph_type='graph', dpi='300', rankdir='TB')
-log_msg(f'Starting parsing')
-formula(SYM_TABLE, PGRAPH, -1)
-log_msg(f'Finished parsing')
-if LOOKAHEAD_INDEX != len(TOKENS):
-    log_error(f'Syntax error. Formula is valid until position {FORM_INDEX}.' +
-              f' Trailing symbols occur after this. Consider adding brackets' +
-              f' around formula position 0 to {FORM_INDEX} and re running' +
-              f' compiler.')
-log_msg(f'Formula is valid')
-subgraph = pydot.Subgraph(rank='max')
-for node in TERM_NODES:
-    subgraph.add_node(pydot.Node(node))
-PGRAPH.add_subgraph(subgraph)
-log_msg(f'Saving parse tree to file: {TIME_STR}_{PARSE_TREE_NAME}.png')
-PGRAPH.write_png(f'{TIME_STR}_{PARSE_TREE_NAME}.png')
+            run(options, time_str, log, profile)
+        outcome['ok'] = True
+    except LogFileError as err:
+        sys.exit(err.message)
+    except CompilerError as err:
+        outcome['error'] = err.message
+        log.error(err.message)
+        sys.exit()
+    finally:
+        if options.profile:
+            profile_name = f'{time_str}_{options.profile_file[0]}.json'
+            instrument.write_record(profile.finish(**outcome), profile_name)
+            log.msg(f'Wrote profile to {profile_name}')
+        log.close_grammar()
+        log.close_logger()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,892 @@
+"""
+    In-process version of the seven stages of test.py. Every case is built in
+    memory, checked against an expected outcome of valid, signature (the input
+    file is rejected) or syntax (the formula is rejected), and the cases are
+    spread over a process pool.
+
+    Stages 4 and 5 never delete or insert NEG, since either can leave a valid
+    formula behind, so their expected outcome is always syntax.
+
+    Later stages are regression checks of what is built on the parser, and
+    their cases pass when it agrees with a simpler way of getting the same
+    answer. Stage 8 makes random edits and compares incremental reparsing
+    with parsing the edited formula from scratch. Stage 9 expands parse DAGs
+    and compares them with the parse trees of the same formulas. Stage 10
+    resolves every variable by searching its ancestors and compares that with
+    the free, vacuous and shadowed variables scope analysis reports. Stage 11
+    evaluates formulas and their negation normal and prenex forms in small
+    random models, under every assignment to their free variables, and
+    checks that the clauses agree with the prenex matrix once each
+    definition atom has the value of the subformula it names. Stage 12
+    does the same for the finite-model evaluator, with relations stored
+    densely and sparsely and with quantifiers split into chunks, and only
+    runs when numpy is installed. Stage 13 checks that parsing through a
+    result cache, in memory and on disk, reports the same verdicts and
+    errors as parsing without one, also when a hit comes from the same
+    formula with different whitespace. Stage 14 checks that recovering from
+    errors reports the error a parse without recovery stops at first, the
+    same errors in the recursive and iterative parsers, and one error in
+    every atom a mistake was put in. Stage 15 spreads formulas over several
+    lines, also inside symbols, and checks that lexing them straight from
+    the memory-mapped file gives the tokens and errors reading the file as
+    text does. Stage 16 times incremental edits of a formula of over a
+    hundred thousand tokens against parsing it again, and only runs when
+    numpy is installed.
+"""
+
+import argparse
+import importlib.util
+import itertools
+import os
+import random
+import re
+import string
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import compiler
+import incremental
+import model
+import normal_form
+import parse_dag
+import parse_tree
+import scope
+
+BASE_VAR = ['VAR1', 'VAR2', 'VAR3', 'VAR4', 'VAR5']
+BASE_CONST = ['CONST1', 'CONST2', 'CONST3', 'CONST4', 'CONST5']
+BASE_PRED = ['PRED1', 'PRED2', 'PRED3', 'PRED4']
+BASE_EQ = ['EQ']
+BASE_CONN = ['AND', 'OR', 'IMPLIES', 'IFF', 'NEG']
+BASE_QUAN = ['EXISTS', 'FORALL']
+
+BASE_FORMULA = [
+    '( ( VAR1 EQ VAR2 ) AND NEG FORALL VAR3 PRED2 ( VAR1 , VAR2 ) )'.split(),
+    ('( ( ( ( PRED1 ( VAR1 ) AND PRED1 ( VAR2 ) ) OR PRED2 ( VAR1 , VAR2 ) )' +
+     ' IMPLIES PRED3 ( VAR1 , VAR2 , VAR3 ) ) IFF' +
+     ' PRED4 ( VAR1 , VAR2 , VAR3 , VAR4 ) )').split(),
+    ('EXISTS VAR1 FORALL VAR2 EXISTS VAR3 FORALL VAR4 EXISTS VAR5' +
+     ' ( PRED4 ( VAR1 , VAR2 , VAR3 , VAR4 ) IMPLIES ( CONST1 EQ CONST2 ) )'
+     ).split(),
+    ('( ( ( CONST1 EQ CONST2 ) AND ( CONST1 EQ VAR1 ) ) IFF' +
+     ' ( ( VAR1 EQ CONST1 ) AND ( VAR1 EQ VAR2 ) ) )').split(),
+]
+
+TARGETED_FORMULAS = [
+    ('VAR1 EQ VAR2', 'Must be surrounded by brackets'),
+    ('NEG ( PRED1 ( VAR1 ) )', 'Unnecessary brackets'),
+    ('( PRED1 ( VAR1 ) )', 'Unnecessary brackets'),
+    ('PRED1 ( VAR1 ) AND PRED1 ( VAR2 )', 'Must be surrounded by brackets'),
+    ('( PRED1 ( VAR1 ) AND PRED1 ( VAR2 ) AND PRED1 ( VAR3 ) )',
+     'Missing brackets'),
+    ('FORALL VAR3 ( PRED2 ( VAR1 , VAR3 ) )', 'Unnecessary brackets'),
+    ('PRED2 ( CONST1 , CONST2 )', 'Constants cannot be arguments'),
+    ('( VAR1 EQ VAR2 EQ VAR3 )', 'Missing brackets'),
+    ('( ( ( ( ( ( ( ( ( ( CONST1 EQ CONST2 ) ) ) ) ) ) ) ) ) )',
+     'Unnecessary brackets'),
+]
+
+SCOPE_FORMULAS = [
+    ('FORALL VAR1 ( EXISTS VAR1 PRED1 ( VAR1 ) AND' +
+     ' PRED2 ( VAR2 , VAR3 ) )').split(),
+    ('EXISTS VAR2 FORALL VAR3 ( ( VAR2 EQ VAR3 ) OR' +
+     ' FORALL VAR2 EXISTS VAR2 PRED1 ( VAR1 ) )').split(),
+]
+
+# Negations to push through quantifiers and every connective.
+NORMAL_FORM_FORMULAS = [
+    ('NEG EXISTS VAR1 ( PRED1 ( VAR1 ) IMPLIES NEG FORALL VAR2' +
+     ' PRED2 ( VAR1 , VAR2 ) )').split(),
+    ('NEG ( PRED1 ( VAR1 ) IFF EXISTS VAR1 NEG PRED1 ( VAR1 ) )').split(),
+    ('( FORALL VAR1 PRED1 ( VAR1 ) OR NEG ( EXISTS VAR2 ( VAR2 EQ CONST1 )' +
+     ' AND FORALL VAR1 PRED2 ( VAR1 , VAR2 ) ) )').split(),
+]
+
+FIELD_RENAMES = [{'formula': 'form'}, {'equality': 'eq'},
+                 {'constants': 'const'}, {'quantifiers': 'equality'},
+                 {'predicates': 'variables'}]
+
+EDIT_PIECES = ['(', ')', ',', ' ', 'VAR1', 'VAR2', 'CONST1', 'PRED1(VAR1)',
+               'PRED2(VAR1, VAR2)', 'EQ', 'AND', 'OR', 'NEG', 'EXISTS VAR3',
+               'FORALL', '(VAR1 EQ CONST1)', 'V', 'AR', '1', 'x', 'A', 'ND']
+
+TOKEN_COLUMNS = ('kind', 'symbol', 'offset', 'length')
+TREE_COLUMNS = ('kind', 'token', 'parent', 'first_child', 'last_child',
+                'next_sibling')
+
+WORD = re.compile(r'\S+')
+
+ALLOWED_CHARS = string.ascii_letters + string.digits + '_'
+WHITESPACE = [' ', '\t', '\n']
+
+
+def gen_sub(rng, sub=True):
+    # VAR9 is never declared, so a formula using it fails to lex.
+    sub_dict = {'(': '(', ')': ')', ',': ',', ' ': ' ', '\t': '\t',
+                '\n': '\n', 'VAR9': 'VAR9'}
+    for arity, pred in enumerate(BASE_PRED):
+        name = ''.join(rng.choices(ALLOWED_CHARS, k=10)) if sub else pred
+        sub_dict[pred] = (name, f'{name}[{arity + 1}]')
+    for symbol in BASE_VAR + BASE_CONST + BASE_EQ + BASE_CONN + BASE_QUAN:
+        chars = ALLOWED_CHARS
+        if symbol in BASE_CONN + BASE_QUAN:
+            chars += '\\'
+        elif symbol in BASE_EQ:
+            chars += '='
+        sub_dict[symbol] = ''.join(rng.choices(chars, k=10)) if sub \
+            else symbol
+    return sub_dict
+
+
+def input_lines(formula, sub_dict, rng=None, fields=None):
+    entries = [('variables', BASE_VAR), ('constants', BASE_CONST),
+               ('predicates', BASE_PRED), ('equality', BASE_EQ),
+               ('connectives', BASE_CONN), ('quantifiers', BASE_QUAN),
+               ('formula', formula)]
+    if rng:
+        rng.shuffle(entries)
+    text = []
+    for field, symbols in entries:
+        name = fields.get(field, field) if fields else field
+        if field == 'predicates':
+            body = ' '.join(sub_dict[x][1] for x in symbols)
+        elif field == 'formula':
+            body = ''.join((sub_dict[x][0] if isinstance(sub_dict[x], tuple)
+                            else sub_dict[x]) + ' ' for x in symbols)
+        else:
+            body = ' '.join(sub_dict[x] for x in symbols)
+        text.append(f'{name}: {body}\n')
+    return ''.join(text).splitlines(True)
+
+
+def balanced_formula(rng, depth):
+    # A valid formula of 2 ** depth random atoms.
+    if depth == 0:
+        return random_formula(rng, 0)
+    return (['('] + balanced_formula(rng, depth - 1) +
+            [rng.choice(BASE_CONN[:-1])] + balanced_formula(rng, depth - 1) +
+            [')'])
+
+
+def random_formula(rng, depth):
+    # A valid formula of base symbols, nested at most depth deep.
+    if depth == 0 or rng.random() < 0.3:
+        if rng.random() < 0.3:
+            terms = rng.choices(BASE_VAR + BASE_CONST[:2], k=2)
+            return ['(', terms[0], 'EQ', terms[1], ')']
+        arity = rng.randrange(1, 3)
+        args = rng.choices(BASE_VAR[:3], k=arity)
+        return [BASE_PRED[arity - 1], '('] + ' , '.join(args).split() + [')']
+    choice = rng.randrange(3)
+    if choice == 0:
+        return ['NEG'] + random_formula(rng, depth - 1)
+    if choice == 1:
+        return ([rng.choice(BASE_QUAN), rng.choice(BASE_VAR[:3])] +
+                random_formula(rng, depth - 1))
+    return (['('] + random_formula(rng, depth - 1) +
+            [rng.choice(BASE_CONN[:-1])] + random_formula(rng, depth - 1) +
+            [')'])
+
+
+def corrupt(rng, formula, edits=None):
+    # Deletes, inserts or replaces a few symbols, possibly with an
+    # undeclared one, so the formula is most likely invalid.
+    formula = list(formula)
+    insertions = (BASE_VAR[:3] + BASE_CONST[:2] + BASE_EQ + BASE_CONN +
+                  BASE_QUAN + ['(', ')', ',', 'PRED1', 'VAR9'])
+    for _ in range(edits or rng.randrange(1, 4)):
+        index = rng.randrange(len(formula) + 1)
+        choice = rng.randrange(3)
+        if choice != 1 and index < len(formula):
+            del formula[index]
+        if choice != 0:
+            formula.insert(index, rng.choice(insertions))
+    return formula
+
+
+def respace(rng, text):
+    # The same symbols as text with different whitespace between them.
+    words = text.split()
+    out = [rng.choice(['', ' ', '\t '])]
+    for i, word in enumerate(words):
+        if i:
+            separators = words[i - 1][-1] in '(),' or word[0] in '(),'
+            out.append('' if separators and rng.random() < 0.5 else
+                       rng.choice([' ', '  ', '\t', ' \n ']))
+        out.append(word)
+    out.append(rng.choice(['', ' ', '\n']))
+    return ''.join(out)
+
+
+def gen_cases(rng, scale=1):
+    # Yields (stage, description, lines, expected).
+    sub_dict = gen_sub(rng, sub=False)
+    for formula in BASE_FORMULA:
+        yield 1, 'Basic input', input_lines(formula, sub_dict), 'valid'
+    for _ in range(3 * scale):
+        sub_dict = gen_sub(rng)
+        for formula in BASE_FORMULA:
+            yield (2, 'Random symbol names',
+                   input_lines(formula, sub_dict, rng), 'valid')
+    for _ in range(3 * scale):
+        sub_dict = gen_sub(rng)
+        for formula in BASE_FORMULA:
+            formula = list(formula)
+            for index in sorted(rng.sample(range(len(formula)), 10),
+                                reverse=True):
+                formula.insert(index, rng.choice(WHITESPACE))
+            yield (3, 'Extra whitespace',
+                   input_lines(formula, sub_dict, rng), 'valid')
+    for _ in range(5 * scale):
+        sub_dict = gen_sub(rng, sub=False)
+        for formula in BASE_FORMULA:
+            index = rng.choice([i for i, symbol in enumerate(formula)
+                                if symbol != 'NEG'])
+            formula = formula[:index] + formula[index + 1:]
+            yield (4, 'Randomly removed symbol',
+                   input_lines(formula, sub_dict, rng), 'syntax')
+    insertions = (BASE_VAR + BASE_CONST + BASE_EQ + BASE_CONN[:-1] +
+                  BASE_QUAN + list('()'))
+    for _ in range(5 * scale):
+        sub_dict = gen_sub(rng, sub=False)
+        for formula in BASE_FORMULA:
+            formula = list(formula)
+            formula.insert(rng.randrange(len(formula)),
+                           rng.choice(insertions))
+            yield (5, 'Random valid symbol added',
+                   input_lines(formula, sub_dict, rng), 'syntax')
+    for formula in BASE_FORMULA:
+        for fields in FIELD_RENAMES:
+            yield (6, f'Invalid field name {fields}',
+                   input_lines(formula, gen_sub(rng), rng, fields),
+                   'signature')
+        lines = input_lines(formula, gen_sub(rng)) + ['variables: VAR0\n']
+        yield 6, 'Duplicate field name', lines, 'signature'
+        for symbol, prefix in (('VAR1', '\\'), ('CONST1', '='),
+                               ('EXISTS', '='), ('EQ', '*')):
+            sub_dict = gen_sub(rng, sub=False)
+            sub_dict[symbol] = f'{prefix}{sub_dict[symbol]}'
+            yield (6, f'Invalid character in {symbol}',
+                   input_lines(formula, sub_dict), 'signature')
+    for formula, note in TARGETED_FORMULAS:
+        yield (7, note, input_lines(formula.split(), gen_sub(rng, False), rng),
+               'syntax')
+    for formula in BASE_FORMULA + [random_formula(rng, 5)
+                                   for _ in range(4 * scale)]:
+        yield (8, 'Incremental edits',
+               input_lines(formula, gen_sub(rng, sub=False)), 'pass')
+    for formula in BASE_FORMULA + [random_formula(rng, 6)
+                                   for _ in range(4 * scale)]:
+        yield 9, 'Parse DAG', input_lines(formula, gen_sub(rng), rng), 'pass'
+    for formula in SCOPE_FORMULAS + [random_formula(rng, 6)
+                                     for _ in range(4 * scale)]:
+        yield (10, 'Scope analysis', input_lines(formula, gen_sub(rng), rng),
+               'pass')
+    for formula in NORMAL_FORM_FORMULAS + [random_formula(rng, 5)
+                                           for _ in range(4 * scale)]:
+        yield 11, 'Normal forms', input_lines(formula, gen_sub(rng)), 'pass'
+    if importlib.util.find_spec('numpy') is not None:
+        for formula in NORMAL_FORM_FORMULAS + BASE_FORMULA[2:3] + [
+                random_formula(rng, 5) for _ in range(4 * scale)]:
+            yield (12, 'Model evaluation', input_lines(formula, gen_sub(rng)),
+                   'pass')
+    for formula in BASE_FORMULA + [random_formula(rng, 4)
+                                   for _ in range(4 * scale)]:
+        if rng.random() < 0.7:
+            formula = corrupt(rng, formula)
+        yield (13, 'Result cache', input_lines(formula, gen_sub(rng, False)),
+               'pass')
+    for formula in BASE_FORMULA + [
+            formula.split() for formula, _ in TARGETED_FORMULAS] + [
+            random_formula(rng, 5) for _ in range(4 * scale)]:
+        yield (14, 'Error recovery', input_lines(formula, gen_sub(rng, False)),
+               'pass')
+    for formula in BASE_FORMULA + [random_formula(rng, 4)
+                                   for _ in range(4 * scale)]:
+        if rng.random() < 0.5:
+            formula = corrupt(rng, formula)
+        sub_dict = gen_sub(rng, rng.random() < 0.5)
+        yield 15, 'Mapped input', input_lines(formula, sub_dict, rng), 'pass'
+    if importlib.util.find_spec('numpy') is not None:
+        yield (16, 'Incremental edit speed',
+               input_lines(balanced_formula(rng, 14), gen_sub(rng, False)),
+               'pass')
+
+
+def check_case(lines):
+    try:
+        sym_table, formula = compiler.read_input(lines)
+        signature = compiler.Signature(sym_table)
+    except compiler.CompilerError as err:
+        return 'signature', err.message
+    valid, err = compiler.Compiler(signature, iterative=True).validate(formula)
+    if valid:
+        return 'valid', None
+    return 'syntax', err.message
+
+
+def full_parse(comp, text):
+    # The (ParseResult, error) pair incremental.edit should give for text.
+    try:
+        tokens = comp.lex(text)
+    except compiler.CompilerError as err:
+        return compiler.ParseResult(text, None, None), err
+    try:
+        return comp.parse_tokens(text, tokens), None
+    except compiler.CompilerError as err:
+        return compiler.ParseResult(text, tokens, None), err
+
+
+def same_parse(got, got_err, want, want_err):
+    if (got_err is None) != (want_err is None):
+        return False
+    if got_err and ((got_err.message, got_err.position) !=
+                    (want_err.message, want_err.position)):
+        return False
+    for mine, theirs, columns in ((got.tokens, want.tokens, TOKEN_COLUMNS),
+                                  (got.tree, want.tree, TREE_COLUMNS)):
+        if (mine is None) != (theirs is None):
+            return False
+        if mine is not None and any(getattr(mine, column) !=
+                                    getattr(theirs, column)
+                                    for column in columns):
+            return False
+    return got.formula == want.formula
+
+
+def check_edits(lines, rng):
+    sym_table, formula = compiler.read_input(lines)
+    comp = compiler.Compiler(compiler.Signature(sym_table), iterative=True)
+    result, _ = full_parse(comp, formula)
+    for _ in range(30):
+        text = result.formula
+        offset = rng.randrange(len(text) + 1)
+        deleted = rng.randrange(min(6, len(text) - offset) + 1)
+        inserted = rng.choice(EDIT_PIECES) if rng.random() < 0.8 else ''
+        result, err = incremental.edit(comp, result, offset, deleted,
+                                       inserted)
+        want, want_err = full_parse(
+            comp, text[:offset] + inserted + text[offset + deleted:])
+        if not same_parse(result, err, want, want_err):
+            return 'fail', (f'replacing {text[offset:offset + deleted]!r}' +
+                            f' at {offset} of {text!r} with {inserted!r}' +
+                            f' differs from a full parse')
+    return 'pass', None
+
+
+def check_edit_speed(lines, rng):
+    # The edits rename a variable, which reparses an atom, or add a NEG in
+    # the first half of the formula, which also moves most tokens and nodes.
+    sym_table, formula = compiler.read_input(lines)
+    comp = compiler.Compiler(compiler.Signature(sym_table), iterative=True)
+    start = time.perf_counter()
+    result = comp.parse(formula)
+    parse_time = time.perf_counter() - start
+    for count in range(6):
+        text = result.formula
+        if count % 2:
+            word = rng.choice([word for word in WORD.finditer(text)
+                               if word[0] in BASE_VAR[:3]])
+            offset, deleted = word.start(), len(word[0])
+            inserted = rng.choice(BASE_VAR[:3])
+        else:
+            word = rng.choice([word for word in WORD.finditer(
+                text, 0, len(text) // 2) if word[0] in BASE_PRED])
+            offset, deleted, inserted = word.start(), 0, 'NEG '
+        start = time.perf_counter()
+        result, err = incremental.edit(comp, result, offset, deleted,
+                                       inserted)
+        edit_time = time.perf_counter() - start
+        if err is not None:
+            return 'fail', f'edit at {offset} gave {err.message}'
+        if edit_time > parse_time / 10:
+            return 'fail', (f'edit at {offset} of {len(result.tokens)}' +
+                            f' tokens took {edit_time:.3f}s, parsing' +
+                            f' took {parse_time:.3f}s')
+    want, _ = full_parse(comp, result.formula)
+    if not same_parse(result, None, want, None):
+        return 'fail', 'edits differ from a full parse'
+    return 'pass', None
+
+
+def expand(dag):
+    # Pre-order walk of the tree a DAG stands for.
+    stack = [dag.root]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(dag.child_ids(node)))
+
+
+def check_dag(lines, rng):
+    sym_table, formula = compiler.read_input(lines)
+    signature = compiler.Signature(sym_table)
+    iterative = rng.random() < 0.5
+    result = compiler.Compiler(signature, iterative).parse(formula)
+    tree, tokens = result.tree, result.tokens
+    dag = compiler.Compiler(signature, iterative, dag=True).parse(
+        formula).tree
+    stats = dag.stats()
+    if stats['tree_nodes'] != len(tree):
+        return 'fail', (f'DAG stands for {stats["tree_nodes"]} nodes, the' +
+                        f' tree has {len(tree)}')
+    if len(parse_dag.from_tree(tree, tokens)) != len(dag):
+        return 'fail', 'DAG built from the tree has a different size'
+    for node, shared in zip(range(len(tree)), expand(dag)):
+        if (tree.kind[node] != dag.kind[shared] or
+                tree.label(node, tokens) != dag.label(shared, tokens)):
+            return 'fail', f'Expanded DAG differs from the tree at {node}'
+    return 'pass', None
+
+
+def naive_scopes(tree, tokens):
+    def bound_symbol(node):
+        # Symbol a quantified <Formula> binds, or None for any other node.
+        if tree.kind[node] != parse_tree.FORMULA:
+            return None
+        for child in tree.children(node):
+            if tree.kind[child] == parse_tree.VARIABLE:
+                return tokens.symbol[tree.token[child]]
+        return None
+
+    binder = [-1] * len(tree)
+    free = {}
+    used = set()
+    shadowed = []
+    for node in range(len(tree)):
+        if bound_symbol(node) is not None:
+            outer = tree.parent[node]
+            while outer != -1 and bound_symbol(outer) != bound_symbol(node):
+                outer = tree.parent[outer]
+            if outer != -1:
+                shadowed.append((node, outer))
+        if tree.kind[node] != parse_tree.VARIABLE:
+            continue
+        symbol = tokens.symbol[tree.token[node]]
+        outer = tree.parent[node]
+        if tree.kind[outer] == parse_tree.FORMULA:
+            binder[node] = outer
+            continue
+        while outer != -1 and bound_symbol(outer) != symbol:
+            outer = tree.parent[outer]
+        binder[node] = outer
+        if outer == -1:
+            free.setdefault(symbol, node)
+        else:
+            used.add(outer)
+    vacuous = [node for node in range(len(tree))
+               if bound_symbol(node) is not None and node not in used]
+    return binder, free, vacuous, shadowed
+
+
+def check_scopes(lines, rng):
+    sym_table, formula = compiler.read_input(lines)
+    result = compiler.Compiler(compiler.Signature(sym_table),
+                               iterative=True).parse(formula)
+    scopes = scope.analyze(result.tree, result.tokens)
+    binder, free, vacuous, shadowed = naive_scopes(result.tree,
+                                                   result.tokens)
+    if list(scopes.binder) != binder:
+        return 'fail', 'Variables are bound by the wrong quantifiers'
+    if scopes.free != free:
+        return 'fail', f'Free variables {scopes.free} should be {free}'
+    if scopes.vacuous != vacuous:
+        return 'fail', (f'Vacuous quantifiers {scopes.vacuous} should be' +
+                        f' {vacuous}')
+    if scopes.shadowed != shadowed:
+        return 'fail', (f'Shadowed quantifiers {scopes.shadowed} should be' +
+                        f' {shadowed}')
+    return 'pass', None
+
+
+def random_model(signature, rng, size=None):
+    # (size, constants, relations) with relations as sets of tuples.
+    if size is None:
+        size = rng.randrange(1, 4)
+    constants = {const: rng.randrange(size) for const in signature.constants}
+    relations = {}
+    for pred in signature.predicates:
+        elements = itertools.product(range(size),
+                                     repeat=signature.arity(pred))
+        relations[pred] = {args for args in elements if rng.random() < 0.5}
+    return size, constants, relations
+
+
+def holds(store, formula, env, model):
+    # Straight from the definition of truth, for formulas of a FormulaStore.
+    size, constants, relations = model
+    node = store.nodes[formula]
+    op = node[0]
+    if op == normal_form.ATOM:
+        args = tuple(constants[term] if term in constants else env[term]
+                     for term in node[2])
+        if node[1] == store.signature.equality:
+            return args[0] == args[1]
+        return args in relations[node[1]]
+    if op == normal_form.NOT:
+        return not holds(store, node[1], env, model)
+    if op in (normal_form.EXISTS, normal_form.FORALL):
+        values = (holds(store, node[2], {**env, node[1]: element}, model)
+                  for element in range(size))
+        return any(values) if op == normal_form.EXISTS else all(values)
+    left = holds(store, node[1], env, model)
+    right = holds(store, node[2], env, model)
+    if op == normal_form.AND:
+        return left and right
+    if op == normal_form.OR:
+        return left or right
+    if op == normal_form.IMPLIES:
+        return not left or right
+    return left == right
+
+
+def assignments(variables, size):
+    for elements in itertools.product(range(size), repeat=len(variables)):
+        yield dict(zip(variables, elements))
+
+
+def literal_holds(store, literal, definitions, env, model):
+    # A definition atom has the value of the subformula it names.
+    node = store.nodes[literal]
+    if node[0] == normal_form.NOT:
+        return not literal_holds(store, node[1], definitions, env, model)
+    if literal in definitions:
+        return holds(store, definitions[literal], env, model)
+    return holds(store, literal, env, model)
+
+
+def satisfiable(store, cnf, definitions, env, model):
+    # Whether some values of the definition atoms satisfy the clauses. An
+    # atom is only negated in the clauses defining it, so it is made true
+    # whenever they allow, after the definitions of its subformulas.
+    defining = {}
+    others = []
+    for clause in cnf.clauses:
+        node = store.nodes[clause[0]]
+        if node[0] == normal_form.NOT and node[1] in definitions:
+            defining.setdefault(node[1], []).append(clause[1:])
+        else:
+            others.append(clause)
+    true = {}
+
+    def value(literal):
+        if literal in true:
+            return true[literal]
+        return literal_holds(store, literal, {}, env, model)
+
+    for atom, _ in cnf.definitions:
+        true[atom] = all(any(value(literal) for literal in clause)
+                         for clause in defining.get(atom, ()))
+    return all(any(value(literal) for literal in clause)
+               for clause in others)
+
+
+def check_clauses(store, forms, rng, signature):
+    cnf = forms.cnf
+    # An AND definition adds two clauses of two literals, any other one
+    # clause of three, and the matrix atom itself one more.
+    size = store.size(forms.matrix)
+    if (len(cnf.definitions) > size or len(cnf.clauses) > 2 * size + 1 or
+            cnf.literals() > 4 * size + 1):
+        return 'fail', (f'{len(cnf.clauses)} clauses with' +
+                        f' {cnf.literals()} literals and' +
+                        f' {len(cnf.definitions)} definitions for a' +
+                        f' matrix of {size} nodes')
+    definitions = dict(cnf.definitions)
+    variables = sorted(normal_form.free_variables(store, forms.matrix))
+    for _ in range(5):
+        model = random_model(signature, rng)
+        for _ in range(20):
+            env = {var: rng.randrange(model[0]) for var in variables}
+            want = holds(store, forms.matrix, env, model)
+            valued = all(any(literal_holds(store, literal, definitions,
+                                           env, model) for literal in clause)
+                         for clause in cnf.clauses)
+            if (valued != want or
+                    satisfiable(store, cnf, definitions, env, model) != want):
+                return 'fail', (f'clauses {list(cnf.lines(store))[1:]}' +
+                                f' differ from the matrix' +
+                                f' {store.text(forms.matrix)} under {env}' +
+                                f' in a model of size {model[0]}')
+    return 'pass', None
+
+
+def check_normal_forms(lines, rng):
+    sym_table, formula = compiler.read_input(lines)
+    signature = compiler.Signature(sym_table)
+    result = compiler.Compiler(signature, iterative=True).parse(formula)
+    forms = normal_form.convert(result.tree, result.tokens, signature, 'cnf')
+    store = forms.store
+    variables = sorted(normal_form.free_variables(store, forms.formula))
+    for _ in range(5):
+        model = random_model(signature, rng)
+        for env in assignments(variables, model[0]):
+            want = holds(store, forms.formula, env, model)
+            for name, form in (('NNF', forms.nnf), ('Prenex', forms.prenex)):
+                if holds(store, form, env, model) != want:
+                    return 'fail', (f'{name} {store.text(form)} differs from' +
+                                    f' {store.text(forms.formula)} in a' +
+                                    f' model of size {model[0]}')
+    return check_clauses(store, forms, rng, signature)
+
+
+def check_model(lines, rng):
+    import numpy
+    sym_table, formula = compiler.read_input(lines)
+    signature = compiler.Signature(sym_table)
+    result = compiler.Compiler(signature, iterative=True).parse(formula)
+    store = normal_form.FormulaStore(signature)
+    root = normal_form.from_tree(store, result.tree, result.tokens)
+    for dense_limit, chunked, kind in ((model.DENSE_LIMIT, False, 'dense'),
+                                       (0, False, 'sparse'),
+                                       (model.DENSE_LIMIT, True, 'chunked'),
+                                       (0, True, 'sparse chunked')):
+        # A budget below the domain size splits every quantifier whose body
+        # uses its variable.
+        size = rng.randrange(2, 4) if chunked else None
+        size, constants, relations = world = random_model(signature, rng,
+                                                          size)
+        budget = rng.randrange(1, size) if chunked else None
+        structure = model.Structure(signature, size, constants, relations,
+                                    dense_limit)
+        valuation = model.evaluate(result.tree, result.tokens, structure,
+                                   budget)
+        array = numpy.asarray(valuation.array)
+        for env in assignments(valuation.variables, size):
+            index = tuple(env[var] for var in valuation.variables)
+            if bool(array[index]) != holds(store, root, env, world):
+                return 'fail', (f'Evaluating {store.text(root)} with' +
+                                f' {kind} relations in a model of size' +
+                                f' {size} is wrong for {env}')
+    return 'pass', None
+
+
+def error_pair(err):
+    return None if err is None else (err.message, err.position)
+
+
+def parse_outcome(comp, method, text):
+    # What a parse, validation or recovering parse of text reports.
+    if method == 'diagnose':
+        return [error_pair(err) for err in comp.diagnose(text)[1]]
+    if method == 'validate':
+        return error_pair(comp.validate(text)[1])
+    try:
+        comp.parse(text)
+    except compiler.CompilerError as err:
+        return error_pair(err)
+    return None
+
+
+def check_result_cache(lines, rng):
+    sym_table, formula = compiler.read_input(lines)
+    signature = compiler.Signature(sym_table)
+    plain = compiler.Compiler(signature, iterative=True)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'results.db')
+        caches = [compiler.ResultCache(path=path) for _ in range(2)]
+        first, second = (compiler.Compiler(signature, True, results)
+                         for results in caches)
+        try:
+            # The second cache shares only the database with the first.
+            for text, comp, lookup in (
+                    (formula, first, 'miss'), (formula, first, 'memory hit'),
+                    (respace(rng, formula), first, 'whitespace hit'),
+                    (respace(rng, formula), second, 'disk hit')):
+                for method in ('parse', 'validate', 'diagnose'):
+                    got = parse_outcome(comp, method, text)
+                    want = parse_outcome(plain, method, text)
+                    if got != want:
+                        return 'fail', (f'{method} of {text!r} on a' +
+                                        f' {lookup} gave {got}, without' +
+                                        f' the cache {want}')
+        finally:
+            for results in caches:
+                results.disk.close()
+    return 'pass', None
+
+
+def break_atoms(rng, words):
+    # Puts a mistake between the brackets of up to three atoms, where
+    # recovery cannot skip past the atom. Returns the new words and the
+    # (first, last) word indexes of the broken atoms.
+    atoms = []
+    for i, word in enumerate(words):
+        if word in BASE_PRED:
+            end = words.index(')', i)
+            atoms.append((i, end, [j for j in range(i + 2, end)
+                                   if words[j] != ',']))
+        elif word == '(' and i + 2 < len(words) and words[i + 2] == 'EQ':
+            atoms.append((i, i + 4, [i + 1, i + 3]))
+    words = list(words)
+    broken = []
+    for first, last, terms in sorted(rng.sample(atoms, min(3, len(atoms)))):
+        words[rng.choice(terms)] = rng.choice(['EQ', 'AND', 'NEG', 'EXISTS',
+                                               ',', ''])
+        broken.append((first, last))
+    return words, broken
+
+
+def check_recovery(lines, rng):
+    sym_table, formula = compiler.read_input(lines)
+    signature = compiler.Signature(sym_table)
+    words = formula.split()
+    injected, broken = break_atoms(rng, words)
+    texts = [formula, ' '.join(corrupt(rng, words)), ' '.join(injected)]
+    reported = []
+    for text in texts:
+        found = []
+        for iterative in (False, True):
+            comp = compiler.Compiler(signature, iterative)
+            errors = parse_outcome(comp, 'diagnose', text)
+            got = errors[0] if errors else None
+            want = parse_outcome(comp, 'parse', text)
+            # Only a recovering lexer names the invalid identifier.
+            if got and want and want[0].startswith('Formula contains'):
+                got, want = got[1], want[1]
+            if got != want:
+                return 'fail', (f'recovering from errors in {text!r} first' +
+                                f' reported {errors[:1]}, without' +
+                                f' recovery {want}')
+            found.append(errors)
+        if found[0] != found[1]:
+            return 'fail', (f'recursive parser reported {found[0]} for' +
+                            f' {text!r}, iterative parser {found[1]}')
+        reported.append([position for _, position in found[0]])
+    if reported[0]:
+        # A mistake in the formula itself can skip the broken atoms.
+        return 'pass', None
+    offsets = [0]
+    for word in injected:
+        offsets.append(offsets[-1] + len(word) + 1)
+    for first, last in broken:
+        start, end = offsets[first], offsets[last + 1]
+        if not any(start <= position < end for position in reported[2]):
+            return 'fail', (f'no error reported in the broken atom ' +
+                            f'{text[start:end]!r} of {text!r}, only at' +
+                            f' {reported[2]}')
+    return 'pass', None
+
+
+def break_lines(rng, text):
+    # text spread over lines with random indentation, which reading the
+    # input file joins back together, so breaks inside words are kept too.
+    out = []
+    for char in text:
+        if rng.random() < 0.08:
+            out.append(rng.choice(['\n', ' \n', '\n\t', '\r\n  ', '\n\n ']))
+        out.append(char)
+    return ''.join(out)
+
+
+def read_outcome(comp, formula):
+    # The tokens or error of a parse and the errors of a recovering parse.
+    try:
+        result = comp.parse(formula)
+        verdict = result.tokens.pairs()
+    except compiler.CompilerError as err:
+        verdict = error_pair(compiler.normal_error(formula, err))
+    errors = [error_pair(compiler.normal_error(formula, err))
+              for err in comp.diagnose(formula)[1]]
+    return verdict, errors
+
+
+def read_file(read, path):
+    try:
+        return read(path), None
+    except compiler.CompilerError as err:
+        return (None, None), err.message
+
+
+def check_mapped_input(lines, rng):
+    index = [line.startswith('formula:') for line in lines].index(True)
+    text = ''.join(lines[:index] + [
+        'formula:' + break_lines(rng, lines[index][len('formula:'):])] +
+        lines[index + 1:])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'input.txt')
+        with open(path, 'w', newline='') as out:
+            out.write(text)
+        (sym_table, plain), want = read_file(compiler.read_in_file, path)
+        (mapped_table, mapped), got = read_file(compiler.map_input, path)
+        if got != want or mapped_table != sym_table:
+            return 'fail', (f'mapping {text!r} gave {got or mapped_table},' +
+                            f' reading it {want or sym_table}')
+        if want is not None:
+            return 'pass', None
+        signature = compiler.Signature(sym_table)
+        for iterative in (False, True):
+            comp = compiler.Compiler(signature, iterative)
+            want = read_outcome(comp, plain)
+            got = read_outcome(comp, mapped)
+            if got != want:
+                return 'fail', (f'mapped formula {text!r} gave {got},' +
+                                f' read as text {want}')
+        mapped.release()
+    return 'pass', None
+
+
+STAGE_CHECKS = {8: check_edits, 9: check_dag, 10: check_scopes,
+                11: check_normal_forms, 12: check_model,
+                13: check_result_cache, 14: check_recovery,
+                15: check_mapped_input, 16: check_edit_speed}
+
+
+def run_case(job):
+    stage, lines, seed = job
+    if stage in STAGE_CHECKS:
+        return STAGE_CHECKS[stage](lines, random.Random(seed))
+    return check_case(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check the compiler against the test stages')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of worker processes (default: all cores)')
+    parser.add_argument('--scale', type=int, default=1,
+                        help='Multiply the number of random cases per stage')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print every case, not just the failures')
+    options = parser.parse_args()
+    seed = options.seed
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    rng = random.Random(seed)
+    cases = list(gen_cases(rng, options.scale))
+    work = [(case[0], case[2], rng.randrange(2 ** 32)) for case in cases]
+    stages = {}
+    failures = 0
+    jobs = options.jobs or os.cpu_count()
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        outcomes = pool.map(run_case, work,
+                            chunksize=max(1, len(cases) // (4 * jobs)))
+        for (stage, description, lines, expected), (outcome, message) in \
+                zip(cases, outcomes):
+            counts = stages.setdefault(stage, [0, 0])
+            counts[0] += 1
+            passed = outcome == expected
+            counts[1] += passed
+            if not passed:
+                failures += 1
+            if not passed or options.verbose:
+                print(f'{"PASS" if passed else "FAIL"} stage {stage}' +
+                      f' {description}: expected {expected}, got {outcome}' +
+                      (f' ({message})' if message else ''))
+                if not passed:
+                    print(''.join(lines))
+    seconds = time.perf_counter() - start
+    for stage in sorted(stages):
+        total, passed = stages[stage]
+        print(f'Stage {stage}: {passed}/{total} passed')
+    print(f'{len(cases)} cases in {seconds:.2f}s on {jobs} workers' +
+          f' ({len(cases) / seconds:.0f} cases/s), seed {seed}')
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
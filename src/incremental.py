@@ -0,0 +1,188 @@
+"""
+    Incremental reparsing of an edited formula. The edit is relexed from the
+    start of the word it touches until the new tokens line up with the old
+    ones again, and only the smallest <Formula> around the changed tokens is
+    reparsed, widening to the enclosing one when the new subtree does not end
+    where the old one did. The result is the same as a full reparse.
+"""
+
+import bisect
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import compiler
+import parse_tree
+import token_stream
+
+
+def word_start(text, index):
+    # An edit can change how lexing goes back to the start of the word it is
+    # in, since symbols are matched longest first.
+    while (index > 0 and not text[index - 1].isspace() and
+           text[index - 1] not in '(),'):
+        index -= 1
+    return index
+
+
+def relex(trie, tokens, text, offset, deleted, inserted):
+    # Lexes text, the edited formula, and returns its tokens, the range of
+    # old tokens that was replaced and how many new tokens replaced it.
+    delta = len(inserted) - deleted
+    edit_end = offset + len(inserted)
+    start = word_start(text, offset)
+    first = bisect.bisect_left(tokens.offset, start)
+    last = len(tokens)
+    middle = token_stream.TokenStream(text)
+    i = start
+    while i < len(text):
+        if text[i].isspace():
+            i += 1
+            continue
+        if i >= edit_end:
+            old = bisect.bisect_left(tokens.offset, i - delta, first)
+            if old < len(tokens) and tokens.offset[old] == i - delta:
+                last = old
+                break
+        length, leaf, _ = compiler.match_trie(trie, text, i)
+        if leaf is None:
+            raise compiler.CompilerError(
+                'Formula contains invalid identifiers', i)
+        middle.append(leaf[0], leaf[1], i, length)
+        i += length
+    new = token_stream.TokenStream(text)
+    new.kind = tokens.kind[:first] + middle.kind + tokens.kind[last:]
+    new.symbol = tokens.symbol[:first] + middle.symbol + tokens.symbol[last:]
+    new.offset = (tokens.offset[:first] + middle.offset +
+                  shifted(tokens.offset[last:], delta))
+    new.length = tokens.length[:first] + middle.length + tokens.length[last:]
+    if tokens.codes is not None:
+        new.codes = (tokens.codes[:first] + middle.terminals() +
+                     tokens.codes[last:])
+    return new, first, last, len(middle)
+
+
+def shifted(column, delta, keep_none=False):
+    # column with delta added to each entry, apart from the -1 standing for
+    # no node when keep_none is set. Everything after an edit is shifted, so
+    # numpy does it in one pass when it is installed.
+    if not delta or not column:
+        return column
+    if numpy is not None:
+        values = numpy.frombuffer(column, dtype=column.typecode)
+        moved = values + delta
+        if keep_none:
+            moved[values == -1] = -1
+        return array(column.typecode, moved.tobytes())
+    if keep_none:
+        return array(column.typecode, [value + delta if value != -1 else -1
+                                       for value in column])
+    return array(column.typecode, map(delta.__add__, column))
+
+
+def subtree_end(tree, node):
+    while node != -1:
+        if tree.next_sibling[node] != -1:
+            return tree.next_sibling[node]
+        node = tree.parent[node]
+    return len(tree)
+
+
+def enclosing_formulas(tree, first, last):
+    # Yields (node, end) for each <Formula> that holds old tokens first to
+    # last - 1 (or the gap before first when nothing was replaced) and starts
+    # before them, innermost first. Its first token being unchanged keeps the
+    # parse that led up to it the same.
+    node = bisect.bisect_left(tree.token, first) - 1
+    while node != -1:
+        if tree.kind[node] == parse_tree.FORMULA:
+            end = subtree_end(tree, node)
+            if tree.token[end - 1] >= max(first, last - 1):
+                yield node, end
+        node = tree.parent[node]
+
+
+def splice(tree, start, end, sub, token_delta):
+    # Replaces the subtree at nodes start to end - 1 with sub.
+    node_delta = len(sub) - (end - start)
+    new = parse_tree.ParseTree()
+    new.kind = tree.kind[:start] + sub.kind + tree.kind[end:]
+    new.token = (tree.token[:start] + sub.token +
+                 shifted(tree.token[end:], token_delta))
+    sub_parent = shifted(sub.parent, start)
+    sub_parent[0] = tree.parent[start]
+    new.parent = (tree.parent[:start] + sub_parent +
+                  shifted(tree.parent[end:], node_delta))
+    for column in ('first_child', 'last_child', 'next_sibling'):
+        old = getattr(tree, column)
+        setattr(new, column, old[:start] +
+                shifted(getattr(sub, column), start, True) +
+                shifted(old[end:], node_delta, True))
+    # Before the replaced root, only it and its ancestors point past it;
+    # after it, only their later siblings point back before it.
+    node = start
+    while node != -1:
+        sibling = tree.next_sibling[node]
+        if sibling != -1:
+            new.next_sibling[node] = sibling + node_delta
+        while sibling != -1:
+            new.parent[sibling + node_delta] = tree.parent[sibling]
+            sibling = tree.next_sibling[sibling]
+        parent = tree.parent[node]
+        if parent != -1 and tree.last_child[parent] >= end:
+            new.last_child[parent] = tree.last_child[parent] + node_delta
+        node = parent
+    return new
+
+
+def reparse(comp, tokens, tree, first, last, count):
+    grammar = comp.signature.ll1_grammar()
+    token_delta = count - (last - first)
+    for node, end in enclosing_formulas(tree, first, last):
+        parser = compiler.Parser(grammar, tokens)
+        parser.lookahead = tree.token[node]
+        if comp.iterative:
+            parser.formula_iterative(-1)
+        else:
+            parser.formula(-1)
+        if parser.lookahead == tree.token[end - 1] + 1 + token_delta:
+            return splice(tree, node, end, parser.tree, token_delta)
+    return compiler.Parser(grammar, tokens).parse(comp.iterative)
+
+
+def edit(comp, result, offset, deleted, inserted):
+    """
+        Applies an edit to a ParseResult from comp and returns the new
+        (ParseResult, error). After an invalid formula the result has no
+        tree, and the next edit is relexed but parsed in full, as is every
+        edit when comp builds DAGs.
+    """
+    formula = result.formula
+    if offset < 0 or deleted < 0 or offset + deleted > len(formula):
+        raise compiler.CompilerError('Edit is outside the formula')
+    text = formula[:offset] + inserted + formula[offset + deleted:]
+    try:
+        if result.tokens is None:
+            tokens = comp.lex(text)
+        else:
+            tokens, first, last, count = relex(
+                comp.signature.trie, result.tokens, text, offset, deleted,
+                inserted)
+    except compiler.CompilerError as err:
+        return compiler.ParseResult(text, None, None), err
+    try:
+        if result.tree is None or comp.dag:
+            return comp.parse_tokens(text, tokens), None
+        old = result.tokens
+        if (last - first == count and
+                old.kind[first:last] == tokens.kind[first:last] and
+                old.symbol[first:last] == tokens.symbol[first:last]):
+            tree = result.tree
+        else:
+            tree = reparse(comp, tokens, result.tree, first, last, count)
+    except compiler.CompilerError as err:
+        return compiler.ParseResult(text, tokens, None), err
+    return compiler.ParseResult(text, tokens, tree), None
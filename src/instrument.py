@@ -0,0 +1,52 @@
+import contextlib
+import json
+import time
+
+
+class Profile:
+    # Wall and CPU time per phase plus free-form counters. hook, if given,
+    # is called with the finished record so library callers can collect it.
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.phases = {}
+        self.counters = {}
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            entry = self.phases.setdefault(name, [0.0, 0.0, 0])
+            entry[0] += time.perf_counter() - wall
+            entry[1] += time.process_time() - cpu
+            entry[2] += 1
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record(self, **info):
+        record = dict(info)
+        record['wall_s'] = time.perf_counter() - self.wall
+        record['cpu_s'] = time.process_time() - self.cpu
+        record['phases'] = {name: {'wall_s': wall, 'cpu_s': cpu,
+                                   'calls': calls}
+                            for name, (wall, cpu, calls)
+                            in self.phases.items()}
+        record['counters'] = dict(self.counters)
+        return record
+
+    def finish(self, **info):
+        record = self.record(**info)
+        if self.hook:
+            self.hook(record)
+        return record
+
+
+def write_record(record, path):
+    with open(path, 'w') as out_file:
+        json.dump(record, out_file, indent=2)
+        out_file.write('\n')
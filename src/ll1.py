@@ -0,0 +1,125 @@
+END = '$'
+
+
+class GrammarError(Exception):
+    pass
+
+
+class Grammar:
+    # Any symbol without productions of its own is a terminal. table() maps
+    # nonterminal -> terminal -> production; a cell that is LL(1) ambiguous
+    # holds a dict keyed by the token after it instead, with the production
+    # added first under None as the fallback.
+    def __init__(self, start):
+        self.start = start
+        self.productions = {}
+        self.first = None
+        self.nullable = None
+        self.follow = None
+        self.table = None
+
+    def add(self, head, *body):
+        self.productions.setdefault(head, []).append(body)
+
+    def is_terminal(self, symbol):
+        return symbol not in self.productions
+
+    def first_of(self, symbols):
+        # FIRST of a sequence and whether all of it can be empty.
+        result = set()
+        for symbol in symbols:
+            if self.is_terminal(symbol):
+                result.add(symbol)
+                return result, False
+            result |= self.first[symbol]
+            if symbol not in self.nullable:
+                return result, False
+        return result, True
+
+    def compute_first(self):
+        self.first = {head: set() for head in self.productions}
+        self.nullable = set()
+        changed = True
+        while changed:
+            changed = False
+            for head, bodies in self.productions.items():
+                for body in bodies:
+                    first, nullable = self.first_of(body)
+                    if not first <= self.first[head]:
+                        self.first[head] |= first
+                        changed = True
+                    if nullable and head not in self.nullable:
+                        self.nullable.add(head)
+                        changed = True
+
+    def compute_follow(self):
+        self.follow = {head: set() for head in self.productions}
+        self.follow[self.start].add(END)
+        changed = True
+        while changed:
+            changed = False
+            for head, bodies in self.productions.items():
+                for body in bodies:
+                    for i, symbol in enumerate(body):
+                        if self.is_terminal(symbol):
+                            continue
+                        follow, nullable = self.first_of(body[i + 1:])
+                        if nullable:
+                            follow |= self.follow[head]
+                        if not follow <= self.follow[symbol]:
+                            self.follow[symbol] |= follow
+                            changed = True
+
+    def after(self, symbols, terminal, follow, seen=frozenset()):
+        # Tokens that can come straight after a leading terminal in the
+        # strings symbols derives, follow being what comes after symbols.
+        if not symbols:
+            return set()
+        symbol, rest = symbols[0], symbols[1:]
+        if self.is_terminal(symbol):
+            if symbol != terminal:
+                return set()
+            result, nullable = self.first_of(rest)
+            return result | follow if nullable else result
+        result = set()
+        if symbol not in seen:
+            for body in self.productions[symbol]:
+                if terminal in self.first_of(body)[0]:
+                    result |= self.after(body + rest, terminal, follow,
+                                         seen | {symbol})
+        if symbol in self.nullable:
+            result |= self.after(rest, terminal, follow, seen)
+        return result
+
+    def refine(self, head, terminal, bodies):
+        entry = {None: bodies[0]}
+        claimed = set()
+        for body in bodies:
+            seconds = self.after(body, terminal, self.follow[head])
+            if seconds & claimed:
+                raise GrammarError(
+                    f'{head} is ambiguous on {terminal} even with two ' +
+                    f'tokens of lookahead')
+            claimed |= seconds
+            for second in seconds:
+                entry[second] = body
+        return entry
+
+    def build(self):
+        self.compute_first()
+        self.compute_follow()
+        cells = {head: {} for head in self.productions}
+        for head, bodies in self.productions.items():
+            for body in bodies:
+                first, nullable = self.first_of(body)
+                if nullable:
+                    first |= self.follow[head]
+                for terminal in first:
+                    cells[head].setdefault(terminal, []).append(body)
+        self.table = {}
+        for head, row in cells.items():
+            self.table[head] = {
+                terminal: bodies[0] if len(bodies) == 1
+                else self.refine(head, terminal, bodies)
+                for terminal, bodies in row.items()}
+        return self
@@ -0,0 +1,307 @@
+"""
+    Evaluation of parsed formulas in finite structures. A formula is compiled
+    to boolean array operations in which each free variable is an axis over
+    the domain: connectives are element-wise, quantifiers reduce along the
+    axis of their variable and atoms index dense or sparse relations. NumPy
+    is only imported once a structure is built. With a memory budget, a
+    quantifier whose body would need a larger array is evaluated over chunks
+    of its variable's range and the partial results combined.
+"""
+
+import json
+import math
+from collections import ChainMap
+
+import normal_form
+
+# Relations given as tuples are stored densely when that takes at most this
+# many elements.
+DENSE_LIMIT = 1 << 24
+
+
+class ModelError(Exception):
+    pass
+
+
+class Structure:
+    # The domain is 0 .. size - 1. constants maps each constant to an
+    # element and relations maps each predicate to a boolean array of shape
+    # (size,) * arity or to an iterable of the tuples in the relation.
+    # Sparse relations are kept as an (n, arity) array of those tuples.
+    def __init__(self, signature, size, constants, relations,
+                 dense_limit=DENSE_LIMIT):
+        import numpy
+        if size < 1:
+            raise ModelError('The domain must have at least one element')
+        self.signature = signature
+        self.size = size
+        self.constants = {}
+        for const in signature.constants:
+            if const not in constants:
+                raise ModelError(f'Constant {const} has no interpretation')
+            if not 0 <= constants[const] < size:
+                raise ModelError(f'Constant {const} is not in the domain')
+            self.constants[const] = constants[const]
+        self.relations = {}
+        self.dense = {}
+        for pred in signature.predicates:
+            if pred not in relations:
+                raise ModelError(f'Predicate {pred} has no relation')
+            arity = signature.arity(pred)
+            relation = relations[pred]
+            if isinstance(relation, numpy.ndarray):
+                if relation.shape != (size,) * arity:
+                    raise ModelError(f'Relation for {pred} must have shape' +
+                                     f' {(size,) * arity}')
+                self.relations[pred] = relation.astype(bool, copy=False)
+                self.dense[pred] = True
+                continue
+            tuples = numpy.array(list(relation), dtype=numpy.int64)
+            tuples = tuples.reshape(len(tuples), arity)
+            if len(tuples) and (tuples.min() < 0 or tuples.max() >= size):
+                raise ModelError(f'Relation for {pred} has elements outside' +
+                                 f' the domain')
+            if size ** arity <= dense_limit:
+                dense = numpy.zeros((size,) * arity, dtype=bool)
+                dense[tuple(tuples.T)] = True
+                self.relations[pred] = dense
+                self.dense[pred] = True
+            else:
+                self.relations[pred] = tuples
+                self.dense[pred] = False
+
+    @classmethod
+    def load(cls, signature, path):
+        # {"size": n, "constants": {name: element},
+        #  "predicates": {name: [[element, ...], ...]}}
+        try:
+            with open(path) as in_file:
+                data = json.load(in_file)
+            return cls(signature, data['size'], data.get('constants', {}),
+                       data.get('predicates', {}))
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            raise ModelError(f'Could not read model {path}: {err}')
+
+
+class Valuation:
+    # array[i, j, ...] says whether the formula holds when the free
+    # variables, in the order of variables, are the elements i, j, ...
+    __slots__ = ('variables', 'array')
+
+    def __init__(self, variables, array):
+        self.variables = variables
+        self.array = array
+
+    def holds(self):
+        return bool(self.array.all())
+
+    def count(self):
+        return int(self.array.sum())
+
+
+class Evaluator:
+    # Keys are (formula, ranges), ranges giving (variable, start, stop) for
+    # each free variable of formula in sorted order. Only results of
+    # subformulas that occur more than once are kept after use.
+    def __init__(self, store, structure, budget=None):
+        import numpy
+        self.np = numpy
+        self.store = store
+        self.nodes = store.nodes
+        self.structure = structure
+        self.budget = budget
+        self.free = store.memo.setdefault('free', {})
+        self.uses = None
+        self.memo = ChainMap()
+
+    def variables(self, formula):
+        return tuple(sorted(self.free[formula]))
+
+    def key(self, formula, ranges):
+        bounds = {var: (start, stop) for var, start, stop in ranges}
+        return formula, tuple((var, *bounds[var])
+                              for var in self.variables(formula))
+
+    def count_uses(self, formula):
+        uses = {formula: 1}
+        stack = [formula]
+        while stack:
+            for child in self.children_of(stack.pop()):
+                uses[child] = uses.get(child, 0) + 1
+                if uses[child] == 1:
+                    stack.append(child)
+        return uses
+
+    def children_of(self, formula):
+        node = self.nodes[formula]
+        if node[0] == normal_form.ATOM:
+            return ()
+        if node[0] in (normal_form.EXISTS, normal_form.FORALL):
+            return (node[2],)
+        return node[1:]
+
+    def body_ranges(self, key):
+        formula, ranges = key
+        return ranges + ((self.nodes[formula][1], 0, self.structure.size),)
+
+    def chunked(self, key):
+        formula, ranges = key
+        node = self.nodes[formula]
+        if self.budget is None or node[1] not in self.free[node[2]]:
+            return False
+        return self.size(self.key(node[2], self.body_ranges(key))) > \
+            self.budget
+
+    def size(self, key):
+        return math.prod(stop - start for _, start, stop in key[1])
+
+    def children(self, key):
+        formula, ranges = key
+        node = self.nodes[formula]
+        op = node[0]
+        if op == normal_form.ATOM:
+            return ()
+        if op in (normal_form.EXISTS, normal_form.FORALL):
+            if self.chunked(key):
+                return ()
+            return (self.key(node[2], self.body_ranges(key)),)
+        return tuple(self.key(child, ranges) for child in node[1:])
+
+    def build(self, key, results):
+        formula, ranges = key
+        node = self.nodes[formula]
+        op = node[0]
+        for child in self.children(key):
+            if self.uses[child[0]] == 1:
+                self.memo.maps[0].pop(child, None)
+        if op == normal_form.ATOM:
+            return self.atom(node, ranges)
+        if op == normal_form.NOT:
+            return ~results[0]
+        if op in (normal_form.EXISTS, normal_form.FORALL):
+            if not results:
+                return self.chunks(key)
+            return self.reduce(op, node[1], node[2], results[0])
+        target = [var for var, _, _ in ranges]
+        left, right = (self.align(result, self.variables(child), target)
+                       for result, child in zip(results, node[1:]))
+        if op == normal_form.AND:
+            return left & right
+        if op == normal_form.OR:
+            return left | right
+        if op == normal_form.IMPLIES:
+            return ~left | right
+        return left == right
+
+    def align(self, value, variables, target):
+        # variables is a sorted subsequence of target, so adding length one
+        # axes for the rest lets the operands broadcast against each other.
+        if len(variables) == len(target):
+            return value
+        return value.reshape([value.shape[variables.index(var)]
+                              if var in variables else 1 for var in target])
+
+    def reduce(self, op, var, body, value):
+        variables = self.variables(body)
+        if var not in variables:
+            return value
+        axis = variables.index(var)
+        if op == normal_form.EXISTS:
+            return value.any(axis=axis)
+        return value.all(axis=axis)
+
+    def chunks(self, key):
+        # Each chunk of the quantified variable's range gets its own memo,
+        # so the results that depend on it are dropped with it.
+        formula, ranges = key
+        op, var, body = self.nodes[formula]
+        size = self.structure.size
+        other = self.size(self.key(body, self.body_ranges(key))) // size
+        step = max(1, self.budget // max(other, 1))
+        outer = self.memo
+        result = None
+        try:
+            for start in range(0, size, step):
+                self.memo = outer.new_child()
+                part = self.value(self.key(
+                    body, ranges + ((var, start, min(size, start + step)),)))
+                part = self.reduce(op, var, body, part)
+                if result is None:
+                    result = part
+                elif op == normal_form.EXISTS:
+                    result |= part
+                else:
+                    result &= part
+                if (result.all() if op == normal_form.EXISTS
+                        else not result.any()):
+                    break
+        finally:
+            self.memo = outer
+        return result
+
+    def atom(self, node, ranges):
+        np = self.np
+        _, predicate, terms = node
+        variables = [var for var, _, _ in ranges]
+        shape = [stop - start for _, start, stop in ranges]
+        constants = self.structure.constants
+
+        def index(term):
+            # An element or an array along the axis of the variable.
+            if term in constants:
+                return constants[term]
+            axis = variables.index(term)
+            _, start, stop = ranges[axis]
+            axes = [1] * len(variables)
+            axes[axis] = stop - start
+            return np.arange(start, stop).reshape(axes)
+
+        if predicate == self.store.signature.equality:
+            return np.asarray(np.equal(index(terms[0]), index(terms[1])))
+        relation = self.structure.relations[predicate]
+        if self.structure.dense[predicate]:
+            return np.asarray(relation[tuple(index(term) for term in terms)])
+        mask = np.ones(len(relation), dtype=bool)
+        first = {}
+        for position, term in enumerate(terms):
+            column = relation[:, position]
+            if term in constants:
+                mask &= column == constants[term]
+            elif term in first:
+                mask &= column == relation[:, first[term]]
+            else:
+                first[term] = position
+                _, start, stop = ranges[variables.index(term)]
+                mask &= (column >= start) & (column < stop)
+        value = np.zeros(shape, dtype=bool)
+        value[tuple(relation[mask, first[var]] - start
+                    for var, start, _ in ranges)] = True
+        return value
+
+    def value(self, key):
+        return normal_form.rewrite(key, self.children, self.build, self.memo)
+
+    def evaluate(self, formula):
+        normal_form.free_variables(self.store, formula)
+        self.uses = self.count_uses(formula)
+        variables = self.variables(formula)
+        key = (formula, tuple((var, 0, self.structure.size)
+                              for var in variables))
+        try:
+            return Valuation(variables, self.value(key))
+        except MemoryError:
+            raise ModelError('Ran out of memory evaluating the formula, a' +
+                             ' smaller memory budget splits quantifiers' +
+                             ' into chunks')
+        finally:
+            self.memo = ChainMap()
+
+
+def evaluate(tree, tokens, structure, budget=None):
+    """
+        Evaluates the formula parsed into tree in structure. budget, in
+        bytes, bounds the boolean arrays made for quantified subformulas.
+    """
+    store = normal_form.FormulaStore(structure.signature)
+    formula = normal_form.from_tree(store, tree, tokens)
+    return Evaluator(store, structure, budget).evaluate(formula)
@@ -0,0 +1,454 @@
+"""
+    Normal forms of parsed formulas for solvers: negation normal form, prenex
+    form and a definitional (Tseitin) clausal form of the prenex matrix whose
+    size is linear in the formula. Formulas are hash-consed in a FormulaStore,
+    so a subformula that occurs many times is stored and transformed once, and
+    every transformation runs on an explicit stack rather than recursing.
+"""
+
+import instrument
+import parse_tree
+
+ATOM = 0
+NOT = 1
+AND = 2
+OR = 3
+IMPLIES = 4
+IFF = 5
+EXISTS = 6
+FORALL = 7
+
+ROLES = {'NOT': NOT, 'AND': AND, 'OR': OR, 'IMPLIES': IMPLIES, 'IFF': IFF,
+         'EXISTS': EXISTS, 'FORALL': FORALL}
+DUAL = {AND: OR, OR: AND, EXISTS: FORALL, FORALL: EXISTS}
+FORMS = ['nnf', 'prenex', 'cnf']
+
+
+class FormulaStore:
+    # Node f is nodes[f], one of (ATOM, predicate, terms), (NOT, g),
+    # (op, g, h) for the binary connectives and (quantifier, variable, g).
+    # Equality atoms use the equality symbol as their predicate. memo keeps
+    # the results of each transformation by name.
+    def __init__(self, signature):
+        self.signature = signature
+        self.nodes = []
+        self.index = {}
+        self.memo = {}
+        self.fresh = 0
+        self.names = {}
+        self.roles = {}
+        for sym, attrib in signature.sym_table.items():
+            if attrib[0] in ('CONNECTIVE', 'QUANTIFIER'):
+                self.names[ROLES[attrib[1]]] = sym
+                self.roles[sym] = ROLES[attrib[1]]
+        self.constants = set(signature.constants)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def make(self, *node):
+        formula = self.index.get(node)
+        if formula is None:
+            formula = len(self.nodes)
+            self.index[node] = formula
+            self.nodes.append(node)
+        return formula
+
+    def variable(self, name):
+        # Symbols cannot contain '.', so fresh names never clash with them.
+        self.fresh += 1
+        return f'{name}.{self.fresh}'
+
+    def is_variable(self, term):
+        return term not in self.constants
+
+    def size(self, formula):
+        # Distinct nodes reachable from formula.
+        seen = {formula}
+        stack = [formula]
+        while stack:
+            node = self.nodes[stack.pop()]
+            if node[0] == ATOM:
+                continue
+            for child in node[2:] if node[0] in (EXISTS, FORALL) else \
+                    node[1:]:
+                if child not in seen:
+                    seen.add(child)
+                    stack.append(child)
+        return len(seen)
+
+    def atom_text(self, node):
+        _, predicate, terms = node
+        if predicate == self.signature.equality:
+            return f'({terms[0]} {predicate} {terms[1]})'
+        return f'{predicate}({",".join(terms)})'
+
+    def text(self, formula):
+        parts = []
+        stack = [formula]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                parts.append(item)
+                continue
+            node = self.nodes[item]
+            op = node[0]
+            if op == ATOM:
+                parts.append(self.atom_text(node))
+            elif op == NOT:
+                stack += [node[1], f'{self.names[NOT]} ']
+            elif op in (EXISTS, FORALL):
+                stack += [node[2], f'{self.names[op]} {node[1]} ']
+            else:
+                stack += [')', node[2], f' {self.names[op]} ', node[1], '(']
+        return ''.join(parts)
+
+
+def rewrite(root, children, build, memo):
+    # Memoized post-order walk: children(key) lists the keys the result for
+    # key is built from and build(key, results) makes it.
+    stack = [(root, children(root))]
+    while stack:
+        key, keys = stack[-1]
+        if key in memo:
+            stack.pop()
+            continue
+        pending = [child for child in keys if child not in memo]
+        if pending:
+            stack += [(child, children(child)) for child in pending]
+            continue
+        stack.pop()
+        memo[key] = build(key, [memo[child] for child in keys])
+    return memo[root]
+
+
+def from_tree(store, tree, tokens):
+    # In reverse pre-order every node comes after its subtree, so the values
+    # of its children are the top of a single stack, first child on top.
+    values = []
+    for node in range(len(tree) - 1, -1, -1):
+        kind = tree.kind[node]
+        count = sum(1 for _ in tree.children(node))
+        children = values[len(values) - count:]
+        children.reverse()
+        del values[len(values) - count:]
+        token = tree.token[node]
+        value = None
+        if kind in (parse_tree.VARIABLE, parse_tree.CONSTANT):
+            value = tokens.text(token)
+        elif kind in (parse_tree.CONNECTIVE, parse_tree.QUANTIFIER):
+            value = store.roles[tokens.text(token)]
+        elif kind == parse_tree.PREDICATE_RULE:
+            value = (tokens.text(token),
+                     tuple(child for child in children if child is not None))
+        elif kind == parse_tree.PREDICATE:
+            value = children[0]
+        elif kind == parse_tree.ATOM:
+            if len(children) == 1:
+                value = store.make(ATOM, *children[0])
+            else:
+                value = store.make(ATOM, store.signature.equality,
+                                   (children[1], children[3]))
+        elif kind == parse_tree.FORMULA:
+            if len(children) == 1:
+                value = children[0]
+            elif len(children) == 2:
+                value = store.make(NOT, children[1])
+            elif len(children) == 3:
+                value = store.make(*children)
+            else:
+                value = store.make(children[2], children[1], children[3])
+        values.append(value)
+    return values[0]
+
+
+def nnf(store, formula):
+    # IMPLIES and IFF are expanded and negations pushed down to the atoms.
+    # Results are kept per (subformula, polarity), so each IFF costs a
+    # constant number of new nodes however often its sides are shared.
+    nodes = store.nodes
+
+    def children(key):
+        formula, positive = key
+        node = nodes[formula]
+        op = node[0]
+        if op == ATOM:
+            return ()
+        if op == NOT:
+            return ((node[1], not positive),)
+        if op in (AND, OR):
+            return ((node[1], positive), (node[2], positive))
+        if op == IMPLIES:
+            return ((node[1], not positive), (node[2], positive))
+        if op == IFF:
+            return ((node[1], False), (node[2], True), (node[1], True),
+                    (node[2], False))
+        return ((node[2], positive),)
+
+    def build(key, results):
+        formula, positive = key
+        node = nodes[formula]
+        op = node[0]
+        if op == ATOM:
+            return formula if positive else store.make(NOT, formula)
+        if op == NOT:
+            return results[0]
+        if op in (AND, OR):
+            return store.make(op if positive else DUAL[op], *results)
+        if op == IMPLIES:
+            return store.make(OR if positive else AND, *results)
+        if op == IFF:
+            not_a, b, a, not_b = results
+            if positive:
+                return store.make(AND, store.make(OR, not_a, b),
+                                  store.make(OR, a, not_b))
+            return store.make(AND, store.make(OR, a, b),
+                              store.make(OR, not_a, not_b))
+        return store.make(op if positive else DUAL[op], node[1], results[0])
+
+    return rewrite((formula, True), children, build,
+                   store.memo.setdefault('nnf', {}))
+
+
+def free_variables(store, formula):
+    nodes = store.nodes
+
+    def children(formula):
+        node = nodes[formula]
+        if node[0] == ATOM:
+            return ()
+        if node[0] in (EXISTS, FORALL):
+            return (node[2],)
+        return node[1:]
+
+    def build(formula, results):
+        node = nodes[formula]
+        if node[0] == ATOM:
+            return frozenset(term for term in node[2]
+                             if store.is_variable(term))
+        if node[0] in (EXISTS, FORALL):
+            return results[0] - {node[1]}
+        if len(results) == 1:
+            return results[0]
+        return results[0] | results[1]
+
+    return rewrite(formula, children, build, store.memo.setdefault('free', {}))
+
+
+def rename_apart(store, formula):
+    # Gives every quantifier of an NNF formula a fresh variable. A result
+    # depends on the renaming of the free variables of its subformula, a
+    # sorted tuple of (variable, fresh name) pairs, so that is part of the
+    # key.
+    nodes = store.nodes
+    free_variables(store, formula)
+    free = store.memo['free']
+    fresh = {}
+
+    def restrict(renaming, formula):
+        variables = free[formula]
+        return formula, tuple(pair for pair in renaming
+                              if pair[0] in variables)
+
+    def children(key):
+        formula, renaming = key
+        node = nodes[formula]
+        op = node[0]
+        if op == ATOM:
+            return ()
+        if op in (EXISTS, FORALL):
+            if key not in fresh:
+                fresh[key] = store.variable(node[1])
+            renaming = dict(renaming)
+            renaming[node[1]] = fresh[key]
+            return (restrict(tuple(sorted(renaming.items())), node[2]),)
+        return tuple(restrict(renaming, child) for child in node[1:])
+
+    def build(key, results):
+        formula, renaming = key
+        node = nodes[formula]
+        op = node[0]
+        if op == ATOM:
+            if not renaming:
+                return formula
+            renaming = dict(renaming)
+            return store.make(ATOM, node[1], tuple(renaming.get(term, term)
+                                                   for term in node[2]))
+        if op in (EXISTS, FORALL):
+            return store.make(op, fresh[key], results[0])
+        return store.make(op, *results)
+
+    return rewrite(restrict((), formula), children, build, {})
+
+
+def quantifier_prefix(store, formula):
+    # Quantifiers of an NNF formula with distinct quantified variables, as
+    # (quantifier, variable) outermost first. Pulling them up through AND
+    # and OR lists them in pre-order, where a subformula shared by both sides
+    # repeats its quantifiers and only the last occurrence of each matters.
+    # Those are the first occurrences in the mirror image of that order, in
+    # which a subformula seen before adds nothing new and can be skipped.
+    nodes = store.nodes
+    prefix = []
+    seen = set()
+    stack = [(formula, False)]
+    while stack:
+        formula, done = stack.pop()
+        node = nodes[formula]
+        if done:
+            prefix.append((node[0], node[1]))
+            continue
+        if formula in seen or node[0] in (ATOM, NOT):
+            continue
+        seen.add(formula)
+        if node[0] in (EXISTS, FORALL):
+            stack += [(formula, True), (node[2], False)]
+        else:
+            stack += [(node[1], False), (node[2], False)]
+    prefix.reverse()
+    return tuple(prefix)
+
+
+def matrix(store, formula):
+    # formula with its quantifiers removed.
+    nodes = store.nodes
+
+    def children(formula):
+        node = nodes[formula]
+        if node[0] in (ATOM, NOT):
+            return ()
+        if node[0] in (EXISTS, FORALL):
+            return (node[2],)
+        return node[1:]
+
+    def build(formula, results):
+        node = nodes[formula]
+        if node[0] in (ATOM, NOT):
+            return formula
+        if node[0] in (EXISTS, FORALL):
+            return results[0]
+        return store.make(node[0], *results)
+
+    return rewrite(formula, children, build,
+                   store.memo.setdefault('matrix', {}))
+
+
+def prenex(store, formula):
+    # Returns (prefix, matrix, formula) for the NNF of formula.
+    renamed = rename_apart(store, nnf(store, formula))
+    prefix = quantifier_prefix(store, renamed)
+    result = body = matrix(store, renamed)
+    for op, var in reversed(prefix):
+        result = store.make(op, var, result)
+    return prefix, body, result
+
+
+class ClausalForm:
+    # The matrix as clauses under the quantifier prefix. A literal is an
+    # atom or a negated atom of the store. definitions lists (atom,
+    # subformula) for each definition predicate, whose atom takes the free
+    # variables of the subformula it names.
+    __slots__ = ('prefix', 'clauses', 'definitions')
+
+    def __init__(self, prefix, clauses, definitions):
+        self.prefix = prefix
+        self.clauses = clauses
+        self.definitions = definitions
+
+    def literals(self):
+        return sum(len(clause) for clause in self.clauses)
+
+    def lines(self, store):
+        yield ' '.join(f'{store.names[op]} {var}' for op, var in self.prefix)
+        for clause in self.clauses:
+            yield f' {store.names[OR]} '.join(store.text(literal)
+                                              for literal in clause)
+
+
+def tseitin(store, prefix, matrix):
+    # The matrix is in NNF, so every subformula occurs positively and only
+    # the definition -> subformula half of each definition is needed. Each
+    # distinct subformula gets one definition, which keeps the clauses
+    # linear in the size of the matrix.
+    nodes = store.nodes
+    free_variables(store, matrix)
+    free = store.memo['free']
+    clauses = []
+    definitions = []
+
+    def children(formula):
+        node = nodes[formula]
+        if node[0] in (ATOM, NOT):
+            return ()
+        return node[1:]
+
+    def build(formula, results):
+        node = nodes[formula]
+        if node[0] in (ATOM, NOT):
+            return formula
+        name = store.make(ATOM, f'def.{len(definitions) + 1}',
+                          tuple(sorted(free[formula])))
+        definitions.append((name, formula))
+        negated = store.make(NOT, name)
+        if node[0] == AND:
+            clauses.extend((negated, result) for result in results)
+        else:
+            clauses.append((negated, *results))
+        return name
+
+    clauses.append((rewrite(matrix, children, build, {}),))
+    return ClausalForm(prefix, clauses, definitions)
+
+
+class NormalForms:
+    __slots__ = ('store', 'formula', 'nnf', 'prefix', 'matrix', 'prenex',
+                 'cnf')
+
+    def __init__(self, store, formula):
+        self.store = store
+        self.formula = formula
+        self.nnf = None
+        self.prefix = None
+        self.matrix = None
+        self.prenex = None
+        self.cnf = None
+
+    def stats(self):
+        store = self.store
+        stats = {'input_nodes': store.size(self.formula),
+                 'store_nodes': len(store)}
+        if self.nnf is not None:
+            stats['nnf_nodes'] = store.size(self.nnf)
+        if self.prenex is not None:
+            stats['prenex_nodes'] = store.size(self.prenex)
+            stats['quantifiers'] = len(self.prefix)
+        if self.cnf is not None:
+            stats['clauses'] = len(self.cnf.clauses)
+            stats['literals'] = self.cnf.literals()
+            stats['definitions'] = len(self.cnf.definitions)
+        return stats
+
+    def lines(self, form):
+        if form == 'cnf':
+            return self.cnf.lines(self.store)
+        return [self.store.text(self.nnf if form == 'nnf' else self.prenex)]
+
+
+def convert(tree, tokens, signature, form='cnf', profile=None):
+    # Runs the transformations up to form, timing each as a phase of
+    # profile and counting the sizes of what it made.
+    if profile is None:
+        profile = instrument.Profile()
+    store = FormulaStore(signature)
+    with profile.phase('normal_form_input'):
+        forms = NormalForms(store, from_tree(store, tree, tokens))
+    with profile.phase('nnf'):
+        forms.nnf = nnf(store, forms.formula)
+    if form in ('prenex', 'cnf'):
+        with profile.phase('prenex'):
+            forms.prefix, forms.matrix, forms.prenex = prenex(
+                store, forms.formula)
+    if form == 'cnf':
+        with profile.phase('cnf'):
+            forms.cnf = tseitin(store, forms.prefix, forms.matrix)
+    return forms
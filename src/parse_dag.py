@@ -0,0 +1,190 @@
+"""
+    Hash-consed form of the parse tree. Structurally identical subtrees, such
+    as an atom repeated all over a generated formula, are stored once and
+    shared, so the number of nodes grows with the number of distinct
+    subformulas rather than with the size of the formula.
+"""
+
+import json
+from array import array
+
+import parse_tree
+
+
+class ParseDag:
+    # Built through the same add() calls a parser makes on a ParseTree. A
+    # node is interned once its subtree is complete, which in pre-order is
+    # when a node is added under one of its ancestors, so children always
+    # have smaller ids than their parents. Node n has the children
+    # children[child_start[n]:child_start[n + 1]], and token is the first
+    # token of its first occurrence.
+    __slots__ = ('tokens', 'kind', 'symbol', 'token', 'child_start',
+                 'children', 'root', 'index', 'pending', 'added')
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.kind = array('b')
+        self.symbol = array('i')
+        self.token = array('l')
+        self.child_start = array('l', [0])
+        self.children = array('l')
+        self.root = -1
+        self.index = {}
+        # Entries [id, kind, token, children] from the root down to the
+        # last node added, none of them interned yet.
+        self.pending = []
+        self.added = 0
+
+    def __len__(self):
+        return len(self.kind)
+
+    def __getstate__(self):
+        return (self.tokens, self.kind, self.symbol, self.token,
+                self.child_start, self.children, self.root)
+
+    def __setstate__(self, state):
+        (self.tokens, self.kind, self.symbol, self.token, self.child_start,
+         self.children, self.root) = state
+        self.index = None
+        self.pending = []
+        self.added = 0
+
+    def add(self, kind, token, parent):
+        # Takes and returns the pre-order ids a ParseTree would use.
+        while self.pending and self.pending[-1][0] != parent:
+            self.intern()
+        node = self.added
+        self.added += 1
+        self.pending.append([node, kind, token, []])
+        return node
+
+    def intern(self):
+        _, kind, token, children = self.pending.pop()
+        symbol = -1
+        if kind in (parse_tree.SYMBOL, parse_tree.PREDICATE_RULE):
+            symbol = self.tokens.symbol[token]
+        key = (kind, symbol, tuple(children))
+        node = self.index.get(key)
+        if node is None:
+            node = len(self.kind)
+            self.index[key] = node
+            self.kind.append(kind)
+            self.symbol.append(symbol)
+            self.token.append(token)
+            self.children.extend(children)
+            self.child_start.append(len(self.children))
+        if self.pending:
+            self.pending[-1][3].append(node)
+        else:
+            self.root = node
+
+    def close(self):
+        # Interns what is left. No nodes can be added afterwards, and the
+        # index is dropped to free its memory.
+        while self.pending:
+            self.intern()
+        self.index = None
+        return self
+
+    def child_ids(self, node):
+        return self.children[self.child_start[node]:
+                             self.child_start[node + 1]]
+
+    def is_leaf(self, node):
+        return self.child_start[node] == self.child_start[node + 1]
+
+    def label(self, node, tokens):
+        kind = self.kind[node]
+        if kind == parse_tree.SYMBOL:
+            return tokens.text(self.token[node])
+        if kind == parse_tree.PREDICATE_RULE:
+            return f'<{tokens.text(self.token[node])}_rule>'
+        return f'<{parse_tree.KIND_NAMES[kind]}>'
+
+    def sizes(self):
+        # Number of tree nodes each node stands for.
+        sizes = array('l', [1]) * len(self)
+        for node in range(len(self)):
+            for child in self.child_ids(node):
+                sizes[node] += sizes[child]
+        return sizes
+
+    def uses(self):
+        # Number of parents pointing at each node, counting repeats.
+        uses = array('l', [0]) * len(self)
+        for child in self.children:
+            uses[child] += 1
+        return uses
+
+    def stats(self):
+        tree_nodes = self.sizes()[self.root] if len(self) else 0
+        return {'tree_nodes': tree_nodes, 'dag_nodes': len(self),
+                'edges': len(self.children),
+                'sharing': tree_nodes / len(self) if len(self) else 0.0}
+
+
+def from_tree(tree, tokens):
+    dag = ParseDag(tokens)
+    for node in range(len(tree)):
+        dag.add(tree.kind[node], tree.token[node], tree.parent[node])
+    return dag.close()
+
+
+def write_dot(dag, tokens, out, dpi=300, options=None):
+    # Directed, so that a shared node reads as one node with many parents.
+    out.write('digraph G {\n')
+    if dpi:
+        out.write(f'dpi={dpi};\n')
+    out.write('rankdir=TB;\nordering=out;\n')
+    leaves = []
+    uses = dag.uses()
+    for node in range(len(dag) - 1, -1, -1):
+        label = parse_tree.escape_bslash(dag.label(node, tokens))
+        if uses[node] > 1:
+            out.write(f'{node} [label="{label}", xlabel="x{uses[node]}"];\n')
+        else:
+            out.write(f'{node} [label="{label}"];\n')
+        for child in dag.child_ids(node):
+            out.write(f'{node} -> {child};\n')
+        if dag.is_leaf(node):
+            leaves.append(node)
+    out.write('subgraph {\nrank=max;\n')
+    for node in leaves:
+        out.write(f'{node};\n')
+    out.write('}\n}\n')
+
+
+def write_json(dag, tokens, out, options=None):
+    # Flat node list where children always come before their parents.
+    stats = dag.stats()
+    out.write(f'{{"root": {dag.root}, "tree_nodes": {stats["tree_nodes"]},' +
+              ' "nodes": [')
+    uses = dag.uses()
+    for node in range(len(dag)):
+        if node:
+            out.write(', ')
+        entry = {'id': node, 'kind': parse_tree.KIND_NAMES[dag.kind[node]],
+                 'label': dag.label(node, tokens), 'token': dag.token[node],
+                 'children': dag.child_ids(node).tolist(),
+                 'uses': uses[node]}
+        out.write(json.dumps(entry))
+    out.write(']}\n')
+
+
+def render(dag, tokens, path, fmt='png', options=None):
+    # The view options of parse trees (subtree, depth and size caps, folding)
+    # do not apply, as the DAG already draws each shared subtree once.
+    if options is None:
+        options = parse_tree.RenderOptions()
+    if fmt == 'none':
+        return
+    if fmt in ('dot', 'json'):
+        with open(path, 'w') as out:
+            if fmt == 'dot':
+                write_dot(dag, tokens, out)
+            else:
+                write_json(dag, tokens, out)
+    elif fmt in ('svg', 'png'):
+        parse_tree.run_graphviz(dag, tokens, path, fmt, options, write_dot)
+    else:
+        raise ValueError(f'Unknown output format {fmt}')
@@ -0,0 +1,331 @@
+import json
+import subprocess
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+FORMULA = 0
+ATOM = 1
+QUANTIFIER = 2
+CONNECTIVE = 3
+VARIABLE = 4
+CONSTANT = 5
+NEGATION = 6
+EQUALITY = 7
+PREDICATE = 8
+PREDICATE_RULE = 9
+SYMBOL = 10
+
+OUTPUT_FORMATS = ['none', 'dot', 'svg', 'png', 'json']
+LAYOUT_ENGINES = ['dot', 'sfdp', 'neato', 'fdp', 'twopi', 'circo']
+
+KIND_NAMES = ['Formula', 'Atom', 'Quantifier', 'Connective', 'Variable',
+              'Constant', 'Negation', 'Equality', 'Predicate',
+              'Predicate_rule', 'Symbol']
+
+
+def escape_bslash(string):
+    return string.replace('\\', '\\\\')
+
+
+class ParseTree:
+    # Nodes are numbered in creation (pre-)order and stored column-wise.
+    # token holds the token of a SYMBOL or PREDICATE_RULE node and the
+    # first token covered by any other node.
+    __slots__ = ('kind', 'token', 'parent', 'first_child', 'last_child',
+                 'next_sibling')
+
+    def __init__(self):
+        self.kind = array('b')
+        self.token = array('l')
+        self.parent = array('l')
+        self.first_child = array('l')
+        self.last_child = array('l')
+        self.next_sibling = array('l')
+
+    def __len__(self):
+        return len(self.kind)
+
+    def add(self, kind, token, parent):
+        node = len(self.kind)
+        self.kind.append(kind)
+        self.token.append(token)
+        self.parent.append(parent)
+        self.first_child.append(-1)
+        self.last_child.append(-1)
+        self.next_sibling.append(-1)
+        if parent > -1:
+            if self.first_child[parent] == -1:
+                self.first_child[parent] = node
+            else:
+                self.next_sibling[self.last_child[parent]] = node
+            self.last_child[parent] = node
+        return node
+
+    def children(self, node):
+        child = self.first_child[node]
+        while child != -1:
+            yield child
+            child = self.next_sibling[child]
+
+    def is_leaf(self, node):
+        return self.first_child[node] == -1
+
+    def label(self, node, tokens):
+        kind = self.kind[node]
+        if kind == SYMBOL:
+            return tokens.text(self.token[node])
+        if kind == PREDICATE_RULE:
+            return f'<{tokens.text(self.token[node])}_rule>'
+        return f'<{KIND_NAMES[kind]}>'
+
+
+class RenderOptions:
+    # max_nodes is the size budget: the depth cap is lowered until the drawn
+    # tree fits in it. fold_repeats folds any subtree of at least that many
+    # nodes whose shape has already been drawn. timeout bounds graphviz.
+    __slots__ = ('prog', 'dpi', 'root', 'max_depth', 'max_nodes',
+                 'fold_repeats', 'timeout')
+
+    def __init__(self, prog='dot', dpi=300, root=0, max_depth=None,
+                 max_nodes=None, fold_repeats=0, timeout=None):
+        self.prog = prog
+        self.dpi = dpi
+        self.root = root
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        self.fold_repeats = fold_repeats
+        self.timeout = timeout
+
+
+def subtree_sizes(tree):
+    # Nodes are in pre-order, so the subtree of n is n .. n + size - 1.
+    sizes = array('l', [1]) * len(tree)
+    for node in range(len(tree) - 1, 0, -1):
+        sizes[tree.parent[node]] += sizes[node]
+    return sizes
+
+
+def depths(tree):
+    depth = array('l', [0]) * len(tree)
+    for node in range(1, len(tree)):
+        depth[node] = depth[tree.parent[node]] + 1
+    return depth
+
+
+def subtree_shapes(tree, tokens):
+    shapes = array('l', [0]) * len(tree)
+    children = [[] for _ in range(len(tree))]
+    interned = {}
+    for node in range(len(tree) - 1, -1, -1):
+        kind = tree.kind[node]
+        text = None
+        if kind in (SYMBOL, PREDICATE_RULE):
+            text = tokens.text(tree.token[node])
+        key = (kind, text, tuple(reversed(children[node])))
+        shapes[node] = interned.setdefault(key, len(interned))
+        children[node] = None
+        if node:
+            children[tree.parent[node]].append(shapes[node])
+    return shapes
+
+
+def budget_depth(depth, root, end, max_nodes):
+    counts = {}
+    for node in range(root, end):
+        counts[depth[node]] = counts.get(depth[node], 0) + 1
+    total = 0
+    for level in sorted(counts):
+        total += counts[level]
+        if total > max_nodes:
+            return max(level - 1 - depth[root], 0)
+    return None
+
+
+def check_view(tree, options):
+    # Run before any output is opened, so bad options leave no partial file.
+    if options is None:
+        return
+    if not 0 <= options.root < len(tree):
+        raise ValueError(f'Parse tree has no node {options.root}, its nodes' +
+                         f' are 0 to {len(tree) - 1}')
+    for name in ('max_depth', 'max_nodes', 'fold_repeats'):
+        value = getattr(options, name)
+        if value is not None and value < 0:
+            raise ValueError(f'{name} must not be negative, got {value}')
+
+
+def view(tree, tokens, options=None):
+    # Yields (node, parent, label, hidden) for every node to draw, where
+    # hidden counts the nodes folded into it.
+    if options is None or (options.root == 0 and options.max_depth is None
+                           and not options.max_nodes
+                           and not options.fold_repeats):
+        for node in range(len(tree)):
+            yield node, tree.parent[node], tree.label(node, tokens), 0
+        return
+    check_view(tree, options)
+    root = options.root
+    sizes = subtree_sizes(tree)
+    depth = depths(tree)
+    end = root + sizes[root]
+    max_depth = options.max_depth
+    if options.max_nodes:
+        limit = budget_depth(depth, root, end, options.max_nodes)
+        if limit is not None and (max_depth is None or limit < max_depth):
+            max_depth = limit
+    shapes = subtree_shapes(tree, tokens) if options.fold_repeats else None
+    seen = {}
+    node = root
+    while node < end:
+        parent = tree.parent[node] if node != root else -1
+        label = tree.label(node, tokens)
+        if shapes is not None and sizes[node] >= options.fold_repeats:
+            first = seen.setdefault(shapes[node], node)
+            if first != node:
+                yield (node, parent, f'{label} same as {first}',
+                       sizes[node] - 1)
+                node += sizes[node]
+                continue
+        if (max_depth is not None and depth[node] - depth[root] >= max_depth
+                and sizes[node] > 1):
+            yield node, parent, f'{label} +{sizes[node] - 1}', sizes[node] - 1
+            node += sizes[node]
+            continue
+        yield node, parent, label, 0
+        node += 1
+
+
+def to_pydot(tree, tokens, options=None):
+    import pydot
+    dpi = options.dpi if options else 300
+    graph = pydot.Dot(graph_type='graph', dpi=str(dpi), rankdir='TB')
+    subgraph = pydot.Subgraph(rank='max')
+    for node, parent, label, hidden in view(tree, tokens, options):
+        graph.add_node(pydot.Node(node, label=f'"{escape_bslash(label)}"'))
+        if parent > -1:
+            graph.add_edge(pydot.Edge(parent, node))
+        if hidden or tree.is_leaf(node):
+            subgraph.add_node(pydot.Node(node))
+    graph.add_subgraph(subgraph)
+    return graph
+
+
+def write_dot(tree, tokens, out, dpi=300, options=None):
+    out.write('graph G {\n')
+    if dpi:
+        out.write(f'dpi={dpi};\n')
+    out.write('rankdir=TB;\n')
+    leaves = []
+    for node, parent, label, hidden in view(tree, tokens, options):
+        if hidden:
+            out.write(f'{node} [label="{escape_bslash(label)}",' +
+                      f' shape=box];\n')
+        else:
+            out.write(f'{node} [label="{escape_bslash(label)}"];\n')
+        if parent > -1:
+            out.write(f'{parent} -- {node};\n')
+        if hidden or tree.is_leaf(node):
+            leaves.append(node)
+    out.write('subgraph {\nrank=max;\n')
+    for node in leaves:
+        out.write(f'{node};\n')
+    out.write('}\n}\n')
+
+
+def write_json(tree, tokens, out, options=None):
+    # Flat node list in pre-order so deep trees need no recursion.
+    out.write('{"nodes": [')
+    first = True
+    for node, parent, label, hidden in view(tree, tokens, options):
+        if not first:
+            out.write(', ')
+        first = False
+        entry = {'id': node, 'kind': KIND_NAMES[tree.kind[node]],
+                 'label': label, 'token': tree.token[node], 'parent': parent}
+        if hidden:
+            entry['hidden'] = hidden
+        out.write(json.dumps(entry))
+    out.write(']}\n')
+
+
+def run_graphviz(tree, tokens, path, fmt, options, write=write_dot):
+    # Streams the DOT text into graphviz rather than building pydot objects.
+    # write is the DOT writer for tree.
+    process = subprocess.Popen([options.prog, f'-T{fmt}', '-o', path],
+                               stdin=subprocess.PIPE, stderr=subprocess.PIPE,
+                               text=True)
+    timer = None
+    if options.timeout:
+        timer = threading.Timer(options.timeout, process.kill)
+        timer.start()
+    try:
+        write(tree, tokens, process.stdin,
+              options.dpi if fmt == 'png' else None, options)
+        process.stdin.close()
+    except BrokenPipeError:
+        pass
+    error = process.stderr.read()
+    status = process.wait()
+    if timer:
+        timer.cancel()
+    if status != 0:
+        if options.timeout and status == -9:
+            raise OSError(f'{options.prog} did not finish within' +
+                          f' {options.timeout}s')
+        raise OSError(f'{options.prog} exited with status {status}:' +
+                      f' {error.strip()}')
+
+
+def render(tree, tokens, path, fmt='png', options=None):
+    if options is None:
+        options = RenderOptions()
+    if fmt == 'none':
+        return
+    check_view(tree, options)
+    if fmt in ('dot', 'json'):
+        with open(path, 'w') as out:
+            if fmt == 'dot':
+                write_dot(tree, tokens, out, options=options)
+            else:
+                write_json(tree, tokens, out, options)
+    elif fmt in ('svg', 'png'):
+        run_graphviz(tree, tokens, path, fmt, options)
+    else:
+        raise ValueError(f'Unknown output format {fmt}')
+
+
+class RenderQueue:
+    # Layout and rasterization happen on worker threads, which spend their
+    # time waiting on graphviz, so callers get their verdicts straight away.
+    def __init__(self, workers=2):
+        self.pool = ThreadPoolExecutor(workers)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.done = 0
+        self.failed = []
+
+    def submit(self, tree, tokens, path, fmt='png', options=None,
+               draw=render):
+        with self.lock:
+            self.pending += 1
+        future = self.pool.submit(draw, tree, tokens, path, fmt, options)
+        future.add_done_callback(lambda done: self.finished(done, path))
+        return future
+
+    def finished(self, future, path):
+        with self.lock:
+            self.pending -= 1
+            if future.exception() is None:
+                self.done += 1
+            else:
+                self.failed.append((path, str(future.exception())))
+
+    def stats(self):
+        with self.lock:
+            return {'pending': self.pending, 'done': self.done,
+                    'failed': len(self.failed)}
+
+    def wait(self):
+        self.pool.shutdown(wait=True)
+        return self.failed
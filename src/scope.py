@@ -0,0 +1,107 @@
+"""
+    Scope analysis in one pass over a parse tree. Each variable occurrence is
+    resolved to the quantifier that binds it, and free variables, vacuous
+    quantifiers (whose variable never occurs in their scope) and shadowed
+    quantifiers (which rebind a variable an enclosing quantifier binds) are
+    collected on the way.
+"""
+
+from array import array
+
+import parse_tree
+
+
+class Scopes:
+    # binder[n] is the quantified <Formula> node binding the <Variable> node
+    # n, which is -1 for free occurrences and any other node. The variable
+    # written after a quantifier is bound by that quantifier. free maps the
+    # symbol id of each free variable to its first occurrence, vacuous lists
+    # quantified <Formula> nodes and shadowed holds (node, outer node) pairs.
+    __slots__ = ('binder', 'free', 'vacuous', 'shadowed')
+
+    def __init__(self, binder, free, vacuous, shadowed):
+        self.binder = binder
+        self.free = free
+        self.vacuous = vacuous
+        self.shadowed = shadowed
+
+    def free_names(self, tree, tokens):
+        return [tokens.text(tree.token[node]) for node in self.free.values()]
+
+    def report(self, tree, tokens):
+        def position(node):
+            return tokens.offset[tree.token[node]]
+
+        def quantifier(node):
+            return (f'{tokens.text(tree.token[node])}' +
+                    f' {tokens.text(tree.token[node] + 1)}')
+
+        messages = []
+        for node in self.free.values():
+            messages.append(f'Variable {tokens.text(tree.token[node])} is' +
+                            f' free, first at formula position' +
+                            f' {position(node)}')
+        for node in self.vacuous:
+            messages.append(f'Quantifier {quantifier(node)} at formula' +
+                            f' position {position(node)} is vacuous, its' +
+                            f' variable does not occur in its scope')
+        for node, outer in self.shadowed:
+            messages.append(f'Quantifier {quantifier(node)} at formula' +
+                            f' position {position(node)} shadows' +
+                            f' {quantifier(outer)} at formula position' +
+                            f' {position(outer)}')
+        return messages
+
+
+def analyze(tree, tokens):
+    kind = tree.kind
+    parent = tree.parent
+    binder = array('l', [-1]) * len(tree)
+    # Innermost binding quantifier of each variable, and the open scopes as
+    # (node, symbol, outer binding) from the outermost in.
+    bound = {}
+    scopes = []
+    uses = {}
+    free = {}
+    vacuous = []
+    shadowed = []
+    # Nodes from the root down to the current one. A scope closes when its
+    # node is popped, which happens once the walk leaves its subtree.
+    path = []
+
+    def close(node):
+        if scopes and scopes[-1][0] == node:
+            _, symbol, outer = scopes.pop()
+            if outer == -1:
+                del bound[symbol]
+            else:
+                bound[symbol] = outer
+            if not uses[node]:
+                vacuous.append(node)
+
+    for node in range(len(tree)):
+        while path and path[-1] != parent[node]:
+            close(path.pop())
+        path.append(node)
+        if kind[node] != parse_tree.VARIABLE:
+            continue
+        symbol = tokens.symbol[tree.token[node]]
+        formula = parent[node]
+        if kind[formula] == parse_tree.FORMULA:
+            # Only a quantifier puts a variable straight under a <Formula>.
+            outer = bound.get(symbol, -1)
+            if outer != -1:
+                shadowed.append((formula, outer))
+            binder[node] = formula
+            bound[symbol] = formula
+            uses[formula] = 0
+            scopes.append((formula, symbol, outer))
+        elif symbol in bound:
+            binder[node] = bound[symbol]
+            uses[bound[symbol]] += 1
+        elif symbol not in free:
+            free[symbol] = node
+    while path:
+        close(path.pop())
+    vacuous.sort()
+    return Scopes(binder, free, vacuous, shadowed)
@@ -0,0 +1,233 @@
+"""
+    Long-running compiler service speaking one JSON object per line.
+
+    Requests carry an "op" of signature, validate (the default), parse or
+    stats, an optional "id" that is echoed back, and either the signature
+    header text in "signature" or the "signature_id" returned by an earlier
+    request. Every response has "ok" and "latency_ms". A valid parse or
+    validate request may carry "render": {"path": ..., "format": ...}, plus
+    any of layout, dpi, subtree, max_depth, max_nodes, fold_repeats and
+    timeout; the tree is then drawn by a background worker and the response
+    does not wait for it.
+"""
+
+import argparse
+import json
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+
+import compiler
+import parse_tree
+
+
+def field(request, name, kind=str):
+    value = request[name]
+    if not isinstance(value, kind):
+        raise compiler.CompilerError(
+            f'Field {name} must be {"an object" if kind is dict else "text"}')
+    return value
+
+
+class CompilerService:
+    def __init__(self, cache_size=128, cache_dir=None, result_size=4096,
+                 result_path=None, render_jobs=2,
+                 result_entries=compiler.RESULT_DISK_ENTRIES):
+        self.renders = parse_tree.RenderQueue(render_jobs)
+        self.signatures = compiler.SignatureCache(cache_size, cache_dir)
+        self.results = None
+        if result_size:
+            self.results = compiler.ResultCache(result_size, result_path,
+                                                result_entries)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'errors': 0, 'seconds': 0.0}
+
+    def load_signature(self, text):
+        # Returns (signature id, signature), counting one cache lookup.
+        sym_table, _ = compiler.stream_input(text.splitlines(True))
+        sig_id, signature, _ = self.signatures.lookup(sym_table)
+        return sig_id, signature
+
+    def get_compiler(self, request):
+        if 'signature' in request:
+            sig_id, signature = self.load_signature(
+                field(request, 'signature'))
+        else:
+            sig_id = field(request, 'signature_id')
+            signature = self.signatures.get(sig_id)
+        if signature is None:
+            raise compiler.CompilerError(f'Unknown signature id {sig_id}')
+        return sig_id, compiler.Compiler(signature, True, self.results)
+
+    def signature(self, request):
+        return {'signature_id':
+                self.load_signature(field(request, 'signature'))[0]}
+
+    def validate(self, request):
+        sig_id, comp = self.get_compiler(request)
+        formula = field(request, 'formula')
+        response = {'signature_id': sig_id, 'valid': True,
+                    'error': None, 'position': None}
+        try:
+            result = comp.parse(formula)
+        except compiler.CompilerError as err:
+            response.update(valid=False, error=err.message,
+                            position=err.position)
+            return response
+        if 'render' in request:
+            render = field(request, 'render', dict)
+            field(render, 'path')
+            fmt = render.get('format', 'png')
+            if fmt not in parse_tree.OUTPUT_FORMATS:
+                raise compiler.CompilerError(f'Unknown output format {fmt}')
+            if render.get('layout', 'dot') not in parse_tree.LAYOUT_ENGINES:
+                raise compiler.CompilerError(
+                    f'Unknown layout engine {render["layout"]}')
+            comp.render_options = parse_tree.RenderOptions(
+                render.get('layout', 'dot'), render.get('dpi', 300),
+                render.get('subtree', 0), render.get('max_depth'),
+                render.get('max_nodes', 20000), render.get('fold_repeats', 0),
+                render.get('timeout', 300))
+            comp.render(result, render['path'], fmt, self.renders)
+            response['render'] = 'queued'
+        if request.get('op') == 'parse':
+            response['tokens'] = result.tokens.pairs()
+            response['nodes'] = len(result.tree)
+        return response
+
+    def get_stats(self, request):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['signatures'] = len(self.signatures.memory)
+        stats['signature_hits'] = self.signatures.memory.hits
+        stats['signature_misses'] = self.signatures.memory.misses
+        if self.results:
+            stats['results'] = self.results.stats()
+        stats['renders'] = self.renders.stats()
+        if stats['requests']:
+            stats['mean_latency_ms'] = (stats['seconds'] * 1000 /
+                                        stats['requests'])
+        return stats
+
+    def handle(self, request):
+        start = time.perf_counter()
+        handlers = {'signature': self.signature, 'validate': self.validate,
+                    'parse': self.validate, 'stats': self.get_stats}
+        op = request.get('op', 'validate')
+        try:
+            if not isinstance(op, str) or op not in handlers:
+                raise compiler.CompilerError(f'Unknown operation {op}')
+            response = handlers[op](request)
+            response['ok'] = True
+        except compiler.CompilerError as err:
+            response = {'ok': False, 'error': err.message}
+        except KeyError as err:
+            response = {'ok': False, 'error': f'Missing field {err}'}
+        except Exception as err:
+            # A request that breaks the compiler must not stop the service.
+            response = {'ok': False, 'error': f'Internal error.' +
+                        f' {type(err).__name__}: {err}'}
+        if 'id' in request:
+            response['id'] = request['id']
+        return self.finish(response, start)
+
+    def finish(self, response, start):
+        elapsed = time.perf_counter() - start
+        response['latency_ms'] = elapsed * 1000
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['errors'] += not response['ok']
+            self.stats['seconds'] += elapsed
+        return response
+
+    def handle_line(self, line):
+        start = time.perf_counter()
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('request must be a JSON object')
+        except ValueError as err:
+            return json.dumps(self.finish(
+                {'ok': False, 'error': f'Bad request: {err}'}, start))
+        return json.dumps(self.handle(request))
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = self.server.service.handle_line(line.decode())
+            self.wfile.write(response.encode() + b'\n')
+            self.wfile.flush()
+
+
+class UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, service):
+        self.service = service
+        super().__init__(path, RequestHandler)
+
+
+def serve_socket(path, service):
+    if os.path.exists(path):
+        os.unlink(path)
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    with UnixServer(path, service) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(path)
+
+
+def serve_stdio(service, in_file=sys.stdin, out_file=sys.stdout):
+    for line in in_file:
+        if not line.strip():
+            continue
+        out_file.write(service.handle_line(line) + '\n')
+        out_file.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve validate/parse requests from a warm compiler')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-s', '--socket', metavar='PATH',
+                       help='Listen on a Unix domain socket at PATH')
+    group.add_argument('--stdio', action='store_true',
+                       help='Read requests from stdin, answer on stdout')
+    parser.add_argument('--cache-size', type=int, default=128,
+                        help='Number of signatures kept warm in memory')
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        help='Also keep signature tables on disk in DIR')
+    parser.add_argument('--result-cache-size', type=int, default=4096,
+                        help='Number of formula results kept in memory,' +
+                        ' 0 disables the result cache')
+    parser.add_argument('--result-cache', metavar='FILE_NAME',
+                        help='Database file shared with other processes for' +
+                        ' formula results')
+    parser.add_argument('--result-cache-entries', type=int,
+                        default=compiler.RESULT_DISK_ENTRIES, metavar='N',
+                        help='Evict the least recently used results once ' +
+                        'the database holds N, 0 for no limit')
+    parser.add_argument('--render-jobs', type=int, default=2,
+                        help='Worker threads drawing requested parse trees')
+    options = parser.parse_args()
+    service = CompilerService(options.cache_size, options.cache_dir,
+                              options.result_cache_size, options.result_cache,
+                              options.render_jobs,
+                              options.result_cache_entries)
+    if options.socket:
+        serve_socket(options.socket, service)
+    else:
+        serve_stdio(service)
+
+
+if __name__ == '__main__':
+    main()
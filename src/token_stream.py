@@ -0,0 +1,82 @@
+from array import array
+
+LPAREN = 0
+RPAREN = 1
+COMMA = 2
+VARIABLE = 3
+CONSTANT = 4
+PREDICATE = 5
+EQUALITY = 6
+CONNECTIVE = 7
+NEGATION = 8
+QUANTIFIER = 9
+
+KIND_NAMES = ['(', ')', ',', 'VARIABLE', 'CONSTANT', 'PREDICATE', 'EQUALITY',
+              'CONNECTIVE', 'NEGATION', 'QUANTIFIER']
+PUNCTUATION = {'(': LPAREN, ')': RPAREN, ',': COMMA}
+
+# Each predicate is a terminal of its own in the parse table, numbered from
+# here by symbol id.
+PREDICATE_TERMINALS = 16
+
+
+def terminal(kind, symbol):
+    if kind == PREDICATE:
+        return PREDICATE_TERMINALS + symbol
+    return kind
+
+
+class TokenStream:
+    # Tokens stored column-wise: the kind, the id of the symbol in the
+    # signature and where the lexeme is in source. codes caches the
+    # terminal codes the parser reads and is not pickled.
+    __slots__ = ('source', 'kind', 'symbol', 'offset', 'length', 'codes')
+
+    def __init__(self, source):
+        self.source = source
+        self.kind = array('b')
+        self.symbol = array('i')
+        self.offset = array('l')
+        self.length = array('i')
+        self.codes = None
+
+    def __getstate__(self):
+        return self.source, self.kind, self.symbol, self.offset, self.length
+
+    def __setstate__(self, state):
+        self.source, self.kind, self.symbol, self.offset, self.length = state
+        self.codes = None
+
+    def __len__(self):
+        return len(self.kind)
+
+    def append(self, kind, symbol, offset, length):
+        self.kind.append(kind)
+        self.symbol.append(symbol)
+        self.offset.append(offset)
+        self.length.append(length)
+
+    def text(self, index):
+        # source may also be a bytes-like buffer, where a lexeme can run
+        # over a line break that is not part of it.
+        offset = self.offset[index]
+        text = self.source[offset:offset + self.length[index]]
+        if not isinstance(text, str):
+            text = ''.join(bytes(text).decode().split())
+        return text
+
+    def terminals(self):
+        if self.codes is None or len(self.codes) != len(self.kind):
+            self.codes = array('l', [terminal(kind, symbol) for kind, symbol
+                                     in zip(self.kind, self.symbol)])
+        return self.codes
+
+    def end(self):
+        # Position just after the last token.
+        if not self.kind:
+            return 0
+        return self.offset[-1] + self.length[-1]
+
+    def pairs(self):
+        return [[KIND_NAMES[self.kind[i]], self.text(i)]
+                for i in range(len(self.kind))]